@@ -0,0 +1,181 @@
+"""
+Deterministic synthetic corpus for the benchmarks.
+
+Everything is generated locally from fixed seeds, hence two runs on two machines time the same inputs:
+- Text images at several resolutions and noise levels
+- Searchable multi-page PDFs, having an embedded text layer
+- Scanned multi-page PDFs, having only images of text
+- Passport and PAN like text, as OCR would output it
+- Passport and PAN like card images, at the size of a 300 DPI scan
+"""
+import os
+import random
+
+import numpy as np
+import cv2 as cv
+from PIL import Image
+from pikepdf import Pdf, Page, Dictionary, Name, Array
+
+
+WORDS = [
+    "document", "processing", "extract", "text", "image", "scanned", "invoice", "amount", "date", "customer",
+    "address", "account", "number", "payment", "total", "signature", "agreement", "period", "balance", "statement",
+]
+
+# Long side in pixels. Roughly a thumbnail, a scan at 150 DPI and a phone photo.
+RESOLUTIONS = {
+    "small": (640, 480),
+    "medium": (1240, 1754),
+    "large": (3024, 4032),
+}
+
+# Standard deviation of the gaussian noise added to the pixels.
+NOISE_LEVELS = {
+    "clean": 0,
+    "noisy": 12,
+    "very-noisy": 30,
+}
+
+# A CR80 card, e.g a PAN card, and a passport's data page, scanned at 300 DPI.
+CARD_SIZES = {
+    "pan": (1011, 638),
+    "passport": (1476, 1039),
+}
+
+PASSPORT_TEXT = """REPUBLIC OF INDIA
+Type P Country Code IND Passport No.
+J8369854
+Surname
+RAMADUGULA
+Given Name(s)
+SITA MAHA LAKSHMI
+Nationality
+INDIAN
+Sex Date of Birth
+F 23/09/1959
+Place of Birth
+GUNDUGOLANU
+Place of Issue
+HYDERABAD
+Date of Issue Date of Expiry
+11/10/2008 10/10/2018
+"""
+
+PAN_TEXT = """INCOME TAX DEPARTMENT GOVT. OF INDIA
+RAHUL GUPTA
+SURESH GUPTA
+23/11/1974
+Permanent Account Number
+ABCDE1234F
+Signature
+"""
+
+
+def sentences(seed: int, count: int, words_per_sentence: int = 10):
+    rng = random.Random(seed)
+    for _ in range(count):
+        words = [rng.choice(WORDS) for _ in range(words_per_sentence)]
+        yield " ".join(words).capitalize() + "."
+
+
+def long_text(seed: int, sentence_count: int) -> str:
+    return "\n".join(sentences(seed, sentence_count))
+
+
+def render_text_image(width: int, height: int, noise: int = 0, seed: int = 0) -> np.ndarray:
+    """
+    Renders lines of text on a white background, as a BGR array, similar to what cv.imread returns.
+    """
+    img = np.full((height, width, 3), 255, dtype=np.uint8)
+    font_scale = width / 1200
+    line_height = max(int(40 * font_scale), 12)
+    y = line_height * 2
+    for sentence in sentences(seed, height // line_height):
+        if y >= height - line_height:
+            break
+        cv.putText(img, sentence[:60], (line_height, y), cv.FONT_HERSHEY_SIMPLEX, font_scale, (0, 0, 0), max(int(2 * font_scale), 1))
+        y += line_height
+    if noise > 0:
+        rng = np.random.default_rng(seed)
+        noisy = img.astype(np.int16) + rng.normal(0, noise, img.shape).astype(np.int16)
+        img = np.clip(noisy, 0, 255).astype(np.uint8)
+    return img
+
+
+def render_card_image(text: str, width: int, height: int) -> np.ndarray:
+    """
+    Renders the lines of `text` on a white card, as a BGR array. A line per line of the text, filling the card's height.
+    """
+    img = np.full((height, width, 3), 255, dtype=np.uint8)
+    lines = text.strip().splitlines()
+    line_height = height // (len(lines) + 2)
+    font_scale = min(line_height / 55, 1.2)
+    y = line_height * 2
+    for line in lines:
+        cv.putText(img, line, (line_height, y), cv.FONT_HERSHEY_SIMPLEX, font_scale, (0, 0, 0), 2)
+        y += line_height
+    return img
+
+
+def write_searchable_pdf(path: str, pages: int, lines_per_page: int = 40, seed: int = 0):
+    """
+    A PDF with an embedded text layer, using the standard Helvetica font. pdfminer.six can extract it without OCR.
+    """
+    pdf = Pdf.new()
+    font = pdf.make_indirect(Dictionary(Type=Name.Font, Subtype=Name.Type1, BaseFont=Name.Helvetica))
+    for page_index in range(pages):
+        operations = ["BT", "/F1 11 Tf", "14 TL", "50 800 Td"]
+        for sentence in sentences(seed + page_index, lines_per_page):
+            operations.append(f"({sentence}) Tj T*")
+        operations.append("ET")
+        content = pdf.make_stream("\n".join(operations).encode('latin-1'))
+        page = Dictionary(
+            Type=Name.Page,
+            MediaBox=Array([0, 0, 595, 842]),
+            Contents=content,
+            Resources=Dictionary(Font=Dictionary(F1=font)),
+        )
+        pdf.pages.append(Page(pdf.make_indirect(page)))
+    pdf.save(path)
+    pdf.close()
+
+
+def write_scanned_pdf(path: str, pages: int, noise: int = 12, seed: int = 0):
+    """
+    A PDF having only images of text, no text layer. Needs OCR.
+    """
+    width, height = RESOLUTIONS["medium"]
+    images = [Image.fromarray(render_text_image(width, height, noise, seed + page_index)[..., ::-1]) for page_index in range(pages)]
+    images[0].save(path, save_all=True, append_images=images[1:], resolution=150)
+
+
+def build_corpus(directory: str, pdf_pages: int = 5) -> dict:
+    """
+    Writes the corpus to `directory` and returns the paths and texts, keyed by name.
+    """
+    os.makedirs(directory, exist_ok=True)
+    corpus = {"images": {}, "pdfs": {}, "texts": {}, "cards": {}}
+    for resolution, (width, height) in RESOLUTIONS.items():
+        for noise_name, noise in NOISE_LEVELS.items():
+            name = f"{resolution}-{noise_name}"
+            path = os.path.join(directory, f"{name}.png")
+            cv.imwrite(path, render_text_image(width, height, noise))
+            corpus["images"][name] = path
+    for pages in (1, pdf_pages):
+        path = os.path.join(directory, f"searchable-{pages}.pdf")
+        write_searchable_pdf(path, pages)
+        corpus["pdfs"][f"searchable-{pages}"] = path
+        path = os.path.join(directory, f"scanned-{pages}.pdf")
+        write_scanned_pdf(path, pages)
+        corpus["pdfs"][f"scanned-{pages}"] = path
+    for name, text in (("pan", PAN_TEXT), ("passport", PASSPORT_TEXT)):
+        width, height = CARD_SIZES[name]
+        path = os.path.join(directory, f"card-{name}.png")
+        cv.imwrite(path, render_card_image(text, width, height))
+        corpus["cards"][name] = path
+    corpus["texts"]["passport"] = PASSPORT_TEXT
+    corpus["texts"]["pan"] = PAN_TEXT
+    corpus["texts"]["short"] = long_text(seed=1, sentence_count=20)
+    # Roughly what pdfminer outputs for a long searchable PDF.
+    corpus["texts"]["long"] = long_text(seed=2, sentence_count=5000)
+    return corpus
@@ -0,0 +1,353 @@
+"""
+Stage-level benchmarks of the hot functions.
+
+Every function is timed separately, on the synthetic corpus from benchmarks.corpus.
+A result is a JSON line having the benchmark name, the input, timings, throughput and peak memory.
+Peak memory is the peak of Python allocations, which includes NumPy arrays, measured with tracemalloc.
+Memory of subprocesses like tesseract and pdftoppm isn't included, see max_rss_children_kb_cumulative.
+It's the largest subprocess since the start of the run, as the OS reports it, hence only an upper bound for a single benchmark.
+The startup benchmark times imports and model loading in a fresh interpreter, i.e the cold start of the API and the workers.
+
+Usage, from the repository root:
+
+    python -m benchmarks.run --output bench-before.jsonl
+    python -m benchmarks.run --output bench-after.jsonl --baseline bench-before.jsonl
+    python -m benchmarks.run --only classify
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+import statistics
+from types import SimpleNamespace
+
+from benchmarks.corpus import build_corpus
+
+# The benchmarks time the functions alone. Don't record stage metrics to Redis.
+os.environ.setdefault("METRICS_ENABLED", "false")
+
+
+def measure(name: str, input_name: str, function, *args, repeat: int = 5, units: float = 1, unit: str = "calls", **kwargs) -> dict:
+    """
+    Times `repeat` calls of `function`. The first call is a warm-up and isn't timed, as it pays for lazy loading.
+    `units` is the amount of work done by one call, e.g bytes or pages, to compute the throughput.
+    tracemalloc slows down every allocation, hence the timed calls run without it, and the peak memory is of an extra traced call.
+    """
+    function(*args, **kwargs)
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    mean = statistics.mean(durations)
+    return {
+        "benchmark": name,
+        "input": input_name,
+        "repeat": repeat,
+        "mean_s": mean,
+        "median_s": statistics.median(durations),
+        "min_s": min(durations),
+        "max_s": max(durations),
+        "throughput": units / mean if mean > 0 else None,
+        "throughput_unit": f"{unit}/s",
+        "peak_python_bytes": peak_bytes,
+        # The largest child process so far in this run, not necessarily one of this benchmark's.
+        "max_rss_children_kb_cumulative": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def skipped(name: str, reason: str) -> dict:
+    return {"benchmark": name, "skipped": reason}
+
+
+def bench_identify_file_type(corpus, repeat):
+    from services import identify_file_type
+    # libmagic reads from the file descriptor, hence a real file, like the upload's temporary file in the API, not a BytesIO.
+    for name, path in {**corpus["images"], **corpus["pdfs"]}.items():
+        def identify(path=path):
+            with open(path, "rb") as f:
+                identify_file_type(f)
+        yield measure("identify_file_type", name, identify, repeat=repeat)
+
+
+def bench_preprocess_image_opencv(corpus, repeat):
+    from image_preprocessing import preprocess_image_opencv
+    combinations = [
+        {"gray": gray, "denoise": denoise, "binarize": binarize}
+        for gray in (True, False) for denoise in (True, False) for binarize in (True, False)
+    ]
+    for name, path in corpus["images"].items():
+        size_bytes = os.path.getsize(path)
+        for options in combinations:
+            for source in ("image", "pdf"):
+                input_name = f"{name} {source} " + ",".join(option for option, enabled in options.items() if enabled)
+                yield measure(
+                    "preprocess_image_opencv", input_name, preprocess_image_opencv, path, options, source,
+                    repeat=repeat, units=size_bytes, unit="bytes"
+                )
+
+
+def bench_preprocess_image_adaptive(corpus, repeat):
+    from image_preprocessing import preprocess_image_file
+    # The default chain against the adaptive one, on the same images.
+    for name, path in corpus["images"].items():
+        size_bytes = os.path.getsize(path)
+        for source in ("image", "pdf"):
+            for adaptive in (False, True):
+                options = {"gray": True, "denoise": True, "binarize": True, "adaptive": adaptive}
+                input_name = f"{name} {source} {'adaptive' if adaptive else 'default'}"
+                yield measure(
+                    "preprocess_image_adaptive", input_name, preprocess_image_file, path, options, source,
+                    repeat=repeat, units=size_bytes, unit="bytes"
+                )
+
+
+def bench_extract_pdf_text_searchable(corpus, repeat):
+    from services import extract_pdf_text_searchable
+    for name, path in corpus["pdfs"].items():
+        if not name.startswith("searchable"):
+            continue
+        pages = int(name.split("-")[1])
+
+        def extract():
+            with open(path, "rb") as f:
+                extract_pdf_text_searchable(f)
+        yield measure("extract_pdf_text_searchable", name, extract, repeat=repeat, units=pages, unit="pages")
+
+
+def bench_extract_pdf_text_non_searchable(corpus, repeat):
+    from services import extract_pdf_text_non_searchable
+    for name, path in corpus["pdfs"].items():
+        if not name.startswith("scanned"):
+            continue
+        pages = int(name.split("-")[1])
+        for workers in sorted({1, os.cpu_count() or 1}):
+            yield measure(
+                "extract_pdf_text_non_searchable", f"{name} workers={workers}", extract_pdf_text_non_searchable, path, workers,
+                repeat=max(1, repeat // 2), units=pages, unit="pages"
+            )
+
+
+def bench_two_pass(corpus, repeat):
+    """
+    The two-pass OCR of ID cards against the general pass, and the classification pass alone at several sizes, with the category it finds.
+    The classification pass should cost a fraction of the general pass, while still classifying the card. See CLASSIFICATION_PASS_MAX_SIDE.
+    """
+    import cv2 as cv
+    import services
+    from image_preprocessing import preprocess_image_file
+    options = {"gray": True, "denoise": True, "binarize": True}
+    for name, path in corpus["cards"].items():
+        def general(path=path):
+            services.extract_image_layout(preprocess_image_file(path, options))
+        yield measure("two_pass", f"{name} general", general, repeat=repeat)
+        yield measure("two_pass", f"{name} two_pass", services.extract_image_text_two_pass, path, options, repeat=repeat)
+        img = cv.imread(path)
+        default_max_side = services.CLASSIFICATION_PASS_MAX_SIDE
+        for max_side in (480, 640, 960, 1280):
+            services.CLASSIFICATION_PASS_MAX_SIDE = max_side
+            try:
+                result = measure("classification_pass", f"{name} max_side={max_side}", services.classify_image_quickly, img, repeat=repeat)
+                result["category"] = services.classify_image_quickly(img)[0]
+            finally:
+                services.CLASSIFICATION_PASS_MAX_SIDE = default_max_side
+            yield result
+
+
+def bench_is_meaningful_content(corpus, repeat):
+    from text_analysis import is_meaningful_content
+    for name, text in corpus["texts"].items():
+        yield measure("is_meaningful_content", name, is_meaningful_content, text, repeat=repeat, units=len(text), unit="chars")
+    garbage = " ".join("x" for _ in range(100000))
+    yield measure("is_meaningful_content", "garbage", is_meaningful_content, garbage, repeat=repeat, units=len(garbage), unit="chars")
+
+
+def bench_probe_pdf_pages(corpus, repeat):
+    from services import probe_pdf_pages
+    for name, path in corpus["pdfs"].items():
+        pages = int(name.split("-")[1])
+        yield measure("probe_pdf_pages", name, probe_pdf_pages, path, repeat=repeat, units=pages, unit="pages")
+
+
+def bench_extract_pdf_text_all(corpus, repeat):
+    from services import extract_pdf_text_all
+    for name, path in corpus["pdfs"].items():
+        if not name.startswith("searchable"):
+            continue
+        pages = int(name.split("-")[1])
+        yield measure("extract_pdf_text_all", name, extract_pdf_text_all, path, repeat=repeat, units=pages, unit="pages")
+
+
+def bench_classify(corpus, repeat):
+    from text_analysis import classify
+    for name, text in corpus["texts"].items():
+        yield measure("classify", name, classify, text, repeat=repeat, units=len(text), unit="chars")
+
+
+def bench_analyze(corpus, repeat):
+    from text_analysis import analyze_passport, analyze_pan
+    for name, text in corpus["texts"].items():
+        yield measure("analyze_passport", name, analyze_passport, text, repeat=repeat, units=len(text), unit="chars")
+        yield measure("analyze_pan", name, analyze_pan, text, repeat=repeat, units=len(text), unit="chars")
+
+
+def bench_analyze_statistics(corpus, repeat):
+    from text_analysis import analyze
+    for name, text in corpus["texts"].items():
+        yield measure("analyze", name, analyze, text, repeat=repeat, units=len(text), unit="chars")
+
+
+def bench_merge_pdfs(corpus, repeat):
+    from services import merge_pdfs
+    if not os.path.isdir("/media/merged-pdfs"):
+        yield skipped("merge_pdfs", "/media/merged-pdfs doesn't exist, merge_pdfs writes there")
+        return
+    paths = list(corpus["pdfs"].values())
+
+    def merge():
+        attachments = []
+        for path in paths:
+            with open(path, "rb") as f:
+                attachments.append(SimpleNamespace(file=io.BytesIO(f.read()), filename=f"bench-{os.path.basename(path)}"))
+        merge_pdfs(attachments)
+    yield measure("merge_pdfs", f"{len(paths)} pdfs", merge, repeat=repeat, units=len(paths), unit="pdfs")
+
+
+def bench_converse(corpus, repeat):
+    from language_processing import converse
+    questions = ["Who paid the amount?", "Where did they go?", "How much is the total?", "When was the payment?"]
+    for name in ("short", "passport"):
+        text = corpus["texts"][name]
+        for question in questions:
+            yield measure("converse", f"{name} {question}", converse, text, question, repeat=repeat, units=len(text), unit="chars")
+
+
+def bench_converse_many(corpus, repeat):
+    from language_processing import converse_many, doc_cache
+    questions = ["Who paid the amount?", "Where did they go?", "How much is the total?", "When was the payment?"]
+    texts = [corpus["texts"]["short"] + f" Reference {index}." for index in range(32)]
+    items = [(text, question) for text in texts for question in questions]
+
+    def uncached():
+        doc_cache.clear()
+        converse_many(items)
+    yield measure("converse_many", f"{len(texts)} texts uncached", uncached, repeat=repeat, units=len(items), unit="questions")
+    yield measure("converse_many", f"{len(texts)} texts cached", converse_many, items, repeat=repeat, units=len(items), unit="questions")
+
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cold start, each in a fresh interpreter: the API boot, a worker's imports, and the first use of the models.
+STARTUP_SNIPPETS = {
+    "import main": "import main",
+    "import service_wrappers": "import service_wrappers",
+    "import language_processing": "import language_processing",
+    "text_analysis warm_up": "import text_analysis; text_analysis.warm_up()",
+    "language_processing warm_up": "import language_processing; language_processing.warm_up()",
+    "ocr_engine warm_up": "import ocr_engine; ocr_engine.warm_up()",
+}
+
+
+def bench_startup(corpus, repeat):
+    def run_python(code: str):
+        subprocess.run([sys.executable, "-c", code], cwd=REPOSITORY_ROOT, check=True, capture_output=True)
+
+    for name, code in STARTUP_SNIPPETS.items():
+        try:
+            run_python(code)
+        except subprocess.CalledProcessError as exc:
+            lines = exc.stderr.decode('utf-8').strip().splitlines()
+            yield skipped("startup", f"{name}: {lines[-1] if lines else exc}")
+            continue
+        yield measure("startup", name, run_python, code, repeat=repeat)
+
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "identify_file_type": bench_identify_file_type,
+    "preprocess_image_opencv": bench_preprocess_image_opencv,
+    "preprocess_image_adaptive": bench_preprocess_image_adaptive,
+    "extract_pdf_text_searchable": bench_extract_pdf_text_searchable,
+    "extract_pdf_text_non_searchable": bench_extract_pdf_text_non_searchable,
+    "two_pass": bench_two_pass,
+    "is_meaningful_content": bench_is_meaningful_content,
+    "probe_pdf_pages": bench_probe_pdf_pages,
+    "extract_pdf_text_all": bench_extract_pdf_text_all,
+    "classify": bench_classify,
+    "analyze_passport_pan": bench_analyze,
+    "analyze_statistics": bench_analyze_statistics,
+    "merge_pdfs": bench_merge_pdfs,
+    "converse": bench_converse,
+    "converse_many": bench_converse_many,
+}
+
+
+def compare(results: list, baseline_path: str):
+    """
+    Prints the change in mean time against a previous run, for the benchmarks present in both.
+    """
+    baseline = {}
+    with open(baseline_path) as f:
+        for line in f:
+            result = json.loads(line)
+            if "mean_s" in result:
+                baseline[(result["benchmark"], result["input"])] = result
+    for result in results:
+        previous = baseline.get((result.get("benchmark"), result.get("input")))
+        if previous is None or "mean_s" not in result:
+            continue
+        change = (result["mean_s"] - previous["mean_s"]) / previous["mean_s"] * 100
+        print(f"{result['benchmark']:35} {result['input']:45} {previous['mean_s']:.4f}s -> {result['mean_s']:.4f}s ({change:+.1f}%)", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the hot functions on a synthetic corpus.")
+    parser.add_argument("--output", help="File to write the JSON lines to. Defaults to stdout.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", action="append", help="Run only the benchmarks whose name contains this. Can be repeated.")
+    parser.add_argument("--pdf-pages", type=int, default=5)
+    parser.add_argument("--baseline", help="A previous --output file, to compare against.")
+    parser.add_argument("--corpus-dir", help="Directory to generate the corpus in. Defaults to a temporary directory.")
+    args = parser.parse_args()
+    corpus_dir = args.corpus_dir or tempfile.mkdtemp(prefix="bench-corpus-")
+    corpus = build_corpus(corpus_dir, pdf_pages=args.pdf_pages)
+    output = open(args.output, "w") if args.output else sys.stdout
+    results = []
+    try:
+        for name, benchmark in BENCHMARKS.items():
+            if args.only and not any(only in name for only in args.only):
+                continue
+            try:
+                for result in benchmark(corpus, args.repeat):
+                    results.append(result)
+                    output.write(json.dumps(result) + "\n")
+                    output.flush()
+            except Exception as exc:
+                # e.g a missing dependency. The other benchmarks still run.
+                result = skipped(name, f"{type(exc).__name__}: {exc}")
+                results.append(result)
+                output.write(json.dumps(result) + "\n")
+    finally:
+        if args.output:
+            output.close()
+        if args.corpus_dir is None:
+            shutil.rmtree(corpus_dir)
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
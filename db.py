@@ -13,6 +13,7 @@ We do not want to get into the complexity of setting up a Relational Database wi
 """
 import os
 import redis
+import redis.asyncio
 
 
 # We want to reuse the Redis connection across the application lifecycle,
@@ -22,15 +23,47 @@ import redis
 # We could refactor it to use a Singleton pattern.
 redis_connection = None
 
+# FastAPI runs sync endpoints on a threadpool of 40 threads. Every thread could be talking to Redis at the same time.
+# Leave some headroom over that, for the async endpoints.
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", "50"))
+# Seconds to wait for a free connection, when all of them are in use, before raising.
+REDIS_POOL_TIMEOUT = int(os.environ.get("REDIS_POOL_TIMEOUT", "5"))
+# Every SSE client holds a connection of the async pool for as long as it's connected, blocked in XREAD.
+# Hence it has its own, larger limit.
+REDIS_ASYNC_MAX_CONNECTIONS = int(os.environ.get("REDIS_ASYNC_MAX_CONNECTIONS", "500"))
+
 
 def get_connection():
+    """
+    The Redis client is thread-safe, every command checks out a connection from the pool.
+    A BlockingConnectionPool makes threads wait for a free connection instead of opening unbounded connections.
+    """
     global redis_connection
     if redis_connection is None:
         REDIS_CONNECTION_STRING = os.environ['REDIS_CONNECTION_STRING']
-        redis_connection = redis.Redis(host=REDIS_CONNECTION_STRING)
+        pool = redis.BlockingConnectionPool(host=REDIS_CONNECTION_STRING, max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT)
+        redis_connection = redis.Redis(connection_pool=pool)
     return redis_connection
 
 
+async_redis_connection = None
+
+
+def get_async_connection():
+    """
+    Connection for the async endpoints, so that blocking reads, e.g XREAD BLOCK, don't hold a thread.
+    Like the sync side, a client waits for a free connection instead of failing with "Too many connections" mid-stream.
+    """
+    global async_redis_connection
+    if async_redis_connection is None:
+        REDIS_CONNECTION_STRING = os.environ['REDIS_CONNECTION_STRING']
+        pool = redis.asyncio.BlockingConnectionPool(
+            host=REDIS_CONNECTION_STRING, max_connections=REDIS_ASYNC_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT
+        )
+        async_redis_connection = redis.asyncio.Redis(connection_pool=pool)
+    return async_redis_connection
+
+
 def get_value(key: str) -> str:
     """
     `key` is the file identifier. In our case a hash created using the file path.
@@ -68,6 +101,42 @@ def set_object(key: str, field: str, value: str):
     connection.hset(key, field, value)
 
 
+def claim_object(key: str, field: str, value: str) -> bool:
+    """
+    Claims the file's hash for an extraction job, by setting `field` only if the hash doesn't have it yet.
+    HSETNX <file_hash> type image
+    A hash whose previous extraction failed, i.e having an `error`, is claimed again by deleting the error.
+
+    Only one of concurrent callers gets True. Hence an identical file submitted again, while its job is still queued or running,
+    or once it's done, isn't extracted again.
+    """
+    connection = get_connection()
+    if connection.hsetnx(key, field, value.encode('utf-8')):
+        return True
+    return connection.hdel(key, "error") == 1
+
+
+def claim_objects(field: str, values: dict) -> dict:
+    """
+    Same as claim_object for many hashes, pipelined. `values` is a dict of key -> value.
+    Returns a dict of key -> whether it was claimed.
+    """
+    connection = get_connection()
+    keys = list(values.keys())
+    pipeline = connection.pipeline(transaction=False)
+    for key in keys:
+        pipeline.hsetnx(key, field, values[key].encode('utf-8'))
+    claimed = dict(zip(keys, pipeline.execute()))
+    existing = [key for key in keys if not claimed[key]]
+    if len(existing) > 0:
+        pipeline = connection.pipeline(transaction=False)
+        for key in existing:
+            pipeline.hdel(key, "error")
+        for key, deleted in zip(existing, pipeline.execute()):
+            claimed[key] = deleted == 1
+    return {key: bool(is_claimed) for key, is_claimed in claimed.items()}
+
+
 def get_object(key: str, field: str):
     connection = get_connection()
     value = connection.hget(key, field)
@@ -78,3 +147,65 @@ def get_object(key: str, field: str):
     # Hence decode to utf-8 on read.
     value = value.decode('utf-8')
     return value
+
+
+def set_fields(key: str, mapping: dict, remove_fields: list = None):
+    """
+    Sets multiple fields of the file's hash in a single round trip.
+    HSET <file_hash> content <content> category <category> ...
+
+    `remove_fields` are deleted in the same round trip, e.g the stale results of a previous run which the new run doesn't produce.
+    """
+    connection = get_connection()
+    mapping = {field: value.encode('utf-8') for field, value in mapping.items()}
+    if not remove_fields:
+        connection.hset(key, mapping=mapping)
+        return
+    # A transaction, so that a reader never sees the fields removed but not yet set.
+    pipeline = connection.pipeline(transaction=True)
+    pipeline.hdel(key, *remove_fields)
+    if mapping:
+        pipeline.hset(key, mapping=mapping)
+    pipeline.execute()
+
+
+def set_objects(records: dict):
+    """
+    Sets fields of many hashes, pipelined in a single round trip.
+    `records` is a dict of key -> (dict of field -> value).
+    """
+    connection = get_connection()
+    pipeline = connection.pipeline(transaction=False)
+    for key, mapping in records.items():
+        mapping = {field: value.encode('utf-8') for field, value in mapping.items()}
+        pipeline.hset(key, mapping=mapping)
+    pipeline.execute()
+
+
+def _decode_fields(fields: list, values: list) -> dict:
+    # Redis stores bytes. Decode to utf-8 on read, missing fields are None.
+    return {field: value.decode('utf-8') if value is not None else None for field, value in zip(fields, values)}
+
+
+def get_fields(key: str, fields: list) -> dict:
+    """
+    Gets multiple fields of the file's hash in a single round trip.
+    Returns a dict of field -> value, having None for missing fields.
+    HMGET <file_hash> content category ...
+    """
+    connection = get_connection()
+    values = connection.hmget(key, fields)
+    return _decode_fields(fields, values)
+
+
+def get_objects(keys: list, fields: list) -> dict:
+    """
+    Batch lookup. Gets the same fields of many hashes, pipelined in a single round trip.
+    Returns a dict of key -> (dict of field -> value).
+    """
+    connection = get_connection()
+    pipeline = connection.pipeline(transaction=False)
+    for key in keys:
+        pipeline.hmget(key, fields)
+    results = pipeline.execute()
+    return {key: _decode_fields(fields, values) for key, values in zip(keys, results)}
@@ -0,0 +1,96 @@
+"""
+Progress events of a job, e.g the text of every page as soon as it is extracted, and the job's completion.
+
+Workers append events to a Redis stream per file identifier, events:<key>.
+A stream, unlike pub/sub, retains the events. Hence a client which connects late, or reconnects, replays what it missed.
+Streams are capped in length and expire, as they are only needed while a job is in progress.
+
+The API reads the stream and pushes the events to clients as Server-Sent Events, see /ocr-events.
+"""
+import json
+import logging
+
+from db import get_connection, get_async_connection
+
+
+logger = logging.getLogger(__name__)
+
+EVENT_STREAM_MAXLEN = 1000
+# Seconds for which the events are retained after the last event.
+EVENT_STREAM_TTL = 3600
+# Marks the end of a job's events.
+COMPLETED = "completed"
+
+
+def stream_name(key: str) -> str:
+    return f"events:{key}"
+
+
+def publish(key: str, event: str, data: dict):
+    """
+    Appends an event to the job's stream. Publishing is best effort, a failure is logged and never fails the job.
+
+    Usage:
+    publish(key, "page", {"page": 2, "is_success": True, "content": "..."})
+    """
+    try:
+        connection = get_connection()
+        pipeline = connection.pipeline(transaction=False)
+        pipeline.xadd(stream_name(key), {"event": event, "data": json.dumps(data)}, maxlen=EVENT_STREAM_MAXLEN, approximate=True)
+        pipeline.expire(stream_name(key), EVENT_STREAM_TTL)
+        pipeline.execute()
+    except Exception as exc:
+        logger.error(f"Exception {exc} ocurred while publishing {event} for {key}")
+
+
+def discard_events(keys: list):
+    """
+    Deletes the events of a previous run of the keys, e.g a failed extraction being retried, in a single round trip.
+    Only for keys which have neither content nor an error, whose clients hence wait for the events of the new run. See /ocr-events.
+    """
+    if len(keys) == 0:
+        return
+    try:
+        get_connection().delete(*[stream_name(key) for key in keys])
+    except Exception as exc:
+        logger.error(f"Exception {exc} ocurred while discarding the events of {len(keys)} keys")
+
+
+def restart_events(key: str, event: str, data: dict):
+    """
+    Replaces the job's events with a fresh first event, when a job is run again on the same key, e.g the analysis.
+    Otherwise a client connecting without Last-Event-ID would replay the previous run's `completed`, and disconnect before the new run ends.
+    Clients already connected keep reading, as the new events have later ids. Best effort, like publish.
+    """
+    try:
+        connection = get_connection()
+        # A transaction, so that a client never finds the stream missing, and mistakes the job for completed. See /ocr-events.
+        pipeline = connection.pipeline(transaction=True)
+        pipeline.delete(stream_name(key))
+        pipeline.xadd(stream_name(key), {"event": event, "data": json.dumps(data)}, maxlen=EVENT_STREAM_MAXLEN, approximate=True)
+        pipeline.expire(stream_name(key), EVENT_STREAM_TTL)
+        pipeline.execute()
+    except Exception as exc:
+        logger.error(f"Exception {exc} ocurred while restarting the events of {key}")
+
+
+async def has_events(key: str) -> bool:
+    connection = get_async_connection()
+    return await connection.exists(stream_name(key)) == 1
+
+
+async def read_events(key: str, last_event_id: str = "0-0", block_ms: int = 15000):
+    """
+    Async generator of (event_id, event, data) tuples, from the event after `last_event_id` onwards.
+    Yields None when no event arrived within `block_ms`, so that the caller can send a keep-alive.
+    """
+    connection = get_async_connection()
+    while True:
+        response = await connection.xread({stream_name(key): last_event_id}, block=block_ms, count=100)
+        if not response:
+            yield None
+            continue
+        for _, entries in response:
+            for entry_id, fields in entries:
+                last_event_id = entry_id.decode('utf-8')
+                yield last_event_id, fields[b"event"].decode('utf-8'), fields[b"data"].decode('utf-8')
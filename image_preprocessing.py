@@ -19,15 +19,47 @@ TODO:
 - Rotation and Alignment
 
 Currently we are using Pillow, which is basic. We can move to opencv which has better denoising and binarization support. Also it supports contour detection and DPI normalization.
+
+Adaptive mode:
+Denoising is the most expensive step, and a clean scan doesn't need it. Passing `adaptive` True in the options measures cheap statistics
+of the grayscale image first, see measure_image, and picks the cheapest sufficient chain:
+- An oversized image, e.g a phone photo, is downscaled to PREPROCESS_TARGET_DPI before any filtering.
+- Denoising is skipped on a clean image, downgraded to a median blur on a slightly noisy one, and is the full filter only on a noisy one.
+  A blurry image isn't smoothed further, unless it's noisy.
+- A low contrast image has its contrast equalised before binarisation.
+The measurements and the chosen chain are reported, and stored next to the result.
 """
 
 import os
+import math
 import logging
+from typing import Optional, Tuple
 from PIL import Image, ImageFilter
 import cv2 as cv
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
+# Adaptive mode, see the module docstring.
+PREPROCESS_TARGET_DPI = int(os.environ.get("PREPROCESS_TARGET_DPI", "300"))
+# An image without a trustworthy DPI is assumed to be at most an A4 page, 11.7 inches on its longest side.
+MAX_PAGE_INCHES = 11.7
+# Cameras write 72 DPI whatever the photo is of. A lower DPI isn't trusted.
+MIN_TRUSTED_DPI = 100
+# Estimated standard deviation of the noise, in gray levels. Below LOW the image is clean, above HIGH it's noisy.
+# Calibrated on benchmarks.corpus: clean renders measure 0, gaussian noise of 12 and 30 gray levels about 4.5 and 11.5.
+# Downscaling averages the noise out, the large noisy render measures about 2 once normalised, and isn't denoised.
+NOISE_SIGMA_LOW = 3.0
+NOISE_SIGMA_HIGH = 8.0
+# Share of the pixels, those with the strongest gradient, taken as edges and left out of the noise estimation.
+NOISE_EDGE_SHARE = 0.2
+# Variance of the Laplacian. Below this, the image is blurry.
+BLUR_VARIANCE_THRESHOLD = 100.0
+# Standard deviation of the gray levels. Below this, the contrast is low.
+LOW_CONTRAST_THRESHOLD = 40.0
+# Immerkær's mask, the difference of two Laplacians. It cancels out smooth regions, and leaves the noise.
+NOISE_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+
 
 def preprocess_image(file_path: str):
     try:
@@ -50,6 +82,69 @@ def preprocess_image_opencv(file_path: str, options: dict = None, source: str =
     source could be one of 'image' or 'pdf'. We will apply fastNlMeansDenoising to PDF pages converted to images,
     while apply bilateralFilter to camera images.
 
+    Reads the image, delegates to preprocess_image_array and writes the processed image next to the original.
+    See preprocess_image_array for the steps performed.
+
+    Usage:
+
+        preprocess_image_opencv("/media/ocr-files/ocr-pan.jpeg", options={"denoise": False, "binarize": False})
+    """
+    preprocess_image_file(file_path, options, source, audit=True)
+    base, ext = os.path.splitext(file_path)
+    ext = ext.lstrip(".")
+    return f"{base}-cv-processed.{ext}"
+
+
+def read_dpi(file_path: str) -> Optional[float]:
+    """
+    The DPI stored in the image file, if any. Only the header is read.
+    """
+    try:
+        with Image.open(file_path) as im:
+            dpi = im.info.get("dpi")
+    except Exception as exc:
+        logger.error(f"Exception {exc} ocurred while reading the DPI of {file_path}.")
+        return None
+    if dpi is None:
+        return None
+    return float(max(dpi))
+
+
+def preprocess_image_file(
+    file_path: str, options: dict = None, source: str = "image", audit: bool = False, report: dict = None
+) -> Optional[np.ndarray]:
+    """
+    Reads the image and preprocesses it in memory. The processed array can be handed to OCR directly.
+    The processed image is written next to the original, with a -cv-processed suffix, only if `audit` is True.
+    See preprocess_image_array for `report`.
+
+    Returns None if the file couldn't be decoded as an image.
+    """
+    logger.info(f"file_path: {file_path}")
+    img = cv.imread(file_path)
+    if img is None:
+        logger.error(f"{file_path} couldn't be decoded as an image.")
+        return None
+    dpi = read_dpi(file_path) if options is not None and options.get("adaptive") is True else None
+    img = preprocess_image_array(img, options, source, report=report, dpi=dpi)
+    if audit is True:
+        base, ext = os.path.splitext(file_path)
+        ext = ext.lstrip(".")
+        output_path = f"{base}-cv-processed.{ext}"
+        cv.imwrite(output_path, img)
+    return img
+
+
+def preprocess_image_array(
+    img: np.ndarray, options: dict = None, source: str = "image", report: dict = None, dpi: float = None
+) -> np.ndarray:
+    """
+    Preprocesses an image already decoded in memory, i.e a NumPy array in BGR or grayscale, and returns the processed array.
+    It doesn't touch the disk, hence the output can be handed to OCR directly.
+
+    If a `report` dict is passed, the steps applied are added to it under "chain". In the adaptive mode, see preprocess_image_adaptive,
+    the measurements are added under "stats" as well. `dpi` is the image's DPI, if known. It's only used by the adaptive mode.
+
     Currently performs:
     - Color space conversion from RGB to Grayscale, to make the image easier to read
     - Denoising, Smoothing and Blurring to remove specks/grains, using fastNlMeansDenoising or bilateralFilter
@@ -58,10 +153,6 @@ def preprocess_image_opencv(file_path: str, options: dict = None, source: str =
     TODO:
     - Cropping the area of interest
     - Rotation and Alignment: Using Canny, HoughLines.
-
-    Usage:
-
-        preprocess_image_opencv("/media/ocr-files/ocr-pan.jpeg", options={"denoise": False, "binarize": False})
     """
     default_options = {
         "gray": True,
@@ -71,10 +162,7 @@ def preprocess_image_opencv(file_path: str, options: dict = None, source: str =
     if options is None:
         options = {}
     default_options.update(options)
-    logger.info(f"file_path: {file_path}, options: {default_options}")
-    base, ext = os.path.splitext(file_path)
-    ext = ext.lstrip(".")
-    img = cv.imread(file_path)
+    logger.info(f"options: {default_options}, source: {source}")
     if default_options['denoise'] is True and default_options['gray'] is False:
         # Force grayscale, as denoising is done in grayscale
         logger.info("Forcing grayscale, as denoising is done in grayscale")
@@ -83,27 +171,139 @@ def preprocess_image_opencv(file_path: str, options: dict = None, source: str =
         # Force grayscale, as denoising is done in grayscale
         logger.info("Forcing grayscale, as binarizing is done in grayscale")
         default_options['gray'] = True
-    if default_options['gray'] is True:
+    if default_options.get('adaptive') is True:
+        return preprocess_image_adaptive(img, default_options, source, report, dpi)
+    chain = []
+    if default_options['gray'] is True and img.ndim == 3:
+        # A 2 dimensional array is already grayscale, e.g PDF pages rendered in grayscale.
         img = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+        chain.append("grayscale")
     if default_options['denoise'] is True:
-        if source == "pdf":
-            logger.info("Applying fastNlMeansDenoising")
-            img = cv.fastNlMeansDenoising(img, h=30)
-        else:
-            logger.info("Applying bilateralFilter")
-            # It smoothes the image without losing edges
-            img = cv.bilateralFilter(img, d=9, sigmaColor=75, sigmaSpace=75)
+        img = _denoise(img, source, light=False, chain=chain)
     if default_options['binarize'] is True:
-        img = cv.adaptiveThreshold(
-            img,
-            maxValue=255,
-            adaptiveMethod=cv.ADAPTIVE_THRESH_GAUSSIAN_C,  # or MEAN_C
-            thresholdType=cv.THRESH_BINARY,
-            blockSize=11,  # size of the neighborhood (must be odd)
-            C=2            # constant subtracted from the mean
-        )
+        img = _binarize(img, chain)
     # Check if dilation and erosion needed
     # Find the margins and crop
-    output_path = f"{base}-cv-processed.{ext}"
-    cv.imwrite(output_path, img)
-    return output_path
+    if report is not None:
+        report["chain"] = chain
+    return img
+
+
+def _denoise(img: np.ndarray, source: str, light: bool, chain: list) -> np.ndarray:
+    if light:
+        # A fraction of the cost of the filters below, and enough for specks.
+        logger.info("Applying medianBlur")
+        chain.append("median_blur")
+        return cv.medianBlur(img, 3)
+    if source == "pdf":
+        logger.info("Applying fastNlMeansDenoising")
+        chain.append("fast_nl_means_denoising")
+        return cv.fastNlMeansDenoising(img, h=30)
+    logger.info("Applying bilateralFilter")
+    chain.append("bilateral_filter")
+    # It smoothes the image without losing edges
+    return cv.bilateralFilter(img, d=9, sigmaColor=75, sigmaSpace=75)
+
+
+def _binarize(img: np.ndarray, chain: list) -> np.ndarray:
+    chain.append("adaptive_threshold")
+    return cv.adaptiveThreshold(
+        img,
+        maxValue=255,
+        adaptiveMethod=cv.ADAPTIVE_THRESH_GAUSSIAN_C,  # or MEAN_C
+        thresholdType=cv.THRESH_BINARY,
+        blockSize=11,  # size of the neighborhood (must be odd)
+        C=2            # constant subtracted from the mean
+    )
+
+
+def estimate_noise(gray: np.ndarray) -> float:
+    """
+    Standard deviation of the noise, in gray levels. Immerkær's fast noise variance estimation, a single 3x3 convolution.
+    The mask responds to edges as well, e.g the strokes of the text, which would make a clean scan look noisy.
+    Hence it's averaged over the flat regions only: the NOISE_EDGE_SHARE of pixels with the strongest Sobel gradient,
+    and their neighbours which the mask reaches, are left out.
+    """
+    height, width = gray.shape
+    if height < 3 or width < 3:
+        return 0.0
+    response = cv.filter2D(gray, cv.CV_32F, NOISE_KERNEL)
+    gradient = cv.addWeighted(
+        cv.convertScaleAbs(cv.Sobel(gray, cv.CV_16S, 1, 0)), 0.5, cv.convertScaleAbs(cv.Sobel(gray, cv.CV_16S, 0, 1)), 0.5, 0
+    )
+    # The gradient's threshold from its histogram, rather than sorting the pixels.
+    counts = np.cumsum(cv.calcHist([gradient], [0], None, [256], [0, 256]).ravel())
+    threshold = int(np.searchsorted(counts, counts[-1] * (1 - NOISE_EDGE_SHARE)))
+    _, edges = cv.threshold(gradient, threshold, 255, cv.THRESH_BINARY)
+    # The mask reaches a pixel away from the edge, hence its neighbours are left out as well. The image's border is left out too.
+    flat = cv.bitwise_not(cv.dilate(edges, np.ones((3, 3), dtype=np.uint8)))
+    flat[[0, -1], :] = 0
+    flat[:, [0, -1]] = 0
+    if cv.countNonZero(flat) == 0:
+        return 0.0
+    return cv.mean(np.abs(response), mask=flat)[0] * math.sqrt(math.pi / 2) / 6
+
+
+def measure_image(gray: np.ndarray) -> dict:
+    """
+    Cheap statistics of a grayscale image, each a few passes over the pixels.
+    - noise: see estimate_noise.
+    - blur: variance of the Laplacian. A sharp image has strong edges, hence a high variance.
+    - contrast: standard deviation of the gray levels.
+    """
+    # cv.meanStdDev is a fraction of the cost of NumPy's std, and a float32 Laplacian is precise enough for a threshold.
+    _, laplacian_std = cv.meanStdDev(cv.Laplacian(gray, cv.CV_32F))
+    _, gray_std = cv.meanStdDev(gray)
+    return {
+        "noise": round(estimate_noise(gray), 2),
+        "blur": round(float(laplacian_std[0, 0]) ** 2, 2),
+        "contrast": round(float(gray_std[0, 0]), 2),
+    }
+
+
+def normalisation_scale(shape: Tuple[int, ...], dpi: Optional[float]) -> float:
+    """
+    The factor which brings the image down to PREPROCESS_TARGET_DPI. Images are never upscaled.
+    """
+    longest_side = max(shape[0], shape[1])
+    scale = PREPROCESS_TARGET_DPI * MAX_PAGE_INCHES / longest_side
+    if dpi is not None and dpi >= MIN_TRUSTED_DPI:
+        scale = min(scale, PREPROCESS_TARGET_DPI / dpi)
+    return min(scale, 1.0)
+
+
+def preprocess_image_adaptive(img: np.ndarray, options: dict, source: str, report: dict = None, dpi: float = None) -> np.ndarray:
+    """
+    The adaptive mode of preprocess_image_array. It works in grayscale.
+    `denoise` and `binarize` of the options still switch those steps off, while the measurements decide how much denoising is applied.
+    """
+    chain = []
+    if img.ndim == 3:
+        img = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+        chain.append("grayscale")
+    scale = normalisation_scale(img.shape, dpi)
+    if scale < 1:
+        # Every filter below then runs on fewer pixels. INTER_AREA averages the pixels, rather than dropping them.
+        img = cv.resize(img, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+        chain.append(f"resize:{scale:.2f}")
+    stats = measure_image(img)
+    logger.info(f"Image statistics: {stats}")
+    if options['denoise'] is True:
+        is_blurry = stats["blur"] < BLUR_VARIANCE_THRESHOLD
+        if stats["noise"] >= NOISE_SIGMA_HIGH:
+            img = _denoise(img, source, light=False, chain=chain)
+        elif stats["noise"] >= NOISE_SIGMA_LOW and not is_blurry:
+            img = _denoise(img, source, light=True, chain=chain)
+        else:
+            # Clean, or blurry and smoothing would only blur it further.
+            logger.info("Skipping denoising")
+    if stats["contrast"] < LOW_CONTRAST_THRESHOLD:
+        # Local histogram equalisation, e.g a faded print or a dim photo.
+        img = cv.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(img)
+        chain.append("clahe")
+    if options['binarize'] is True:
+        img = _binarize(img, chain)
+    if report is not None:
+        report["stats"] = stats
+        report["chain"] = chain
+    return img
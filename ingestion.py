@@ -0,0 +1,104 @@
+"""
+Streaming upload ingestion.
+
+The multipart endpoints receive an UploadFile which Starlette has already spooled entirely, before our handler runs.
+The handler then sniffs the MIME type, copies the spooled file to /media and reads it once more to hash it.
+All of this is blocking I/O, performed on the API threadpool.
+
+Instead, ingest_stream consumes the request body as it arrives, in a single pass:
+- The first bytes are fed to libmagic, so that a wrong file type is rejected before the rest of the body is read.
+- Every chunk updates the content hash, and the running size. An oversized upload is rejected as soon as it crosses the limit.
+- Every chunk is written to storage, asynchronously.
+
+The body is written to a temporary file next to the destination, and renamed once the content hash is known.
+"""
+import os
+import uuid
+import hashlib
+import logging
+from dataclasses import dataclass
+from typing import AsyncIterator, Tuple
+
+import anyio
+
+from services import identify_buffer_type
+
+
+logger = logging.getLogger(__name__)
+
+# Default upload limit is 20 MB.
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+# libmagic only needs the first bytes to identify images and PDFs.
+SNIFF_BYTES = 8192
+
+
+class IngestionError(Exception):
+    """
+    The upload was rejected. `status_code` and `detail` are meant for the HTTP response.
+    """
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+@dataclass
+class IngestedFile:
+    path: str
+    mime_type: str
+    content_hash: str
+    size: int
+
+
+def _check_mime_type(head: bytes, allowed_mime_prefixes: Tuple[str, ...]) -> str:
+    mime_type = identify_buffer_type(head).mime_type
+    if not mime_type.startswith(allowed_mime_prefixes):
+        raise IngestionError(400, f"A {mime_type} file posted.")
+    return mime_type
+
+
+async def ingest_stream(
+    chunks: AsyncIterator[bytes], directory: str, filename: str,
+    allowed_mime_prefixes: Tuple[str, ...], max_bytes: int = MAX_UPLOAD_BYTES
+) -> IngestedFile:
+    """
+    Streams `chunks` to `directory`, while sniffing, hashing and limiting the size in the same pass.
+    The stored file is named <content_hash>-<filename>.
+    Raises IngestionError if the upload is too large or of a type not in `allowed_mime_prefixes`. Nothing is stored in that case.
+    """
+    filename = os.path.basename(filename)
+    temp_path = os.path.join(directory, f".upload-{uuid.uuid4().hex}")
+    hasher = hashlib.sha256()
+    size = 0
+    head = b""
+    mime_type = None
+    try:
+        async with await anyio.open_file(temp_path, "wb") as out_file:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > max_bytes:
+                    raise IngestionError(413, f"Upload exceeds the limit of {max_bytes} bytes.")
+                if mime_type is None:
+                    head += chunk
+                    if len(head) >= SNIFF_BYTES:
+                        mime_type = _check_mime_type(head[:SNIFF_BYTES], allowed_mime_prefixes)
+                        head = b""
+                hasher.update(chunk)
+                await out_file.write(chunk)
+        if size == 0:
+            raise IngestionError(400, "Empty upload.")
+        if mime_type is None:
+            # The whole upload was smaller than SNIFF_BYTES.
+            mime_type = _check_mime_type(head, allowed_mime_prefixes)
+    except BaseException:
+        # Also covers the client disconnecting midway.
+        await anyio.Path(temp_path).unlink(missing_ok=True)
+        raise
+    content_hash = hasher.hexdigest()
+    path = os.path.join(directory, f"{content_hash}-{filename}")
+    await anyio.Path(temp_path).rename(path)
+    logger.info(f"Ingested {size} bytes of {mime_type} to {path}")
+    return IngestedFile(path=path, mime_type=mime_type, content_hash=content_hash, size=size)
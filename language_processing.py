@@ -14,12 +14,96 @@ Later, we want it to perform:
 - Answer basic question
 """
 
+import os
+import hashlib
 import logging
-import spacy
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
 
 logger = logging.getLogger(__name__)
 
-nlp = spacy.load("en_core_web_sm")
+# Pipeline components every function needs, the rest are disabled while parsing for it.
+# en_core_web_sm has tok2vec, tagger, parser, attribute_ruler, lemmatizer and ner.
+# pos_ is set by the tagger and the attribute_ruler. is_punct, is_stop and like_num only need the tokenizer.
+COMPONENTS = {
+    "pos": ["tok2vec", "tagger", "attribute_ruler"],
+    "entities": ["ner"],
+    "tokens": [],
+    "converse": ["tok2vec", "tagger", "attribute_ruler", "parser", "ner"],
+}
+# Parsed Docs are cached by the text's hash, many questions are asked about the same document.
+NLP_DOC_CACHE_SIZE = int(os.environ.get("NLP_DOC_CACHE_SIZE", "128"))
+# Processes used by nlp.pipe. Only worth it for batches having many uncached texts.
+NLP_PROCESSES = int(os.environ.get("NLP_PROCESSES", "1"))
+NLP_MULTIPROCESS_MIN_TEXTS = 16
+NLP_BATCH_SIZE = 32
+
+# Global variable, the model is loaded on first use. See get_nlp.
+# Loading takes seconds, and only /converse needs it.
+nlp = None
+
+
+def get_nlp():
+    """
+    The model is installed as a package in the Docker image, hence loading it doesn't need network access.
+    """
+    global nlp
+    if nlp is None:
+        # Imported here, importing spaCy alone takes a second.
+        import spacy
+        logger.info("Loading spaCy model en_core_web_sm")
+        nlp = spacy.load("en_core_web_sm")
+    return nlp
+
+
+def warm_up():
+    """
+    Loads the model upfront, e.g in the worker pool supervisor, instead of in the first request.
+    """
+    get_nlp()
+
+
+# (text hash, components) -> Doc, least recently used first.
+doc_cache = OrderedDict()
+doc_cache_lock = threading.Lock()
+
+
+def _cache_key(text: str, components: str) -> Tuple[str, str]:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest(), components
+
+
+def parse_many(texts: List[str], components: str = "converse") -> list:
+    """
+    Parses many texts, running only the pipeline components named by `components`, see COMPONENTS.
+    Cached Docs are reused. The rest are parsed in a single nlp.pipe call, in batches and with NLP_PROCESSES processes.
+    Returns the Docs in the order of `texts`.
+    """
+    nlp = get_nlp()
+    keys = [_cache_key(text, components) for text in texts]
+    docs = {}
+    with doc_cache_lock:
+        for key in keys:
+            if key in doc_cache:
+                doc_cache.move_to_end(key)
+                docs[key] = doc_cache[key]
+    # Unique uncached texts, the same text could appear many times in a batch.
+    misses = {key: text for key, text in zip(keys, texts) if key not in docs}
+    if len(misses) > 0:
+        disable = [name for name in nlp.pipe_names if name not in COMPONENTS[components]]
+        n_process = NLP_PROCESSES if len(misses) >= NLP_MULTIPROCESS_MIN_TEXTS else 1
+        parsed = nlp.pipe(misses.values(), disable=disable, batch_size=NLP_BATCH_SIZE, n_process=n_process)
+        with doc_cache_lock:
+            for key, doc in zip(misses.keys(), parsed):
+                docs[key] = doc
+                doc_cache[key] = doc
+            while len(doc_cache) > NLP_DOC_CACHE_SIZE:
+                doc_cache.popitem(last=False)
+    return [docs[key] for key in keys]
+
+
+def parse(text: str, components: str = "converse"):
+    return parse_many([text], components)[0]
 
 
 def parts_of_speech(text: str):
@@ -28,7 +112,7 @@ def parts_of_speech(text: str):
     """
     nouns = []
     verbs = []
-    doc = nlp(text)
+    doc = parse(text, "pos")
     for token in doc:
         if token.pos_ == "PROPN":
             nouns.append(token)
@@ -42,23 +126,23 @@ def parts_of_speech(text: str):
 
 
 def entities(text: str):
-    doc = nlp(text)
+    doc = parse(text, "entities")
     ents = [ent.text for ent in doc.ents]
     return ents
 
 
 def remove_punctuations(text: str):
-    doc = nlp(text)
+    doc = parse(text, "tokens")
     return [token.text for token in doc if not token.is_punct]
 
 
 def remove_stopwords(text: str):
-    doc = nlp(text)
+    doc = parse(text, "tokens")
     return [token.text for token in doc if not token.is_stop]
 
 
 def remove_punctuations_and_stopwords(text: str):
-    doc = nlp(text)
+    doc = parse(text, "tokens")
     tokens = []
     for token in doc:
         if not token.is_stop and not token.is_punct:
@@ -84,6 +168,19 @@ def converse(text: str, question: str):
     - Syntactic Dependencies (dep_)
     - Rule based matching. In addition to regex, use token attributes like is_punct, is_stop etc.
     """
+    return _answer(parse(text, "converse"), question)
+
+
+def converse_many(items: List[Tuple[str, str]]) -> list:
+    """
+    Batch variant of converse. `items` is a list of (text, question).
+    Every distinct text is parsed once, however many questions are asked about it.
+    """
+    docs = parse_many([text for text, _ in items], "converse")
+    return [_answer(doc, question) for doc, (_, question) in zip(docs, items)]
+
+
+def _answer(doc, question: str):
     proper_nouns = []
     verbs = []
     subjects = []
@@ -91,10 +188,12 @@ def converse(text: str, question: str):
     prepositions = []
     numerics = []
     dates = []
-    doc = nlp(text)
     lowered_question = question.lower()
+    # Formatting a line per token is costly on a long document, even if it isn't emitted.
+    debug = logger.isEnabledFor(logging.DEBUG)
     for token in doc:
-        logger.info(f"Token: {token.text}, POS: {token.pos_}, Dep: {token.dep_}")
+        if debug:
+            logger.debug(f"Token: {token.text}, POS: {token.pos_}, Dep: {token.dep_}")
         if token.pos_ == "PROPN":
             proper_nouns.append(token)
         if token.pos_ == "VERB":
@@ -108,14 +207,14 @@ def converse(text: str, question: str):
         if token.like_num:
             numerics.append(token)
     for ent in doc.ents:
-        logger.info(f"Entity: {ent.text}, Type: {ent.label_}")
+        logger.debug(f"Entity: {ent.text}, Type: {ent.label_}")
         if ent.label_ == "DATE":
             dates.append(ent)
-    logger.info(f"Nouns: {proper_nouns}")
-    logger.info(f"Verbs: {verbs}")
-    logger.info(f"Subjects: {subjects}")
-    logger.info(f"Objects: {objects}")
-    logger.info(f"Prepositions: {prepositions}")
+    logger.debug(f"Nouns: {proper_nouns}")
+    logger.debug(f"Verbs: {verbs}")
+    logger.debug(f"Subjects: {subjects}")
+    logger.debug(f"Objects: {objects}")
+    logger.debug(f"Prepositions: {prepositions}")
     if "who" in lowered_question:
         # The answer should probably be a proper noun.
         if len(proper_nouns) == 1:
@@ -124,7 +223,8 @@ def converse(text: str, question: str):
         # Hence dependency parsing can help us get that.
         # We are currently dealing with single sentences.
         # TODO: Modify it to get more context from the question, and then infer the correct subject
-        return subjects[0].text
+        if len(subjects) > 0:
+            return subjects[0].text
     if "where" in lowered_question:
         # It means we want a place as answer
         # The answer should probably be a noun
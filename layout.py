@@ -0,0 +1,177 @@
+"""
+Word level layout of an OCR'd image.
+
+Plain text loses where every word is on the page, and how confident Tesseract is of it.
+The layout keeps both, as blocks of lines of words:
+
+    {
+        "width": 1200, "height": 800, "confidence": 87.5,
+        "blocks": [
+            {"box": [40, 30, 610, 95], "lines": [
+                {"box": [40, 30, 610, 60], "confidence": 91.0, "text": "INCOME TAX DEPARTMENT", "words": [
+                    {"text": "INCOME", "box": [40, 30, 190, 60], "confidence": 93.0},
+                    ...
+                ]},
+            ]},
+        ]
+    }
+
+A box is [left, top, right, bottom], in pixels of the OCR'd image. Confidences are from 0 to 100.
+It's plain dicts and lists, stored as JSON in the `layout` field next to `content`.
+
+Field extraction can then work from spatial neighbourhoods, e.g the value printed under a label, instead of the order of the lines in the text.
+A line recognised with low confidence can be OCR'd again on its own, see services.extract_image_layout.
+
+This module only works on the layout, it doesn't perform OCR.
+"""
+from typing import Iterator, List, Optional
+
+
+# Consecutive words of a value are at most this many word heights apart. Farther words belong to another field.
+WORD_GAP_FACTOR = 1.5
+# A value is at most this many label heights below its label.
+MAX_LINE_GAP_FACTOR = 2.5
+
+
+def _union(boxes: List[list]) -> list:
+    return [
+        min(box[0] for box in boxes),
+        min(box[1] for box in boxes),
+        max(box[2] for box in boxes),
+        max(box[3] for box in boxes),
+    ]
+
+
+def _mean_confidence(items: List[dict]) -> float:
+    if len(items) == 0:
+        return 0.0
+    return round(sum(item["confidence"] for item in items) / len(items), 2)
+
+
+def make_line(words: List[dict]) -> dict:
+    return {
+        "box": _union([word["box"] for word in words]),
+        "confidence": _mean_confidence(words),
+        "text": " ".join(word["text"] for word in words),
+        "words": words,
+    }
+
+
+def build_layout(words: list, width: int, height: int) -> dict:
+    """
+    Groups the words, a list of ocr_engine.OCRWord as returned by image_to_words, into lines and blocks.
+    """
+    blocks = []
+    block_lines = {}
+    line_words = {}
+    for word in words:
+        if word.block not in block_lines:
+            block_lines[word.block] = []
+            blocks.append(word.block)
+        if word.line not in line_words:
+            line_words[word.line] = []
+            block_lines[word.block].append(word.line)
+        word_dict = {"text": word.text, "box": [word.left, word.top, word.right, word.bottom], "confidence": round(word.confidence, 2)}
+        line_words[word.line].append(word_dict)
+    layout = {"width": width, "height": height, "blocks": []}
+    for block in blocks:
+        lines = [make_line(line_words[line]) for line in block_lines[block]]
+        layout["blocks"].append({"box": _union([line["box"] for line in lines]), "lines": lines})
+    layout["confidence"] = _mean_confidence([word for line in iter_lines(layout) for word in line["words"]])
+    return layout
+
+
+def iter_lines(layout: dict) -> Iterator[dict]:
+    for block in layout["blocks"]:
+        yield from block["lines"]
+
+
+def layout_text(layout: dict) -> str:
+    """
+    The text of the layout, a line per line and a blank line between blocks. Same as Tesseract's plain text output.
+    """
+    return "\n\n".join("\n".join(line["text"] for line in block["lines"]) for block in layout["blocks"])
+
+
+def low_confidence_lines(layout: dict, threshold: float, limit: int) -> List[dict]:
+    """
+    The lines recognised with a confidence below `threshold`, the least confident first, at most `limit` of them.
+    """
+    lines = [line for line in iter_lines(layout) if line["confidence"] < threshold]
+    lines.sort(key=lambda line: line["confidence"])
+    return lines[:limit]
+
+
+def replace_line(layout: dict, line: dict, words: List[dict]):
+    """
+    Replaces the words of `line`, e.g with the result of OCR'ing the line again. Updates the layout in place.
+    """
+    line.update(make_line(words))
+    for block in layout["blocks"]:
+        block["box"] = _union([block_line["box"] for block_line in block["lines"]])
+    layout["confidence"] = _mean_confidence([word for layout_line in iter_lines(layout) for word in layout_line["words"]])
+
+
+def phrase_box(line: dict, start: int, end: int) -> list:
+    """
+    Box of the words of `line` spanning the characters from `start` to `end` of the line's text.
+    """
+    boxes = []
+    offset = 0
+    for word in line["words"]:
+        word_end = offset + len(word["text"])
+        if word_end > start and offset < end:
+            boxes.append(word["box"])
+        # Words are joined by a single space.
+        offset = word_end + 1
+    return _union(boxes) if len(boxes) > 0 else line["box"]
+
+
+def _value_words(words: List[dict], first: int) -> List[dict]:
+    value = [words[first]]
+    for word in words[first + 1:]:
+        previous = value[-1]
+        word_height = previous["box"][3] - previous["box"][1]
+        if word["box"][0] - previous["box"][2] > WORD_GAP_FACTOR * word_height:
+            break
+        value.append(word)
+    return value
+
+
+def value_below(layout: dict, box: list) -> Optional[str]:
+    """
+    The value printed under a label whose box is `box`, e.g the name under "Given Name(s)" on a passport.
+    It's the words of the nearest line below, starting at the first word overlapping the label horizontally,
+    and continuing until a gap wider than a few characters. Returns None if no line is close enough below the label.
+    """
+    left, top, right, bottom = box
+    label_height = bottom - top
+    nearest = None
+    for line in iter_lines(layout):
+        line_top = line["box"][1]
+        # Lines could be slightly skewed, allow a small overlap with the label.
+        if line_top < bottom - label_height / 4 or line_top - bottom > MAX_LINE_GAP_FACTOR * label_height:
+            continue
+        for index, word in enumerate(line["words"]):
+            if word["box"][2] > left and word["box"][0] < right:
+                if nearest is None or line_top < nearest[0]:
+                    nearest = (line_top, line["words"], index)
+                break
+    if nearest is None:
+        return None
+    _, words, first = nearest
+    return " ".join(word["text"] for word in _value_words(words, first))
+
+
+def lines_below(layout: dict, box: list) -> List[dict]:
+    """
+    The lines below `box` and overlapping it horizontally, from top to bottom, irrespective of the block they were read in.
+    Lines beside the box, e.g around a photo next to it, are left out.
+    """
+    left, _, right, bottom = box
+    lines = [
+        line for line in iter_lines(layout)
+        if line["box"][1] >= bottom and line["box"][2] > left and line["box"][0] < right
+    ]
+    lines.sort(key=lambda line: line["box"][1])
+    return lines
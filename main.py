@@ -1,21 +1,25 @@
 import os
+import time
+import uuid
 import logging
-import hashlib
 import json
 from typing import List
 
 from fastapi import FastAPI
-from fastapi import UploadFile, Form
+from fastapi import UploadFile, Form, Request
 from fastapi.exceptions import HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 
-from models import ConverseModel
-from services import identify_file_type, merge_pdfs, save_file
-from service_wrappers import extract_image_text_and_set_db, extract_pdf_text_and_set_db
-from textract_wrapper import detect_text_and_set_db
-from language_processing import converse
-from tasks import enqueue_extraction
-from db import set_object, get_object
+from models import ConverseModel, ConverseBatchModel, OCRResultsModel
+from services import identify_file_type, merge_pdfs, save_file, hash_file, result_key
+from language_processing import converse, converse_many
+from tasks import enqueue_extraction, enqueue_analysis, fan_out_extractions, OCR_QUEUE, PDF_QUEUE, TEXTRACT_QUEUE, ANALYSIS_PENDING
+from db import set_object, get_object, get_fields, get_objects, set_objects, get_async_connection, claim_object, claim_objects
+from events import has_events, read_events, restart_events, discard_events, COMPLETED
+from metrics import timed, observe, render_prometheus, pending_metrics, write_metrics
+from ingestion import ingest_stream, IngestionError, MAX_UPLOAD_BYTES
 
 
 app = FastAPI()
@@ -33,6 +37,22 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def batch_metrics(request: Request, call_next):
+    """
+    Buffers the metrics recorded while handling a request, and writes them in a single round trip once it's handled.
+    The endpoints, including the ones run on the threadpool, see the buffer through the context. See metrics.pending_metrics.
+    """
+    commands = []
+    token = pending_metrics.set(commands)
+    try:
+        return await call_next(request)
+    finally:
+        pending_metrics.reset(token)
+        if len(commands) > 0:
+            await run_in_threadpool(write_metrics, commands)
+
+
 @app.get("/")
 def root():
     logger.info("Root invoked")
@@ -64,10 +84,22 @@ def pdfs_merge(attachments: List[UploadFile]):
     return {"status": "processed", "filename": merged_filename}
 
 
+# OCR engines of /ocr. The auto engine runs Tesseract, and escalates the pages it does poorly on to Textract. See ocr_router.
+OCR_ENGINES = ("tesseract", "textract", "auto")
+
+
+def ocr_key(content_hash: str, engine: str, is_image: bool, options: dict) -> str:
+    # Preprocessing options are only applied to images, and Textract is sent the original file.
+    return result_key(content_hash, engine=engine, options=options if is_image and engine != "textract" else None)
+
+
 @app.post("/ocr")
-def ocr(attachment: UploadFile, gray: bool = Form(True), denoise: bool = Form(True), binarize: bool = Form(True)):
+def ocr(
+    attachment: UploadFile, gray: bool = Form(True), denoise: bool = Form(True), binarize: bool = Form(True),
+    engine: str = Form("tesseract"), two_pass: bool = Form(False), adaptive: bool = Form(False)
+):
     """
-    TODO: Support multiple attachments
+    See /ocr-batch for multiple attachments.
     It could pass a PDF or an image.
     A PDF could be searchable or non-searchable.
 
@@ -80,53 +112,178 @@ def ocr(attachment: UploadFile, gray: bool = Form(True), denoise: bool = Form(Tr
 
     In all of the above cases, the processing would happen asynchronously.
     The task would be queued and a link would be returned to the user.
+
+    `engine` is one of tesseract, textract or auto.
+    `two_pass` classifies an image with a quick low resolution pass first, and OCRs it with the profile of its type. See ocr_profiles.
+    It applies to images OCR'd with Tesseract.
+    `adaptive` picks the preprocessing steps from the image's noise, blur, contrast and size. See image_preprocessing.
     """
+    if engine not in OCR_ENGINES:
+        raise HTTPException(status_code=400, detail=f"Engine should be one of {', '.join(OCR_ENGINES)}")
     options = {
         "gray": gray,
         "denoise": denoise,
         "binarize": binarize
     }
-    type_details = identify_file_type(attachment.file)
+    if two_pass is True and engine == "tesseract":
+        # Only added when asked for, so that the keys of the results of the general pass don't change.
+        options["two_pass"] = True
+    if adaptive is True:
+        options["adaptive"] = True
+    with timed("mime_sniff", engine=engine):
+        type_details = identify_file_type(attachment.file)
     if not type_details.mime_type.startswith('image') and not type_details.mime_type.startswith('application/pdf'):
         raise HTTPException(status_code=400, detail="Provide either an image or a PDF")
-    # 1. Save the attachment, for later auditing
-    output_filename = f"/media/ocr-files/{attachment.filename}"
-    save_file(attachment.file, output_filename)
-    attachment.file.seek(0)
-    path_hash = hashlib.sha256(output_filename.encode('utf-8')).hexdigest()
+    # The result is keyed on the file's content, the engine and the preprocessing options.
+    # Preprocessing options are only applied to images, hence they don't participate in the key of a PDF.
+    is_image = type_details.mime_type.startswith('image')
+    doc_type = "image" if is_image else "pdf"
+    with timed("hash", doc_type=doc_type, engine=engine):
+        content_hash = hash_file(attachment.file)
+    path_hash = ocr_key(content_hash, engine, is_image, options)
+    BASE_URL = os.environ.get("BASE_URL", "http://localhost:8000")
+    link = f"{BASE_URL}/ocr-result/{path_hash}"
+    if not claim_object(path_hash, "type", doc_type):
+        # An identical file has already been processed, or is queued or being processed. Nothing to enqueue.
+        logger.info(f"Cache hit for {attachment.filename}, key {path_hash}")
+        return {"link": link}
+    try:
+        # 1. Save the attachment, for later auditing
+        # Prefix with the content hash, so that different files having the same name don't overwrite each other.
+        output_filename = f"/media/ocr-files/{content_hash}-{attachment.filename}"
+        with timed("save_file", doc_type=doc_type, engine=engine):
+            save_file(attachment.file, output_filename)
+        attachment.file.seek(0)
+        enqueue_ocr(output_filename, path_hash, is_image, options, engine)
+    except Exception as exc:
+        fail_claim(path_hash, exc)
+        raise
+    return {"link": link}
+
+
+def fail_claim(key: str, exc: Exception):
+    """
+    Marks a claimed key failed, when its job couldn't be enqueued. The next submission of the file claims it again, see db.claim_object.
+    """
+    logger.error(f"Exception {exc} ocurred while enqueuing the extraction of {key}")
+    set_object(key=key, field="error", value=f"{exc}")
+
+
+def enqueue_ocr(file_path: str, key: str, is_image: bool, options: dict, engine: str = "tesseract"):
+    """
+    Enqueues the extraction of a key claimed with db.claim_object, which has set its type.
+    """
+    # A retried key still has the events of the failed run, which a client would replay.
+    discard_events([key])
+    doc_type = "image" if is_image else "pdf"
+    if engine == "textract":
+        enqueue_extraction(
+            extraction_function="textract_wrapper.detect_text_and_set_db", queue_name=TEXTRACT_QUEUE,
+            file_path=file_path, key=key, doc_type=doc_type
+        )
+    elif engine == "auto":
+        enqueue_extraction(
+            extraction_function="service_wrappers.extract_auto_and_set_db", queue_name=OCR_QUEUE if is_image else PDF_QUEUE,
+            file_path=file_path, key=key, options=options if is_image else None, doc_type=doc_type
+        )
     # Check the content-type, if image, then extract text using Tesseract.
-    if type_details.mime_type.startswith('image'):
+    elif is_image:
         # Attempt extraction through Tesseract
-        set_object(key=path_hash, field="type", value="image")
-        enqueue_extraction(extraction_function=extract_image_text_and_set_db, file_path=output_filename, key=path_hash, options=options)
-    elif type_details.mime_type.startswith('application/pdf'):
+        enqueue_extraction(extraction_function="service_wrappers.extract_image_text_and_set_db", queue_name=OCR_QUEUE, file_path=file_path, key=key, options=options)
+    else:
         # Attempt extracting text using pdfminer.six or else through the image conversion -> OCR pipeline.
-        set_object(key=path_hash, field="type", value="pdf")
-        enqueue_extraction(extraction_function=extract_pdf_text_and_set_db, file_path=output_filename, key=path_hash)
-    # Add it to a queue.
+        enqueue_extraction(extraction_function="service_wrappers.extract_pdf_text_and_set_db", queue_name=PDF_QUEUE, file_path=file_path, key=key)
+
+
+def enqueue_ocr_unless_claimed(file_path: str, key: str, is_image: bool, options: dict, engine: str = "tesseract"):
+    if not claim_object(key, "type", "image" if is_image else "pdf"):
+        logger.info(f"Cache hit for {file_path}, key {key}")
+        return
+    try:
+        enqueue_ocr(file_path, key, is_image, options, engine)
+    except Exception as exc:
+        fail_claim(key, exc)
+        raise
+
+
+@app.post("/ocr-stream")
+async def ocr_stream(
+    request: Request, filename: str = "upload", gray: bool = True, denoise: bool = True, binarize: bool = True, engine: str = "tesseract",
+    two_pass: bool = False, adaptive: bool = False
+):
+    """
+    Streaming variant of /ocr. The image or PDF is posted as the raw request body, instead of multipart/form-data.
+    Options and the filename are passed as query parameters.
+
+        curl -X POST --data-binary @scan.png "http://localhost:8000/ocr-stream?filename=scan.png&denoise=false"
+
+    The body is streamed to storage as it arrives, while the MIME type is sniffed from the first bytes and the content is hashed.
+    A wrong type or an oversized upload is rejected before the rest of the body is read.
+    It doesn't occupy a threadpool slot while the body is being received.
+    """
+    if engine not in OCR_ENGINES:
+        raise HTTPException(status_code=400, detail=f"Engine should be one of {', '.join(OCR_ENGINES)}")
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+        # Rejected without reading the body at all.
+        raise HTTPException(status_code=413, detail=f"Upload exceeds the limit of {MAX_UPLOAD_BYTES} bytes.")
+    options = {
+        "gray": gray,
+        "denoise": denoise,
+        "binarize": binarize
+    }
+    if two_pass is True and engine == "tesseract":
+        options["two_pass"] = True
+    if adaptive is True:
+        options["adaptive"] = True
+    start = time.perf_counter()
+    try:
+        ingested = await ingest_stream(request.stream(), "/media/ocr-files", filename, ("image", "application/pdf"))
+    except IngestionError as exc:
+        raise HTTPException(status_code=exc.status_code, detail=exc.detail)
+    is_image = ingested.mime_type.startswith('image')
+    doc_type = "image" if is_image else "pdf"
+    path_hash = ocr_key(ingested.content_hash, engine, is_image, options)
     BASE_URL = os.environ.get("BASE_URL", "http://localhost:8000")
     link = f"{BASE_URL}/ocr-result/{path_hash}"
+    # Buffered, and written once the request is handled. See batch_metrics.
+    observe("ingest", time.perf_counter() - start, doc_type, engine)
+    # Redis and rq calls are blocking, hence run them on the threadpool.
+    await run_in_threadpool(enqueue_ocr_unless_claimed, ingested.path, path_hash, is_image, options, engine)
     return {"link": link}
 
 
-@app.get("/ocr-result/{key}")
-def ocr_result(key: str):
-    content = get_object(key, "content")
+# Fields of the file's hash, which make up the result.
+RESULT_FIELDS = ["content", "category", "passport_data", "pan_data", "statistics", "page_quality", "routing", "ocr_profile", "preprocessing", "analysis_status"]
+MAX_RESULT_KEYS = 500
+
+
+def build_result(record: dict):
+    content = record["content"]
     if content is None:
         return {"content": content}
     response_data = {}
-    category = get_object(key, "category")
+    category = record["category"]
     if category is not None:
         # Only if category is not None, then include it in the response
         response_data["category"] = category
-        if category == 'passport':
-            passport_data = get_object(key, "passport_data")
-            passport_data = json.loads(passport_data)
-            response_data["passport_data"] = passport_data
-        elif category == 'pan':
-            pan_data = get_object(key, "pan_data")
-            pan_data = json.loads(pan_data)
-            response_data["pan_data"] = pan_data
+        if category == 'passport' and record["passport_data"] is not None:
+            response_data["passport_data"] = json.loads(record["passport_data"])
+        elif category == 'pan' and record["pan_data"] is not None:
+            response_data["pan_data"] = json.loads(record["pan_data"])
+    if record["statistics"] is not None:
+        response_data["statistics"] = json.loads(record["statistics"])
+    if record["page_quality"] is not None:
+        response_data["page_quality"] = json.loads(record["page_quality"])
+    if record["routing"] is not None:
+        response_data["routing"] = json.loads(record["routing"])
+    if record["ocr_profile"] is not None:
+        response_data["ocr_profile"] = record["ocr_profile"]
+    if record["preprocessing"] is not None:
+        response_data["preprocessing"] = json.loads(record["preprocessing"])
+    if record["analysis_status"] is not None:
+        # pending, done or failed. Tells a missing category apart from an analysis yet to run.
+        response_data["analysis_status"] = record["analysis_status"]
     # Remove empty lines
     lines = content.splitlines()
     non_blank_lines = [line for line in lines if line.strip() != '']
@@ -135,23 +292,263 @@ def ocr_result(key: str):
     return response_data
 
 
+@app.get("/ocr-result/{key}")
+def ocr_result(key: str):
+    # The whole record is fetched in a single round trip.
+    record = get_fields(key, RESULT_FIELDS)
+    return build_result(record)
+
+
+@app.get("/ocr-result/{key}/layout")
+def ocr_result_layout(key: str):
+    """
+    Word level layout of an OCR'd image: blocks of lines of words, with their boxes and confidences. See layout.py.
+    Kept out of /ocr-result, as it's many times the size of the content.
+    """
+    page_layout = get_object(key, "layout")
+    if page_layout is None:
+        raise HTTPException(status_code=404, detail="No layout for this key")
+    return json.loads(page_layout)
+
+
+@app.post("/ocr-result/{key}/analyze")
+def ocr_result_analyze(key: str):
+    """
+    Re-runs the classification and structured data extraction of an already extracted text, e.g after the classifier is improved.
+    OCR isn't performed again. Progress is pushed on /ocr-events as usual.
+    """
+    record = get_fields(key, ["type", "content"])
+    if record["content"] is None:
+        raise HTTPException(status_code=404, detail="No extracted content for this key")
+    set_object(key=key, field="analysis_status", value=ANALYSIS_PENDING)
+    # Clients connecting to /ocr-events from now on follow the new run, not the previous run's completed event.
+    restart_events(key, "stage", {"stage": "analysis"})
+    enqueue_analysis(key=key, doc_type=record["type"] or "unknown")
+    BASE_URL = os.environ.get("BASE_URL", "http://localhost:8000")
+    return {"link": f"{BASE_URL}/ocr-result/{key}"}
+
+
+def format_event(event: str, data: str, event_id: str = None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {data}")
+    return "\n".join(lines) + "\n\n"
+
+
+@app.get("/ocr-events/{key}")
+async def ocr_events(key: str, request: Request):
+    """
+    Server-Sent Events, as an alternative to polling /ocr-result.
+    Pushes the stage progress, the text of every page as soon as it's extracted, and finally a `completed` event.
+
+    Event types:
+    - stage: {"stage": "ocr"}. The analysis stage follows the extraction, once the content is available at /ocr-result.
+    - page: {"page": 1, "is_success": true, "content": "..."}. Pages of a PDF could arrive out of order.
+    - completed: {"is_success": true, "category": "pan"}. Sent after the analysis, or right after a failed extraction.
+      The full result, including the category and structured data, is then available at /ocr-result.
+
+    A reconnecting client sends the Last-Event-ID header, and only receives the events after it.
+    """
+    connection = get_async_connection()
+    doc_type, content, error = await connection.hmget(key, ["type", "content", "error"])
+    if doc_type is None and content is None:
+        raise HTTPException(status_code=404, detail="Unknown key")
+    last_event_id = request.headers.get("last-event-id", "0-0")
+
+    async def event_source():
+        if (content is not None or error is not None) and not await has_events(key):
+            # Extracted, or failed, earlier, e.g a cache hit, and the events have expired. No event would ever arrive.
+            yield format_event(COMPLETED, json.dumps({"is_success": content is not None}))
+            return
+        async for item in read_events(key, last_event_id):
+            if item is None:
+                if await request.is_disconnected():
+                    return
+                # SSE comment, keeps proxies from closing an idle connection.
+                yield ": keep-alive\n\n"
+                continue
+            event_id, event, data = item
+            yield format_event(event, data, event_id)
+            if event == COMPLETED:
+                return
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(event_source(), media_type="text/event-stream", headers=headers)
+
+
+@app.post("/ocr-results")
+def ocr_results(body: OCRResultsModel):
+    """
+    Batch lookup of many result links at once. All the records are fetched in a single pipelined round trip.
+    Returns the result of every key, keyed by the key.
+    """
+    if len(body.keys) > MAX_RESULT_KEYS:
+        raise HTTPException(status_code=400, detail=f"A maximum of {MAX_RESULT_KEYS} keys are allowed.")
+    records = get_objects(body.keys, RESULT_FIELDS)
+    return {key: build_result(record) for key, record in records.items()}
+
+
+MAX_BATCH_ATTACHMENTS = 20
+
+
+@app.post("/ocr-batch")
+def ocr_batch(
+    attachments: List[UploadFile], gray: bool = Form(True), denoise: bool = Form(True), binarize: bool = Form(True),
+    two_pass: bool = Form(False), adaptive: bool = Form(False)
+):
+    """
+    Batch variant of /ocr, e.g a customer's passport, PAN and Aadhaar uploaded together.
+    Accepts multiple images or PDFs, and returns a single batch link which gives the progress and the results of all the documents.
+
+    Every attachment is validated before anything is stored. A single invalid attachment rejects the batch.
+    Cache lookups and writes to Redis are pipelined, i.e a single round trip each for the whole batch.
+    A single fan-out job is enqueued, which enqueues the extraction jobs of all the documents.
+    Documents processed earlier, or queued or being processed, aren't processed again.
+    """
+    if len(attachments) > MAX_BATCH_ATTACHMENTS:
+        raise HTTPException(status_code=400, detail=f"A maximum of {MAX_BATCH_ATTACHMENTS} attachments are allowed.")
+    options = {
+        "gray": gray,
+        "denoise": denoise,
+        "binarize": binarize
+    }
+    if two_pass is True:
+        options["two_pass"] = True
+    if adaptive is True:
+        options["adaptive"] = True
+    documents = []
+    for attachment in attachments:
+        with timed("mime_sniff", engine="tesseract"):
+            type_details = identify_file_type(attachment.file)
+        is_image = type_details.mime_type.startswith('image')
+        if not is_image and not type_details.mime_type.startswith('application/pdf'):
+            raise HTTPException(status_code=400, detail=f"{attachment.filename}: Provide either an image or a PDF")
+        doc_type = "image" if is_image else "pdf"
+        with timed("hash", doc_type=doc_type, engine="tesseract"):
+            content_hash = hash_file(attachment.file)
+        key = result_key(content_hash, engine="tesseract", options=options if is_image else None)
+        documents.append({"attachment": attachment, "content_hash": content_hash, "key": key, "type": doc_type})
+    # Documents processed earlier, or queued or being processed, aren't claimed. See db.claim_object.
+    claimed = claim_objects("type", {document["key"]: document["type"] for document in documents})
+    extractions = []
+    enqueued_keys = set()
+    try:
+        for document in documents:
+            if not claimed[document["key"]] or document["key"] in enqueued_keys:
+                # Already claimed, or the same file attached twice in the batch.
+                continue
+            attachment = document["attachment"]
+            output_filename = f"/media/ocr-files/{document['content_hash']}-{attachment.filename}"
+            with timed("save_file", doc_type=document["type"], engine="tesseract"):
+                save_file(attachment.file, output_filename)
+            enqueued_keys.add(document["key"])
+            if document["type"] == "image":
+                kwargs = {"file_path": output_filename, "key": document["key"], "options": options}
+                extractions.append({"function": "service_wrappers.extract_image_text_and_set_db", "kwargs": kwargs, "queue": OCR_QUEUE})
+            else:
+                kwargs = {"file_path": output_filename, "key": document["key"]}
+                extractions.append({"function": "service_wrappers.extract_pdf_text_and_set_db", "kwargs": kwargs, "queue": PDF_QUEUE})
+        if len(extractions) > 0:
+            # A retried key still has the events of the failed run, which a client would replay.
+            discard_events(list(enqueued_keys))
+            enqueue_extraction(extraction_function=fan_out_extractions, extractions=extractions)
+    except Exception as exc:
+        logger.error(f"Exception {exc} ocurred while enqueuing a batch")
+        # Release every claim of the batch, so that the documents can be submitted again.
+        set_objects({key: {"error": f"{exc}"} for key, is_claimed in claimed.items() if is_claimed})
+        raise
+    batch_id = uuid.uuid4().hex
+    batch_documents = [{"filename": document["attachment"].filename, "key": document["key"], "type": document["type"]} for document in documents]
+    set_object(key=f"batch:{batch_id}", field="documents", value=json.dumps(batch_documents))
+    logger.info(f"Batch {batch_id} of {len(documents)} documents, {len(extractions)} enqueued")
+    BASE_URL = os.environ.get("BASE_URL", "http://localhost:8000")
+    return {"batch_id": batch_id, "link": f"{BASE_URL}/ocr-batch/{batch_id}"}
+
+
+@app.get("/ocr-batch/{batch_id}")
+def ocr_batch_result(batch_id: str):
+    """
+    Aggregate progress of a batch, and the result of every document of the batch.
+    A document is completed once its content is extracted, and failed if the extraction failed.
+    """
+    documents = get_object(f"batch:{batch_id}", "documents")
+    if documents is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    documents = json.loads(documents)
+    records = get_objects([document["key"] for document in documents], RESULT_FIELDS + ["error"])
+    BASE_URL = os.environ.get("BASE_URL", "http://localhost:8000")
+    completed = 0
+    failed = 0
+    for document in documents:
+        record = records[document["key"]]
+        if record["content"] is not None:
+            completed += 1
+        elif record["error"] is not None:
+            failed += 1
+            document["error"] = record["error"]
+        document["link"] = f"{BASE_URL}/ocr-result/{document['key']}"
+        document["result"] = build_result(record)
+    total = len(documents)
+    return {
+        "batch_id": batch_id,
+        "status": "completed" if completed + failed == total else "processing",
+        "total": total,
+        "completed": completed,
+        "failed": failed,
+        "pending": total - completed - failed,
+        "documents": documents,
+    }
+
+
 @app.post("/textract-ocr")
 def textract_ocr(attachment: UploadFile):
-    type_details = identify_file_type(attachment.file)
-    if not type_details.mime_type.startswith('image'):
-        raise HTTPException(status_code=400, detail="Provide an image")
-    output_filename = f"/media/textract-ocr-files/{attachment.filename}"
-    save_file(attachment.file, output_filename)
-    attachment.file.seek(0)
-    path_hash = hashlib.sha256(output_filename.encode('utf-8')).hexdigest()
-    set_object(key=path_hash, field="type", value="pdf")
-    # Add it to a queue.
-    enqueue_extraction(extraction_function=detect_text_and_set_db, file_path=output_filename, key=path_hash)
+    """
+    OCR using AWS Textract. Accepts an image, or a PDF whose pages are sent to Textract concurrently.
+    """
+    with timed("mime_sniff", engine="textract"):
+        type_details = identify_file_type(attachment.file)
+    is_image = type_details.mime_type.startswith('image')
+    if not is_image and not type_details.mime_type.startswith('application/pdf'):
+        raise HTTPException(status_code=400, detail="Provide either an image or a PDF")
+    doc_type = "image" if is_image else "pdf"
+    with timed("hash", doc_type=doc_type, engine="textract"):
+        content_hash = hash_file(attachment.file)
+    path_hash = result_key(content_hash, engine="textract")
     BASE_URL = os.environ.get("BASE_URL", "http://localhost:8000")
     link = f"{BASE_URL}/ocr-result/{path_hash}"
+    if not claim_object(path_hash, "type", doc_type):
+        # Avoid a paid Textract call for a file we have already processed, or which is queued or being processed.
+        logger.info(f"Cache hit for {attachment.filename}, key {path_hash}")
+        return {"link": link}
+    try:
+        output_filename = f"/media/textract-ocr-files/{content_hash}-{attachment.filename}"
+        with timed("save_file", doc_type=doc_type, engine="textract"):
+            save_file(attachment.file, output_filename)
+        attachment.file.seek(0)
+        # A retried key still has the events of the failed run, which a client would replay.
+        discard_events([path_hash])
+        # Add it to a queue.
+        enqueue_extraction(
+            extraction_function="textract_wrapper.detect_text_and_set_db", queue_name=TEXTRACT_QUEUE,
+            file_path=output_filename, key=path_hash, doc_type=doc_type
+        )
+    except Exception as exc:
+        fail_claim(path_hash, exc)
+        raise
     return {"link": link}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Stage timings and outcome counters in Prometheus text format.
+    The workers record in Redis as well, hence this includes the worker stages.
+    """
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/converse")
 def conversation(body: ConverseModel):
     """
@@ -165,3 +562,19 @@ def conversation(body: ConverseModel):
     if answer is None:
         answer = "Failed to parse"
     return {"answer": answer}
+
+
+MAX_CONVERSE_ITEMS = 100
+
+
+@app.post("/converse-batch")
+def conversation_batch(body: ConverseBatchModel):
+    """
+    Batch variant of /converse, e.g many questions about the same OCR'd document.
+    Every distinct text is parsed once, and parsed texts are cached for later requests.
+    Returns the answers in the order of the items.
+    """
+    if len(body.items) > MAX_CONVERSE_ITEMS:
+        raise HTTPException(status_code=400, detail=f"A maximum of {MAX_CONVERSE_ITEMS} items are allowed.")
+    answers = converse_many([(item.text, item.question) for item in body.items])
+    return {"answers": [answer if answer is not None else "Failed to parse" for answer in answers]}
@@ -0,0 +1,274 @@
+"""
+Per-stage timing instrumentation.
+
+Every stage of a job, e.g MIME sniffing, saving the file, queue wait, preprocessing, rasterisation, OCR, classification and database writes,
+records its duration in a histogram. Histograms are labelled with the stage, the document type and the engine.
+Successes and failures of every stage are counted as well.
+
+The API process and the rq workers are different processes. Moreover rq forks a work horse for every job, which exits once the job is done.
+In-process counters would thus be lost. Hence the aggregates are kept in Redis, the same database we use for results,
+and any process can render them in Prometheus text format. The API exposes them at /metrics.
+
+Within a job, or an API request, the metrics are buffered and written at the end in a single pipelined round trip to Redis,
+rather than a round trip per stage. See job_timings_recorder, and main.batch_metrics for the API. Outside of them, a stage is written right away.
+A failure to record is logged and never fails the job.
+Recording to Redis can be turned off by setting METRICS_ENABLED to false, e.g while benchmarking.
+
+The stage timings of the current job are also collected, see job_timings_recorder, and stored next to the result.
+Pages OCR'd in a process pool collect their own, and hand them to the job's process, see collected_metrics and merge_metrics.
+"""
+import os
+import time
+import json
+import logging
+import contextvars
+from contextlib import contextmanager
+
+from db import get_connection
+
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "document_processing"
+HISTOGRAM_KEY = "metrics:stage_duration_seconds"
+COUNTER_KEY = "metrics:stage_total"
+ENGINE_USAGE_KEY = "metrics:engine_usage"
+ROUTE_KEY = "metrics:route_total"
+# Upper bounds in seconds. A Tesseract run is in seconds, a large PDF could be in minutes.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+current_job_timings = contextvars.ContextVar("current_job_timings", default=None)
+# Redis commands of the metrics recorded in the current job or request, as (command, *args) tuples. Written by write_metrics.
+pending_metrics = contextvars.ContextVar("pending_metrics", default=None)
+
+
+def _bucket_label(seconds: float) -> str:
+    for bucket in BUCKETS:
+        if seconds <= bucket:
+            return str(bucket)
+    return "+Inf"
+
+
+def _is_enabled() -> bool:
+    return os.environ.get("METRICS_ENABLED", "true").lower() != "false"
+
+
+def _add_timing(timings: dict, stage: str, seconds: float):
+    # A stage could run multiple times in a job, e.g OCR of every page.
+    timings[stage] = round(timings.get(stage, 0) + seconds, 6)
+
+
+def _record(commands: list):
+    """
+    Buffers the commands in the current job or request, else writes them right away.
+    """
+    if not _is_enabled():
+        return
+    pending = pending_metrics.get()
+    if pending is not None:
+        pending.extend(commands)
+        return
+    write_metrics(commands)
+
+
+def write_metrics(commands: list):
+    """
+    Writes the buffered commands in a single pipelined round trip.
+    """
+    if len(commands) == 0:
+        return
+    try:
+        pipeline = get_connection().pipeline(transaction=False)
+        for command, *args in commands:
+            getattr(pipeline, command)(*args)
+        pipeline.execute()
+    except Exception as exc:
+        logger.error(f"Exception {exc} ocurred while recording {len(commands)} metrics")
+
+
+def observe(stage: str, seconds: float, doc_type: str = "unknown", engine: str = "none", outcome: str = "success"):
+    """
+    Records the duration of a stage.
+    Buckets are stored non-cumulative, to need a single increment. They are made cumulative while rendering.
+    """
+    timings = current_job_timings.get()
+    if timings is not None:
+        _add_timing(timings, stage, seconds)
+    labels = f"{stage}|{doc_type}|{engine}"
+    _record([
+        ("hincrby", HISTOGRAM_KEY, f"{labels}|{_bucket_label(seconds)}", 1),
+        ("hincrbyfloat", HISTOGRAM_KEY, f"{labels}|sum", seconds),
+        ("hincrby", HISTOGRAM_KEY, f"{labels}|count", 1),
+        ("hincrby", COUNTER_KEY, f"{labels}|{outcome}", 1),
+    ])
+
+
+class StageTimer:
+    """
+    Yielded by `timed`. A stage which doesn't raise, but reports failure through its return value, should call `fail`.
+    """
+
+    def __init__(self):
+        self.outcome = "success"
+
+    def fail(self):
+        self.outcome = "failure"
+
+
+@contextmanager
+def timed(stage: str, doc_type: str = "unknown", engine: str = "none"):
+    """
+    Usage:
+
+        with timed("preprocess", doc_type="image", engine="tesseract"):
+            img = preprocess_image_array(img, options)
+    """
+    timer = StageTimer()
+    start = time.perf_counter()
+    try:
+        yield timer
+    except Exception:
+        timer.fail()
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start, doc_type, engine, timer.outcome)
+
+
+@contextmanager
+def collected_metrics():
+    """
+    Collects the stage timings and the metrics recorded within the block, without writing them.
+    Yields the (timings, commands), timings being a dict of stage -> seconds. See merge_metrics.
+    """
+    timings = {}
+    commands = []
+    timings_token = current_job_timings.set(timings)
+    metrics_token = pending_metrics.set(commands)
+    try:
+        yield timings, commands
+    finally:
+        pending_metrics.reset(metrics_token)
+        current_job_timings.reset(timings_token)
+
+
+def merge_metrics(timings: dict, commands: list):
+    """
+    Adds the timings and metrics collected elsewhere, e.g by a page OCR'd in a process pool, to the current job's.
+    """
+    current_timings = current_job_timings.get()
+    if current_timings is not None:
+        for stage, seconds in timings.items():
+            _add_timing(current_timings, stage, seconds)
+    _record(commands)
+
+
+@contextmanager
+def job_timings_recorder(key: str = None, field: str = "timings"):
+    """
+    Collects the stage timings recorded within the block, in a dict of stage -> seconds.
+    At the end of the block, the job's metrics are written, along with the timings in `field` of `key` if passed, in a single round trip.
+    Storing the result within the block thus has its db_write in the timings.
+    """
+    with collected_metrics() as (timings, commands):
+        try:
+            yield timings
+        finally:
+            if key is not None:
+                commands.append(("hset", key, field, json.dumps(timings)))
+            write_metrics(commands)
+
+
+def record_queue_wait(doc_type: str = "unknown", engine: str = "none"):
+    """
+    Records how long the current rq job waited in the queue. Does nothing outside an rq job.
+    """
+    # Imported here, as the API process doesn't need rq for anything but enqueuing.
+    from rq import get_current_job
+    job = get_current_job()
+    if job is None or job.enqueued_at is None or job.started_at is None:
+        return
+    seconds = (job.started_at - job.enqueued_at).total_seconds()
+    observe("queue_wait", max(seconds, 0), doc_type, engine)
+
+
+def record_engine_usage(engine: str, doc_type: str, cost: float, pages: int = 1):
+    """
+    Counts the pages sent to an OCR engine, and their cost. Latency is recorded by timing the engine_ocr stage.
+    """
+    _record([
+        ("hincrby", ENGINE_USAGE_KEY, f"{engine}|{doc_type}|pages", pages),
+        ("hincrbyfloat", ENGINE_USAGE_KEY, f"{engine}|{doc_type}|cost", cost),
+    ])
+
+
+def record_route(doc_type: str, score: float, engine: str):
+    """
+    Counts the routing decisions of ocr_router by score, in tenths. Tells how many pages a change of the threshold would escalate.
+    """
+    score_bucket = min(int(score * 10), 9) / 10
+    _record([("hincrby", ROUTE_KEY, f"{doc_type}|{score_bucket}|{engine}", 1)])
+
+
+def _format_labels(stage: str, doc_type: str, engine: str, **extra) -> str:
+    labels = {"stage": stage, "doc_type": doc_type, "engine": engine, **extra}
+    return ",".join(f'{name}="{value}"' for name, value in labels.items())
+
+
+def render_prometheus() -> str:
+    """
+    Renders the aggregated metrics in Prometheus text exposition format.
+    """
+    connection = get_connection()
+    pipeline = connection.pipeline(transaction=False)
+    pipeline.hgetall(HISTOGRAM_KEY)
+    pipeline.hgetall(COUNTER_KEY)
+    pipeline.hgetall(ENGINE_USAGE_KEY)
+    pipeline.hgetall(ROUTE_KEY)
+    histogram_fields, counter_fields, engine_usage_fields, route_fields = pipeline.execute()
+    histograms = {}
+    for field, value in histogram_fields.items():
+        stage, doc_type, engine, suffix = field.decode('utf-8').split("|")
+        histogram = histograms.setdefault((stage, doc_type, engine), {"buckets": {}, "sum": 0.0, "count": 0})
+        if suffix == "sum":
+            histogram["sum"] = float(value)
+        elif suffix == "count":
+            histogram["count"] = int(value)
+        else:
+            histogram["buckets"][suffix] = int(value)
+    lines = [
+        f"# HELP {METRIC_PREFIX}_stage_duration_seconds Duration of a processing stage.",
+        f"# TYPE {METRIC_PREFIX}_stage_duration_seconds histogram",
+    ]
+    for (stage, doc_type, engine), histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bucket in BUCKETS:
+            cumulative += histogram["buckets"].get(str(bucket), 0)
+            labels = _format_labels(stage, doc_type, engine, le=bucket)
+            lines.append(f"{METRIC_PREFIX}_stage_duration_seconds_bucket{{{labels}}} {cumulative}")
+        labels = _format_labels(stage, doc_type, engine, le="+Inf")
+        lines.append(f"{METRIC_PREFIX}_stage_duration_seconds_bucket{{{labels}}} {histogram['count']}")
+        labels = _format_labels(stage, doc_type, engine)
+        lines.append(f"{METRIC_PREFIX}_stage_duration_seconds_sum{{{labels}}} {histogram['sum']}")
+        lines.append(f"{METRIC_PREFIX}_stage_duration_seconds_count{{{labels}}} {histogram['count']}")
+    lines.append(f"# HELP {METRIC_PREFIX}_stage_total Number of processing stages, by outcome.")
+    lines.append(f"# TYPE {METRIC_PREFIX}_stage_total counter")
+    for field, value in sorted(counter_fields.items()):
+        stage, doc_type, engine, outcome = field.decode('utf-8').split("|")
+        labels = _format_labels(stage, doc_type, engine, outcome=outcome)
+        lines.append(f"{METRIC_PREFIX}_stage_total{{{labels}}} {int(value)}")
+    usage = {"pages": [], "cost": []}
+    for field, value in sorted(engine_usage_fields.items()):
+        engine, doc_type, suffix = field.decode('utf-8').split("|")
+        usage[suffix].append(f'{{engine="{engine}",doc_type="{doc_type}"}} {float(value) if suffix == "cost" else int(value)}')
+    lines.append(f"# HELP {METRIC_PREFIX}_engine_pages_total Number of pages sent to an OCR engine.")
+    lines.append(f"# TYPE {METRIC_PREFIX}_engine_pages_total counter")
+    lines.extend(f"{METRIC_PREFIX}_engine_pages_total{sample}" for sample in usage["pages"])
+    lines.append(f"# HELP {METRIC_PREFIX}_engine_cost_total Cost of the pages sent to an OCR engine, in USD.")
+    lines.append(f"# TYPE {METRIC_PREFIX}_engine_cost_total counter")
+    lines.extend(f"{METRIC_PREFIX}_engine_cost_total{sample}" for sample in usage["cost"])
+    lines.append(f"# HELP {METRIC_PREFIX}_route_total Routing decisions of the auto engine, by the score of Tesseract's result.")
+    lines.append(f"# TYPE {METRIC_PREFIX}_route_total counter")
+    for field, value in sorted(route_fields.items()):
+        doc_type, score_bucket, engine = field.decode('utf-8').split("|")
+        lines.append(f'{METRIC_PREFIX}_route_total{{doc_type="{doc_type}",score="{score_bucket}",engine="{engine}"}} {int(value)}')
+    return "\n".join(lines) + "\n"
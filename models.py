@@ -1,6 +1,16 @@
+from typing import List
+
 from pydantic import BaseModel
 
 
 class ConverseModel(BaseModel):
     text: str
-    question: str
\ No newline at end of file
+    question: str
+
+
+class ConverseBatchModel(BaseModel):
+    items: List[ConverseModel]
+
+
+class OCRResultsModel(BaseModel):
+    keys: List[str]
@@ -0,0 +1,294 @@
+"""
+OCR engine layer behind services.extract_image_text.
+
+pytesseract forks a new `tesseract` process for every image, and that process loads the language model every time.
+For a multi-page PDF, that happens once per page.
+
+tesserocr binds to the Tesseract C++ API. An initialised engine can hence be kept resident in the process,
+and reused across pages and jobs. Engines are kept in a per-process pool:
+- An engine is checked out by one caller at a time, hence it is safe to use from multiple threads.
+- Processes forked after the engines are initialised, e.g rq work horses and the parallel page pool, inherit warm engines.
+
+If tesserocr isn't installed, we fall back to pytesseract.
+
+This module only imports Python built-ins or third-party libraries.
+"""
+import os
+import queue
+import shlex
+import logging
+import threading
+from dataclasses import dataclass
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+import pytesseract
+from pytesseract.pytesseract import TesseractError
+
+try:
+    # Needs libtesseract-dev and libleptonica-dev to build.
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+
+logger = logging.getLogger(__name__)
+
+TESSERACT_LANGUAGE = os.environ.get("TESSERACT_LANGUAGE", "eng")
+# Number of resident engines per process. Every engine holds a loaded language model.
+TESSERACT_POOL_SIZE = int(os.environ.get("TESSERACT_POOL_SIZE", "1"))
+
+
+class OCRError(Exception):
+    """
+    Raised when the engine can't read or recognise the image.
+    """
+
+
+@dataclass
+class OCRWord:
+    """
+    A recognised word, and its bounding box in pixels of the recognised image.
+    `block` and `line` number the blocks and lines of the page, in reading order, starting at 1.
+    """
+    text: str
+    left: int
+    top: int
+    right: int
+    bottom: int
+    confidence: float
+    block: int
+    line: int
+
+
+# Global variables, similar to the Redis connection in db.py.
+idle_engines = queue.LifoQueue()
+created_engines = 0
+pool_lock = threading.Lock()
+
+
+def _after_fork_in_child():
+    # Locks held by another thread at the time of fork would never be released in the child.
+    # Hence recreate the synchronisation primitives, while keeping the idle warm engines.
+    global idle_engines, created_engines, pool_lock
+    inherited_engines = list(idle_engines.queue)
+    idle_engines = queue.LifoQueue()
+    for engine in inherited_engines:
+        idle_engines.put(engine)
+    created_engines = len(inherited_engines)
+    pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def is_resident_engine_available() -> bool:
+    return tesserocr is not None
+
+
+def _create_engine():
+    logger.info(f"Initialising a Tesseract engine with language {TESSERACT_LANGUAGE}")
+    return tesserocr.PyTessBaseAPI(lang=TESSERACT_LANGUAGE)
+
+
+def _acquire_engine():
+    global created_engines
+    try:
+        return idle_engines.get_nowait()
+    except queue.Empty:
+        pass
+    with pool_lock:
+        if created_engines < TESSERACT_POOL_SIZE:
+            created_engines += 1
+            should_create = True
+        else:
+            should_create = False
+    if should_create:
+        try:
+            return _create_engine()
+        except Exception:
+            with pool_lock:
+                created_engines -= 1
+            raise
+    # Pool exhausted, wait for an engine to be released.
+    return idle_engines.get()
+
+
+def _release_engine(engine, discard: bool = False):
+    global created_engines
+    if discard:
+        # An engine in an unknown state isn't put back.
+        engine.End()
+        with pool_lock:
+            created_engines -= 1
+        return
+    engine.Clear()
+    idle_engines.put(engine)
+
+
+def warm_up():
+    """
+    Initialises the resident engines upfront, so that the first job doesn't pay for loading the language model.
+    Call it in the worker's parent process, before jobs are forked.
+    """
+    if not is_resident_engine_available():
+        logger.info("tesserocr isn't available, OCR will use pytesseract")
+        return
+    engines = [_acquire_engine() for _ in range(TESSERACT_POOL_SIZE)]
+    for engine in engines:
+        _release_engine(engine)
+
+
+def _to_rgb(image: Union[str, np.ndarray]) -> Union[str, np.ndarray]:
+    # OpenCV arrays are BGR, Tesseract expects RGB. File paths and grayscale arrays are passed as they are.
+    if isinstance(image, np.ndarray) and image.ndim == 3:
+        return image[..., ::-1]
+    return image
+
+
+def _set_image(engine, image: Union[str, np.ndarray]):
+    if isinstance(image, str):
+        engine.SetImageFile(image)
+    elif image.ndim == 2 and image.dtype == np.uint8:
+        # Grayscale or binarised, hand the buffer over without going through PIL.
+        image = np.ascontiguousarray(image)
+        height, width = image.shape
+        engine.SetImageBytes(image.tobytes(), width, height, 1, width)
+    else:
+        engine.SetImage(Image.fromarray(_to_rgb(image)))
+
+
+def image_to_string(image: Union[str, np.ndarray]) -> str:
+    """
+    Expects an image file path, or an image decoded in memory as a NumPy array.
+    Raises OCRError if the image can't be recognised.
+    """
+    if not is_resident_engine_available():
+        try:
+            return pytesseract.image_to_string(_to_rgb(image))
+        except TesseractError as exc:
+            raise OCRError(str(exc)) from exc
+    engine = _acquire_engine()
+    try:
+        _set_image(engine, image)
+        text = engine.GetUTF8Text()
+    except RuntimeError as exc:
+        # tesserocr raises RuntimeError when the image can't be read or recognised.
+        _release_engine(engine)
+        raise OCRError(str(exc)) from exc
+    except Exception:
+        _release_engine(engine, discard=True)
+        raise
+    _release_engine(engine)
+    return text
+
+
+def image_to_string_with_confidence(image: Union[str, np.ndarray]) -> Tuple[str, float]:
+    """
+    Same as image_to_string, and also returns the mean confidence of the recognised words, from 0 to 100.
+    The resident engine computes it from the recognition it has already done.
+    """
+    if not is_resident_engine_available():
+        try:
+            image = _to_rgb(image)
+            text = pytesseract.image_to_string(image)
+            # pytesseract runs tesseract once more, for the word level data.
+            data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT)
+        except TesseractError as exc:
+            raise OCRError(str(exc)) from exc
+        # Non-word elements, e.g blocks and lines, have a confidence of -1.
+        confidences = [float(confidence) for confidence in data["conf"] if float(confidence) >= 0]
+        return text, sum(confidences) / len(confidences) if len(confidences) > 0 else 0.0
+    engine = _acquire_engine()
+    try:
+        _set_image(engine, image)
+        text = engine.GetUTF8Text()
+        confidence = float(engine.MeanTextConf())
+    except RuntimeError as exc:
+        _release_engine(engine)
+        raise OCRError(str(exc)) from exc
+    except Exception:
+        _release_engine(engine, discard=True)
+        raise
+    _release_engine(engine)
+    return text, confidence
+
+
+def _words_from_data(data: dict) -> List[OCRWord]:
+    words = []
+    line_numbers = {}
+    block_numbers = {}
+    for index, text in enumerate(data["text"]):
+        confidence = float(data["conf"][index])
+        # Non-word elements, e.g blocks and lines, have a confidence of -1.
+        if confidence < 0 or text.strip() == "":
+            continue
+        block = block_numbers.setdefault(data["block_num"][index], len(block_numbers) + 1)
+        line_id = (data["block_num"][index], data["par_num"][index], data["line_num"][index])
+        line = line_numbers.setdefault(line_id, len(line_numbers) + 1)
+        left, top = data["left"][index], data["top"][index]
+        words.append(OCRWord(text, left, top, left + data["width"][index], top + data["height"][index], confidence, block, line))
+    return words
+
+
+def _recognize_words(engine, image: Union[str, np.ndarray], psm: Optional[int], whitelist: Optional[str]) -> List[OCRWord]:
+    level = tesserocr.RIL.WORD
+    if psm is not None:
+        engine.SetPageSegMode(psm)
+    if whitelist is not None:
+        engine.SetVariable("tessedit_char_whitelist", whitelist)
+    try:
+        _set_image(engine, image)
+        engine.Recognize()
+        words = []
+        block = 0
+        line = 0
+        for iterator in tesserocr.iterate_level(engine.GetIterator(), level):
+            if iterator.IsAtBeginningOf(tesserocr.RIL.BLOCK):
+                block += 1
+            if iterator.IsAtBeginningOf(tesserocr.RIL.TEXTLINE):
+                line += 1
+            text = iterator.GetUTF8Text(level)
+            box = iterator.BoundingBox(level)
+            if text is None or text.strip() == "" or box is None:
+                continue
+            left, top, right, bottom = box
+            words.append(OCRWord(text, left, top, right, bottom, float(iterator.Confidence(level)), block, line))
+        return words
+    finally:
+        # The engine goes back to the pool, restore the defaults for the next caller.
+        if psm is not None:
+            engine.SetPageSegMode(tesserocr.PSM.AUTO)
+        if whitelist is not None:
+            engine.SetVariable("tessedit_char_whitelist", "")
+
+
+def image_to_words(image: Union[str, np.ndarray], psm: Optional[int] = None, whitelist: Optional[str] = None) -> List[OCRWord]:
+    """
+    Same as image_to_string, but returns the recognised words along with their boxes and confidences, in reading order.
+    `psm` is Tesseract's page segmentation mode, e.g 7 to treat the image as a single line of text. Tesseract's default if None.
+    `whitelist` restricts the characters Tesseract can recognise, e.g to keep stray symbols out of an ID card. It can't contain spaces.
+    """
+    if not is_resident_engine_available():
+        config = f"--psm {psm}" if psm is not None else ""
+        if whitelist is not None:
+            # pytesseract splits the config like a shell does.
+            config += f" -c tessedit_char_whitelist={shlex.quote(whitelist)}"
+        try:
+            data = pytesseract.image_to_data(_to_rgb(image), config=config, output_type=pytesseract.Output.DICT)
+        except TesseractError as exc:
+            raise OCRError(str(exc)) from exc
+        return _words_from_data(data)
+    engine = _acquire_engine()
+    try:
+        words = _recognize_words(engine, image, psm, whitelist)
+    except RuntimeError as exc:
+        _release_engine(engine)
+        raise OCRError(str(exc)) from exc
+    except Exception:
+        _release_engine(engine, discard=True)
+        raise
+    _release_engine(engine)
+    return words
@@ -0,0 +1,85 @@
+"""
+OCR profiles per document type, for the two-pass OCR of images. See services.extract_image_text_two_pass.
+
+The general pass OCRs every image the same way: full resolution, the requested preprocessing and Tesseract's default page segmentation.
+Only afterwards does text_analysis.classify tell whether it was a passport or a PAN card.
+
+In the two-pass mode, a quick pass over a downscaled grayscale copy classifies the image first.
+The full pass then uses the profile of that document type:
+- psm: Tesseract's page segmentation mode. ID cards are sparse text around a photo and emblems, rather than paragraphs.
+- whitelist: The characters printed on the card. Keeps stray symbols, e.g | and ~ read off the photo's edges, out of the text.
+- crop_to_text: Crops the image to the region of the text found by the quick pass, e.g a card photographed on a table.
+- options: The preprocessing options, see image_preprocessing.preprocess_image_array.
+
+An unclassified image has no profile, and goes through the general pass.
+"""
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+
+# Tesseract's page segmentation mode finding as much text as possible, in no particular order.
+PSM_SPARSE_TEXT = 11
+
+LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+DIGITS = "0123456789"
+# Spaces aren't characters for Tesseract, they can't be in a whitelist.
+CARD_PUNCTUATION = "/.,-'():&"
+# The machine readable zone of a passport fills fields with <.
+PASSPORT_PUNCTUATION = CARD_PUNCTUATION + "<"
+
+# Margin around the text found by the quick pass, as a fraction of the image's size.
+ROI_MARGIN = 0.05
+
+
+@dataclass
+class OCRProfile:
+    name: str
+    psm: Optional[int]
+    whitelist: Optional[str]
+    crop_to_text: bool
+    options: dict
+
+
+PROFILES = {
+    "pan": OCRProfile(
+        name="pan",
+        psm=PSM_SPARSE_TEXT,
+        whitelist=LETTERS + DIGITS + CARD_PUNCTUATION,
+        crop_to_text=True,
+        # Printed cards are clean. The bilateral filter is the most expensive step, and binarisation is enough.
+        options={"gray": True, "denoise": False, "binarize": True},
+    ),
+    "passport": OCRProfile(
+        name="passport",
+        psm=PSM_SPARSE_TEXT,
+        whitelist=LETTERS + DIGITS + PASSPORT_PUNCTUATION,
+        crop_to_text=True,
+        # The guilloche pattern behind the fields needs smoothing before binarisation.
+        options={"gray": True, "denoise": True, "binarize": True},
+    ),
+}
+
+
+def get_profile(category: Optional[str]) -> Optional[OCRProfile]:
+    if category is None:
+        return None
+    return PROFILES.get(category)
+
+
+def region_of_interest(words: list, scale: float, width: int, height: int) -> Optional[Tuple[int, int, int, int]]:
+    """
+    The (left, top, right, bottom) region of the text, in pixels of the full resolution image, with a margin.
+    `words` are the ocr_engine.OCRWord of the quick pass, recognised on the image downscaled by `scale`.
+    Returns None if no text was found.
+    """
+    # Single characters are mostly specks and edges read as text.
+    boxes = [(word.left, word.top, word.right, word.bottom) for word in words if len(word.text.strip()) > 1]
+    if len(boxes) == 0:
+        return None
+    margin_x = int(width * ROI_MARGIN)
+    margin_y = int(height * ROI_MARGIN)
+    left = max(int(min(box[0] for box in boxes) / scale) - margin_x, 0)
+    top = max(int(min(box[1] for box in boxes) / scale) - margin_y, 0)
+    right = min(int(max(box[2] for box in boxes) / scale) + margin_x, width)
+    bottom = min(int(max(box[3] for box in boxes) / scale) + margin_y, height)
+    return left, top, right, bottom
@@ -0,0 +1,135 @@
+"""
+Automatic OCR engine selection.
+
+Tesseract runs locally, and costs only compute. Textract is more accurate on low quality, skewed or handwritten images,
+but it is billed per page and adds a network round trip. Most documents OCR fine locally.
+
+Hence the auto engine runs Tesseract first, and scores its result:
+- Whether the text is meaningful at all, and the share of tokens which aren't stray characters. See text_analysis.assess_content.
+- Tesseract's mean word confidence.
+- Whether the classifier recognises the document. Its key phrases then were read well enough.
+Only a page scoring below ROUTER_QUALITY_THRESHOLD is sent to Textract. Pages of a PDF are scored and escalated individually,
+and pages having a usable text layer aren't OCR'd at all.
+
+The pages and cost of every engine, and the routing decisions by score, are recorded in the metrics. See /metrics.
+Tune the threshold from the share of pages scoring below it, against the cost of escalating them.
+"""
+import os
+import time
+import logging
+from typing import Optional, Tuple
+
+from services import extract_image_text_with_confidence, extract_image_layout, render_pdf_page_array, is_audit_enabled
+from image_preprocessing import preprocess_image_file
+from textract import detect_text, detect_pdf_page_text
+from text_analysis import assess_content, classify
+from metrics import timed, observe, record_engine_usage, record_route
+
+
+logger = logging.getLogger(__name__)
+
+# Pages scoring below this, from 0 to 1, are escalated to Textract.
+ROUTER_QUALITY_THRESHOLD = float(os.environ.get("ROUTER_QUALITY_THRESHOLD", "0.6"))
+# Cost per page in USD. Tesseract only costs compute. Textract's DetectDocumentText is billed at $1.50 per 1000 pages.
+ENGINE_COST_PER_PAGE = {
+    "tesseract": float(os.environ.get("TESSERACT_COST_PER_PAGE", "0")),
+    "textract": float(os.environ.get("TEXTRACT_COST_PER_PAGE", "0.0015")),
+}
+# Share of Tesseract's confidence in the score, the rest is the text's quality.
+CONFIDENCE_WEIGHT = 0.5
+
+
+def score_text(text: str, confidence: float) -> float:
+    """
+    Scores Tesseract's result from 0 to 1. `confidence` is Tesseract's mean word confidence, from 0 to 100.
+    """
+    quality = assess_content(text)
+    if not quality.is_meaningful:
+        return 0.0
+    score = CONFIDENCE_WEIGHT * confidence / 100 + (1 - CONFIDENCE_WEIGHT) * quality.score
+    if classify(text) is not None:
+        # The document is recognised, there is no need to pay for Textract.
+        score = max(score, ROUTER_QUALITY_THRESHOLD)
+    return score
+
+
+def _tesseract(image, doc_type: str) -> Tuple[bool, str, float]:
+    with timed("engine_ocr", doc_type=doc_type, engine="tesseract") as timer:
+        is_success, content, confidence = extract_image_text_with_confidence(image)
+        if is_success is False:
+            timer.fail()
+    record_engine_usage("tesseract", doc_type, ENGINE_COST_PER_PAGE["tesseract"])
+    return is_success, content, confidence
+
+
+def route_image(file_path: str, options: dict = None, report: dict = None) -> Tuple[bool, str, dict, Optional[dict]]:
+    """
+    OCRs an image with Tesseract, and escalates it to Textract if the result scores below the threshold.
+    Tesseract's pass is the same as the tesseract engine's, with the word level layout and the re-OCR of low confidence lines.
+    See services.extract_image_layout. The layout's mean word confidence goes into the score.
+    The original image is sent to Textract, not the preprocessed one.
+    Returns (is_success, content, route, layout), where route tells the engine which produced the content, and Tesseract's score.
+    The layout is Tesseract's, hence None if the content is Textract's.
+    `report` is filled with the preprocessing applied, see image_preprocessing.preprocess_image_file.
+    """
+    processed_image = preprocess_image_file(file_path, options, audit=is_audit_enabled(), report=report)
+    if processed_image is None:
+        return False, "An invalid or corrupted image", {"engine": "tesseract", "score": 0.0, "escalated": False}, None
+    with timed("engine_ocr", doc_type="image", engine="tesseract") as timer:
+        is_success, content, page_layout = extract_image_layout(processed_image)
+        if is_success is False:
+            timer.fail()
+    record_engine_usage("tesseract", "image", ENGINE_COST_PER_PAGE["tesseract"])
+    score = score_text(content, page_layout["confidence"]) if is_success is True else 0.0
+    route = {"engine": "tesseract", "score": round(score, 3), "escalated": False}
+    if score >= ROUTER_QUALITY_THRESHOLD:
+        record_route("image", score, "tesseract")
+        return is_success, content, route, page_layout
+    logger.info(f"Tesseract scored {score:.2f} on {file_path}, escalating to Textract")
+    with timed("engine_ocr", doc_type="image", engine="textract") as timer:
+        textract_success, textract_content = detect_text(file_path)
+        if textract_success is False:
+            timer.fail()
+    record_route("image", score, "textract")
+    if textract_success is False:
+        # Keep Tesseract's result, it's better than nothing.
+        logger.warning(f"Textract failed on {file_path}: {textract_content}")
+        return is_success, content, route, page_layout
+    # Only successful requests are billed.
+    record_engine_usage("textract", "image", ENGINE_COST_PER_PAGE["textract"])
+    route["engine"] = "textract"
+    route["escalated"] = True
+    return True, textract_content, route, None
+
+
+def route_pdf_page(file_path: str, page_number: int, options: dict = None) -> Tuple[bool, str]:
+    """
+    Same as route_image, for a page of a PDF. It's a page_function for services.ocr_pdf_pages.
+    The page is sent to Textract as a single-page PDF, as it is in the original PDF.
+    """
+    img = render_pdf_page_array(file_path, page_number, options)
+    if img is None:
+        return False, f"Page {page_number} couldn't be rendered"
+    is_success, content, confidence = _tesseract(img, "pdf")
+    # The pixels aren't needed anymore, don't hold them during the Textract call.
+    del img
+    score = score_text(content, confidence) if is_success is True else 0.0
+    if score >= ROUTER_QUALITY_THRESHOLD:
+        record_route("pdf", score, "tesseract")
+        return is_success, content
+    logger.info(f"Tesseract scored {score:.2f} on page {page_number} of {file_path}, escalating to Textract")
+    start = time.perf_counter()
+    try:
+        textract_content = detect_pdf_page_text(file_path, page_number)
+        outcome = "success"
+    except Exception as exc:
+        logger.warning(f"Textract failed on page {page_number} of {file_path}: {exc}")
+        textract_content = None
+        outcome = "failure"
+    # Timed by hand, as a failure is handled here rather than raised.
+    observe("engine_ocr", time.perf_counter() - start, "pdf", "textract", outcome)
+    record_route("pdf", score, "textract")
+    if textract_content is None:
+        return is_success, content
+    record_engine_usage("textract", "pdf", ENGINE_COST_PER_PAGE["textract"])
+    return True, textract_content
@@ -1,52 +1,188 @@
 import json
 import logging
 
-from services import extract_image_text, extract_pdf_text_all
-from image_preprocessing import preprocess_image_opencv
+from services import extract_image_layout, extract_image_text_two_pass, extract_pdf_text_all, is_audit_enabled
+from image_preprocessing import preprocess_image_file
 
-from db import set_object
-from text_analysis import classify, analyze_passport, analyze_pan
+from db import set_fields, get_fields
+from metrics import timed, job_timings_recorder, record_queue_wait
+from events import publish, COMPLETED
+from text_analysis import classify, analyze_passport, analyze_pan, analyze_stream, ContentQuality
+from tasks import store_extraction, finish_extraction, ANALYSIS_DONE, ANALYSIS_FAILED
+from ocr_router import route_image, route_pdf_page
 
 
 logger = logging.getLogger(__name__)
 
 
 def extract_image_text_and_set_db(file_path: str, key: str, field: str = 'content', options=None):
+    """
+    Passing `two_pass` True in the options classifies the image with a quick pass first, and OCRs it with the profile of its type.
+    See services.extract_image_text_two_pass.
+    """
     if options is None:
         options = {
             "gray": True,
             "denoise": True,
             "binarize": True
         }
-    processed_image_path = preprocess_image_opencv(file_path, options)
-    is_success, content = extract_image_text(processed_image_path)
-    # TODO: Perform text analysis on another queue to not stall this queue
-    if is_success is True:
-        set_object(key, field, content)
-        # Perform classification
-        category = classify(content)
-        logger.info(f"Category: {category}")
-        if category is not None:
-            set_object(key, "category", category)
-            if category == 'passport':
-                passport_data = analyze_passport(content)
-                passport_data = json.dumps(passport_data)
-                set_object(key, "passport_data", passport_data)
-            elif category == 'pan':
-                pan_data = analyze_pan(content)
-                pan_data = json.dumps(pan_data)
-                set_object(key, "pan_data", pan_data)
-        # Extract structured data
-        # Store structured data in DB
-        return True, content
-    else:
-        return False, content
-
-
-def extract_pdf_text_and_set_db(file_path: str, key: str, field: str = 'content'):
-    is_success, content = extract_pdf_text_all(file_path)
-    if is_success is True:
-        set_object(key, field, content)
-        return True, content
-    else:
-        return False, content
+    fields = {}
+    # Filled with the preprocessing steps applied, and the image statistics in the adaptive mode.
+    preprocessing = {}
+    # The timings are stored at the end of the block, along with the job's metrics.
+    with job_timings_recorder(key):
+        record_queue_wait(doc_type="image", engine="tesseract")
+        if options.get("two_pass") is True:
+            publish(key, "stage", {"stage": "ocr"})
+            is_success, content, page_layout, profile_name = extract_image_text_two_pass(
+                file_path, options, audit=is_audit_enabled(), report=preprocessing
+            )
+            if profile_name is not None:
+                fields["ocr_profile"] = profile_name
+        else:
+            publish(key, "stage", {"stage": "preprocess"})
+            # The processed image is handed to OCR in memory. It's written to disk only for auditing.
+            with timed("preprocess", doc_type="image", engine="opencv"):
+                processed_image = preprocess_image_file(file_path, options, audit=is_audit_enabled(), report=preprocessing)
+            if processed_image is None:
+                is_success, content, page_layout = False, "An invalid or corrupted image", None
+            else:
+                publish(key, "stage", {"stage": "ocr"})
+                with timed("ocr", doc_type="image", engine="tesseract") as timer:
+                    is_success, content, page_layout = extract_image_layout(processed_image)
+                    if is_success is False:
+                        timer.fail()
+        publish(key, "page", {"page": 1, "is_success": is_success, "content": content})
+        if len(preprocessing) > 0:
+            fields["preprocessing"] = json.dumps(preprocessing)
+        if is_success is True:
+            fields[field] = content
+            # Words with their boxes and confidences, for the spatial field extraction of the analysis.
+            fields["layout"] = json.dumps(page_layout)
+        else:
+            fields["error"] = content
+        # Store the content and layout in DB, in a single round trip.
+        store_extraction(key, "image", is_success, fields)
+    finish_extraction(key, field, "image", is_success)
+    return is_success, content
+
+
+def extract_pdf_text_and_set_db(file_path: str, key: str, field: str = 'content', options=None):
+    def publish_page(page_number: int, is_success: bool, content: str):
+        publish(key, "page", {"page": page_number, "is_success": is_success, "content": content})
+
+    page_quality = []
+
+    def record_quality(page_number: int, quality: ContentQuality):
+        page_quality.append({"page": page_number, "score": round(quality.score, 3), "is_meaningful": quality.is_meaningful})
+
+    fields = {}
+    with job_timings_recorder(key):
+        record_queue_wait(doc_type="pdf", engine="tesseract")
+        publish(key, "stage", {"stage": "extraction"})
+        is_success, content = extract_pdf_text_all(file_path, options, on_page=publish_page, on_quality=record_quality)
+        if len(page_quality) > 0:
+            # Quality of the embedded text of every page. Pages which aren't meaningful were OCR'd.
+            fields["page_quality"] = json.dumps(page_quality)
+        if is_success is True:
+            fields[field] = content
+        else:
+            fields["error"] = content
+        store_extraction(key, "pdf", is_success, fields)
+    finish_extraction(key, field, "pdf", is_success)
+    return is_success, content
+
+
+def extract_auto_and_set_db(file_path: str, key: str, field: str = 'content', options=None, doc_type: str = "image"):
+    """
+    OCR using the auto engine, Tesseract first and Textract only for the pages Tesseract does poorly on. See ocr_router.
+    """
+    def publish_page(page_number: int, is_success: bool, content: str):
+        publish(key, "page", {"page": page_number, "is_success": is_success, "content": content})
+
+    fields = {}
+    # Filled with the preprocessing steps applied to an image, see extract_image_text_and_set_db.
+    preprocessing = {}
+    with job_timings_recorder(key):
+        record_queue_wait(doc_type=doc_type, engine="auto")
+        publish(key, "stage", {"stage": "ocr"})
+        if doc_type == "image":
+            is_success, content, route, page_layout = route_image(file_path, options, report=preprocessing)
+            publish_page(1, is_success, content)
+            fields["routing"] = json.dumps(route)
+            if page_layout is not None and is_success is True:
+                # Kept by Tesseract, the analysis can locate the fields spatially.
+                fields["layout"] = json.dumps(page_layout)
+        else:
+            is_success, content = extract_pdf_text_all(file_path, options, on_page=publish_page, page_function=route_pdf_page)
+        if len(preprocessing) > 0:
+            fields["preprocessing"] = json.dumps(preprocessing)
+        if is_success is True:
+            fields[field] = content
+        else:
+            fields["error"] = content
+        store_extraction(key, doc_type, is_success, fields)
+    finish_extraction(key, field, doc_type, is_success)
+    return is_success, content
+
+
+# Fields written by the analysis. A re-run removes the ones it doesn't produce, e.g the category if it no longer classifies.
+ANALYSIS_FIELDS = ["category", "passport_data", "pan_data", "statistics", "analysis_error", "analysis_timings", "analysis_status"]
+# The text is fed to the statistics in chunks of this many characters, to bound the memory of tokenising a long PDF's text.
+STATISTICS_CHUNK_SIZE = 1024 * 1024
+
+
+def analyze_text_and_set_db(key: str, field: str = 'content', doc_type: str = "unknown"):
+    """
+    Classifies the extracted text stored in `field` of `key`, and extracts the structured data of the category.
+    Also computes the word statistics of the text, see text_analysis.TextStatistics.
+    Runs on its own queue, so that fuzzy matching doesn't stall the OCR workers.
+    It only needs the stored text, hence it can be re-run, e.g after the classifier is improved, without performing OCR again.
+    """
+    with job_timings_recorder(key, field="analysis_timings"):
+        record_queue_wait(doc_type=doc_type, engine="text_analysis")
+        record = get_fields(key, [field, "layout"])
+        content = record[field]
+        if content is None:
+            logger.warning(f"No {field} to analyse for {key}")
+            publish(key, COMPLETED, {"is_success": False})
+            return None
+        publish(key, "stage", {"stage": "classification"})
+        fields = {}
+        try:
+            with timed("classification", doc_type=doc_type, engine="text_analysis"):
+                category = classify(content)
+                logger.info(f"Category: {category}")
+                # Extract structured data
+                structured_data = None
+                # Only OCR'd images have a layout. Fields are then located spatially, else from the order of the lines.
+                page_layout = json.loads(record["layout"]) if record["layout"] is not None else None
+                if category == 'passport':
+                    structured_data = analyze_passport(content, page_layout)
+                elif category == 'pan':
+                    structured_data = analyze_pan(content, page_layout)
+            if category is not None:
+                fields["category"] = category
+                if structured_data is not None:
+                    fields[f"{category}_data"] = json.dumps(structured_data)
+        except Exception as exc:
+            # The extracted content is still valid, only the analysis failed.
+            logger.error(f"Exception {exc} ocurred while analysing {key}")
+            category = None
+            fields["analysis_error"] = f"{exc}"
+        # The statistics don't depend on the category. Their failure keeps the category, which is published as stored.
+        try:
+            with timed("statistics", doc_type=doc_type, engine="text_analysis"):
+                chunks = (content[index:index + STATISTICS_CHUNK_SIZE] for index in range(0, len(content), STATISTICS_CHUNK_SIZE))
+                fields["statistics"] = json.dumps(analyze_stream(chunks))
+        except Exception as exc:
+            logger.error(f"Exception {exc} ocurred while computing the statistics of {key}")
+            fields["analysis_error"] = f"{exc}"
+        fields["analysis_status"] = ANALYSIS_FAILED if "analysis_error" in fields else ANALYSIS_DONE
+        # The analysis_timings are stored at the end of the block, along with the job's metrics.
+        remove_fields = [name for name in ANALYSIS_FIELDS if name not in fields and name != "analysis_timings"]
+        with timed("db_write", doc_type=doc_type, engine="redis"):
+            set_fields(key, fields, remove_fields=remove_fields)
+    # The content was extracted successfully, irrespective of the analysis.
+    publish(key, COMPLETED, {"is_success": True, "category": category})
+    return category
@@ -4,33 +4,47 @@ This module is supposed to only import Python built-ins or third-party libraries
 It can import application module only if that module too adherese to the above policy.
 """
 
+import io
 import os
-import glob
+import json
+import hashlib
 import logging
-from typing import List, BinaryIO
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, BinaryIO, Tuple, Union, Callable, Optional, Iterator
+
+import numpy as np
+import cv2 as cv
 
 # File mime-type detection
 import magic
 from magic.compat import FileMagic
 
 # PDF manipulation
-from pikepdf import Pdf
+from pikepdf import Pdf, Name, String, parse_content_stream
 
 # PDF text extraction
 from pdfminer.high_level import extract_text
 from pdfminer.pdfparser import PDFSyntaxError
+from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+from pdfminer.converter import TextConverter
+from pdfminer.layout import LAParams
+from pdfminer.pdfpage import PDFPage
 
-# Image text extraction
-# OCR can only happen on images, OCR doesn't work with PDF
-import pytesseract
-from pytesseract.pytesseract import TesseractError
 
 # Convert non-searchable PDFs to images before performing OCR
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 
 from fastapi import UploadFile
 
-from text_analysis import is_meaningful_content
+# Image text extraction
+# OCR can only happen on images, OCR doesn't work with PDF
+from ocr_engine import image_to_string, image_to_string_with_confidence, image_to_words, OCRError
+from layout import build_layout, layout_text, low_confidence_lines, replace_line
+
+from text_analysis import assess_content, classify, ContentQuality
+from ocr_profiles import get_profile, region_of_interest
+from image_preprocessing import preprocess_image_array, read_dpi
+from metrics import timed, collected_metrics, merge_metrics
 
 
 logger = logging.getLogger(__name__)
@@ -56,6 +70,15 @@ def identify_file_type(file_object_or_stream: BinaryIO) -> FileMagic:
     return result
 
 
+def identify_buffer_type(buffer: bytes) -> FileMagic:
+    """
+    Identifies the MIME type from the first bytes of a file, e.g while the file is still being streamed.
+    The magic numbers are at the beginning of the file, hence the first few KB suffice.
+    """
+    result = magic.detect_from_content(buffer)
+    return result
+
+
 def merge_pdfs(attachments: List[UploadFile]) -> str:
     """
     Merges multiple PDFs using pikepdf.
@@ -102,6 +125,37 @@ def save_file(file: BinaryIO, path: str):
     logger.info(f"Saved file to {path}")
 
 
+def hash_file(file: BinaryIO) -> str:
+    """
+    Computes the sha256 of a file's bytes. Reads in chunks, so that a large upload isn't loaded in memory at once.
+    The file pointer is reset to the beginning before and after hashing.
+    """
+    chunk_size = 1024 * 1024   # 1 MB
+    hasher = hashlib.sha256()
+    file.seek(0)
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        hasher.update(chunk)
+    file.seek(0)
+    return hasher.hexdigest()
+
+
+def result_key(content_hash: str, engine: str, options: dict = None) -> str:
+    """
+    The key under which the extraction result is stored.
+
+    It is derived from the file's content rather than the file's path. Hence the same file uploaded twice,
+    even under different names, maps to the same result. And two different files having the same name don't overwrite each other's result.
+    The engine and the preprocessing options are part of the key, as they change the extracted text.
+    """
+    options = options or {}
+    serialized_options = json.dumps(options, sort_keys=True)
+    key = f"{engine}:{content_hash}:{serialized_options}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
 def extract_pdf_text_searchable(file: BinaryIO):
     """
     :param: A file like object, opened in binary mode.
@@ -117,50 +171,351 @@ def extract_pdf_text_searchable(file: BinaryIO):
         return False, "An invalid or corrupted PDF"
 
 
-def extract_pdf_text_non_searchable(file_path: str):
+def get_pdf_ocr_workers() -> int:
+    """
+    Number of processes used to OCR the pages of a non-searchable PDF.
+    Configurable through PDF_OCR_WORKERS. Defaults to the number of cores, capped at 4.
+    Setting it to 1 disables the parallel mode.
+    """
+    workers = os.environ.get("PDF_OCR_WORKERS")
+    if workers is None:
+        return min(4, os.cpu_count() or 1)
+    return max(1, int(workers))
+
+
+def is_audit_enabled() -> bool:
+    """
+    Intermediate images, e.g rendered PDF pages and preprocessed images, are only written to /media when AUDIT_INTERMEDIATE_FILES is set.
+    Otherwise they only live in memory.
+    """
+    return os.environ.get("AUDIT_INTERMEDIATE_FILES", "false").lower() in ("1", "true", "yes")
+
+
+def get_pdf_page_count(file_path: str) -> int:
+    info = pdfinfo_from_path(file_path)
+    return info["Pages"]
+
+
+def render_pdf_page_array(file_path: str, page_number: int, options: dict = None) -> Optional[np.ndarray]:
+    """
+    Renders a single PDF page in memory, as a grayscale array ready for OCR. `page_number` is 1-based.
+    Returns None if the page couldn't be rendered.
+
+    Nothing is written to disk, unless auditing is enabled. The page is rendered in grayscale, as OCR works in grayscale anyways.
+    Preprocessing is applied only if `options` are passed.
+    """
+    # Without an output_folder, pdf2image reads the rendered page from poppler's stdout.
+    with timed("rasterise", doc_type="pdf", engine="poppler"):
+        images = convert_from_path(file_path, first_page=page_number, last_page=page_number, grayscale=True)
+    if len(images) == 0:
+        return None
+    page_image = images[0]
+    if is_audit_enabled():
+        basename = os.path.basename(file_path)       # File name -> sample.pdf
+        if '.pdf' in basename:
+            basename = basename.replace('.pdf', '')
+        page_image.save(f"/media/pdf-to-image/{basename}-page-{page_number}.png")
+    img = np.asarray(page_image)
+    if options is not None:
+        with timed("preprocess", doc_type="pdf", engine="opencv"):
+            img = preprocess_image_array(img, options, source="pdf")
+    return img
+
+
+def ocr_pdf_page(file_path: str, page_number: int, options: dict = None) -> Tuple[bool, str]:
+    """
+    Renders a single PDF page in memory, and hands the pixels straight to preprocessing and OCR.
+    Only one page is held in memory at a time, the buffer is dropped once the text is extracted.
+    """
+    img = render_pdf_page_array(file_path, page_number, options)
+    if img is None:
+        return False, f"Page {page_number} couldn't be rendered"
+    with timed("ocr", doc_type="pdf", engine="tesseract") as timer:
+        is_success, content = extract_image_text(img)
+        if is_success is False:
+            timer.fail()
+    return is_success, content
+
+
+# Called with (page_number, is_success, content) as soon as a page is extracted.
+PageCallback = Optional[Callable[[int, bool, str], None]]
+# Called with (page_number, quality) as soon as the embedded text of a page is assessed.
+QualityCallback = Optional[Callable[[int, ContentQuality], None]]
+# Extracts the text of a page which needs OCR. Called as page_function(file_path, page_number, options), returns (is_success, content).
+# Has to be a module level function, as it's called in the page pool's processes.
+PageFunction = Callable[[str, int, Optional[dict]], Tuple[bool, str]]
+
+
+def ocr_pdf_pages(
+    file_path: str, page_numbers: List[int] = None, workers: int = None, options: dict = None, on_page: PageCallback = None,
+    page_function: PageFunction = ocr_pdf_page
+) -> List[Tuple[int, bool, str]]:
+    """
+    Performs OCR on the pages of a PDF, and returns a (page_number, is_success, content) tuple for every page, in page order.
+    Only the pages in `page_numbers` are OCR'd, when passed.
+    `on_page` is called for every page as soon as it is done. In the parallel mode, pages could complete out of order.
+    Every page is OCR'd by `page_function`, Tesseract by default. See ocr_router for an alternative.
+
+    Tesseract is CPU bound and runs one page on one core. With workers > 1, the pages are spread over a bounded process pool.
+    Every process renders its own page, hence only the page number crosses the process boundary and not the pixels.
+    A page failing, even with an unexpected exception, doesn't fail the other pages.
+    """
+    if workers is None:
+        workers = get_pdf_ocr_workers()
+    if page_numbers is None:
+        page_numbers = list(range(1, get_pdf_page_count(file_path) + 1))
+    workers = min(workers, len(page_numbers))
+    with timed("ocr_pages", doc_type="pdf", engine="tesseract"):
+        results = _ocr_pdf_pages(file_path, page_numbers, workers, options, on_page, page_function)
+    failed_pages = [page_number for page_number, is_success, _ in results if is_success is False]
+    if len(failed_pages) > 0:
+        logger.warning(f"Failed to extract text from pages {failed_pages} of {file_path}")
+    return results
+
+
+def _collect_page(page_function: PageFunction, file_path: str, page_number: int, options: dict) -> Tuple[bool, str, dict, list]:
+    """
+    Runs page_function in a process of the page pool. The page's timings and metrics are returned along with its text,
+    as the process doesn't see the job's. They are merged into the job's by _ocr_pdf_pages.
+    """
+    with collected_metrics() as (timings, commands):
+        is_success, content = page_function(file_path, page_number, options)
+    return is_success, content, timings, commands
+
+
+def _ocr_pdf_pages(
+    file_path: str, page_numbers: List[int], workers: int, options: dict, on_page: PageCallback, page_function: PageFunction
+) -> List[Tuple[int, bool, str]]:
+    results = []
+    if workers <= 1:
+        for page_number in page_numbers:
+            try:
+                is_success, content = page_function(file_path, page_number, options)
+            except Exception as exc:
+                logger.error(f"Exception {exc} ocurred during OCR of page {page_number} of {file_path}")
+                is_success, content = False, str(exc)
+            results.append((page_number, is_success, content))
+            if on_page is not None:
+                on_page(page_number, is_success, content)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_collect_page, page_function, file_path, page_number, options): page_number for page_number in page_numbers
+            }
+            for future in as_completed(futures):
+                page_number = futures[future]
+                try:
+                    is_success, content, timings, commands = future.result()
+                    merge_metrics(timings, commands)
+                except Exception as exc:
+                    logger.error(f"Exception {exc} ocurred during OCR of page {page_number} of {file_path}")
+                    is_success, content = False, str(exc)
+                results.append((page_number, is_success, content))
+                if on_page is not None:
+                    on_page(page_number, is_success, content)
+        # Pages complete in any order, restore the page order.
+        results.sort(key=lambda result: result[0])
+    return results
+
+
+def extract_pdf_text_non_searchable(
+    file_path: str, workers: int = None, options: dict = None, on_page: PageCallback = None, page_function: PageFunction = ocr_pdf_page
+):
     """
     :param: A PDF file path.
     Extracts text from non searchable PDFs i.e scanned PDFs that don't have embedded text.
-    Converts a PDF to an image and then extracts text from it. Delegates to extract_image_text which
+    Converts every PDF page to an in-memory image and then extracts text from it. Delegates to extract_image_text which
     performs OCR using Pytesseract.
+
+    Pages are OCR'd in parallel across `workers` processes, see get_pdf_ocr_workers.
+    Pages that fail are skipped, and reported in the logs.
     """
-    output_folder = "/media/pdf-to-image"   # Directory name -> /media/pdf-to-image
-    basename = os.path.basename(file_path)       # File name -> sample.pdf
-    if '.pdf' in basename:
-        basename = basename.replace('.pdf', '')
-    convert_from_path(file_path, output_folder=output_folder, fmt="png", output_file=basename)
-    # The converted images have been saved now.
-    converted_images_paths = sorted(glob.glob(f"{output_folder}/{basename}*.png"))
-    is_successes = []
-    contents = []
-    for converted_image_path in converted_images_paths:
-        is_success, content = extract_image_text(converted_image_path)
-        is_successes.append(is_success)
-        if is_success is True:
-            # Only concatenate the contents from pages that we were able to extract.
-            contents.append(content)
-        else:
-            logger.info(f"Failed to extract text from {converted_image_path}")
+    results = ocr_pdf_pages(file_path, workers=workers, options=options, on_page=on_page, page_function=page_function)
+    is_successes = [is_success for _, is_success, _ in results]
+    # Only concatenate the contents from pages that we were able to extract.
+    contents = [content for _, is_success, content in results if is_success is True]
     return any(is_successes), "\n".join(contents)
 
 
-def extract_pdf_text_all(file_path: str):
+# Kinds of pages, as told by probe_pdf_pages.
+PAGE_TEXT = "text"
+PAGE_IMAGE = "image"
+PAGE_MIXED = "mixed"
+PAGE_EMPTY = "empty"
+# Operators which show text, and which draw an XObject, e.g an image.
+PROBE_OPERATORS = "Tj TJ ' \" Do"
+# Form XObjects could be nested, e.g a form drawing a form drawing an image.
+PROBE_MAX_DEPTH = 5
+
+
+def _inherited_resources(page_object):
+    # A page without its own /Resources inherits them from its ancestors in the page tree.
+    node = page_object
+    while node is not None:
+        if "/Resources" in node:
+            return node.Resources
+        node = node.get("/Parent")
+    return None
+
+
+def _probe_content(content, resources, seen: set, depth: int = 0) -> Tuple[int, int]:
+    """
+    Returns the number of text bytes shown, and the number of images drawn, by a page's or a Form XObject's content stream.
+    Text shown without any font in the resources can't be extracted, and isn't counted.
+    """
+    text_bytes = 0
+    images = 0
+    fonts = resources.get("/Font") if resources is not None else None
+    xobjects = resources.get("/XObject") if resources is not None else None
+    for operands, operator in parse_content_stream(content, PROBE_OPERATORS):
+        operator = str(operator)
+        if operator in ("Tj", "'", '"'):
+            if fonts is not None and len(operands) > 0:
+                text_bytes += len(bytes(operands[-1]))
+        elif operator == "TJ":
+            if fonts is not None and len(operands) > 0:
+                text_bytes += sum(len(bytes(item)) for item in operands[0] if isinstance(item, String))
+        elif operator == "Do":
+            xobject = xobjects.get(operands[0]) if xobjects is not None else None
+            if xobject is None:
+                continue
+            subtype = xobject.get("/Subtype")
+            if subtype == Name.Image:
+                images += 1
+            elif subtype == Name.Form and depth < PROBE_MAX_DEPTH and xobject.objgen not in seen:
+                seen.add(xobject.objgen)
+                form_text_bytes, form_images = _probe_content(xobject, xobject.get("/Resources", resources), seen, depth + 1)
+                text_bytes += form_text_bytes
+                images += form_images
+    return text_bytes, images
+
+
+def probe_pdf_pages(file_path: str) -> List[str]:
+    """
+    Tells, for every page, whether it has a text layer, only images, both, or neither. See PAGE_TEXT etc.
+    Only the content streams are tokenised, by qpdf. No layout analysis and no rendering, hence it takes milliseconds per page.
+
+    - text: Shows text. pdfminer.six can extract it.
+    - image: Only draws images, e.g a scanned page. Needs OCR.
+    - mixed: Both, e.g a scan having an invisible OCR text layer, or a typed page with a logo. pdfminer.six has to be tried.
+    - empty: Neither. Could still be drawn with vector paths, e.g text converted to outlines, hence treated like an image.
+      Inline images, which are rare, are reported as empty.
+    Raises pikepdf.PdfError for a PDF qpdf can't read, or a content stream it can't parse.
+    """
+    kinds = []
+    with Pdf.open(file_path) as pdf:
+        for page in pdf.pages:
+            text_bytes = 0
+            images = 0
+            resources = _inherited_resources(page.obj)
+            if "/Contents" in page.obj:
+                text_bytes, images = _probe_content(page.obj, resources, set())
+            if text_bytes > 0 and images > 0:
+                kinds.append(PAGE_MIXED)
+            elif text_bytes > 0:
+                kinds.append(PAGE_TEXT)
+            elif images > 0:
+                kinds.append(PAGE_IMAGE)
+            else:
+                kinds.append(PAGE_EMPTY)
+    return kinds
+
+
+def iter_pdf_text_pages(file: BinaryIO, page_numbers: List[int] = None) -> Iterator[Tuple[int, str]]:
+    """
+    Yields the page number and the embedded text of every page, as pdfminer.six extracts it, without the \x0c page end marker.
+    Same as extract_text, except a page's text is available as soon as the page is processed, instead of after the whole PDF.
+    Only the pages in `page_numbers` are processed, when passed. The layout analysis of the rest is skipped.
+    Raises PDFSyntaxError for an invalid PDF.
+    """
+    wanted_pages = set(page_numbers) if page_numbers is not None else None
+    resource_manager = PDFResourceManager(caching=True)
+    output = io.StringIO()
+    converter = TextConverter(resource_manager, output, codec="utf-8", laparams=LAParams())
+    interpreter = PDFPageInterpreter(resource_manager, converter)
+    try:
+        for page_number, page in enumerate(PDFPage.get_pages(file, caching=True), start=1):
+            if wanted_pages is not None and page_number not in wanted_pages:
+                continue
+            interpreter.process_page(page)
+            text = output.getvalue()
+            output.seek(0)
+            output.truncate()
+            # pdfminer.six ends every page with a \x0c page end marker.
+            yield page_number, text[:-1] if text.endswith("\x0c") else text
+    finally:
+        converter.close()
+
+
+def extract_pdf_text_all(
+    file_path: str, options: dict = None, on_page: PageCallback = None, on_quality: QualityCallback = None,
+    page_function: PageFunction = ocr_pdf_page
+):
     """
     Attempts extraction for both searchable and non-searchable PDFs.
 
     1. For searchable_pdfs, delegate to extract_pdf_text which uses pdfminer.six
     2. For non-searchable PDFs, convert to an image and then extract text
+
+    The decision is made per page. A PDF could be a mix of both, e.g a typed cover letter followed by scanned attachments.
+    The pages are first probed, see probe_pdf_pages. Pages having only images go straight to OCR, without pdfminer.six's layout analysis.
+    The rest are extracted by pdfminer.six, and assessed as soon as they're extracted, on a sample of their text, see text_analysis.assess_content.
+    The embedded text is kept for pages having meaningful text, and only the remaining pages are converted and OCR'd.
+
+    `on_page` is called for every page as soon as its text is available, see ocr_pdf_pages.
+    `on_quality` is called with the quality score of every page's embedded text.
+    `page_function` OCRs the pages which need OCR, see ocr_pdf_pages.
     """
-    f = open(file_path, "rb")
-    is_success, content = extract_pdf_text_searchable(f)
-    f.close()
-    if is_success is False:
-        # It's not even a PDF probably
-        return False, content
-    if is_meaningful_content(content):
-        return True, content
-    is_success, content = extract_pdf_text_non_searchable(file_path)
-    return is_success, content
+    try:
+        with timed("pdf_probe", doc_type="pdf", engine="pikepdf"):
+            kinds = probe_pdf_pages(file_path)
+        text_page_numbers = [page_number for page_number, kind in enumerate(kinds, start=1) if kind in (PAGE_TEXT, PAGE_MIXED)]
+        logger.info(f"Probed {file_path}: {len(text_page_numbers)} of {len(kinds)} pages have a text layer")
+    except Exception as exc:
+        # Probing is only an optimisation. Leave it to pdfminer.six, which also tells whether it's a PDF at all.
+        logger.warning(f"Exception {exc} ocurred while probing {file_path}")
+        kinds = None
+        text_page_numbers = None
+    if kinds is not None and len(text_page_numbers) == 0:
+        # e.g a scanned PDF. Nothing for pdfminer.six to extract.
+        return extract_pdf_text_non_searchable(file_path, options=options, on_page=on_page, page_function=page_function)
+    page_contents = {}
+    scanned_page_numbers = []
+    if kinds is not None:
+        text_pages = set(text_page_numbers)
+        scanned_page_numbers = [page_number for page_number in range(1, len(kinds) + 1) if page_number not in text_pages]
+    with open(file_path, "rb") as f, timed("pdfminer", doc_type="pdf", engine="pdfminer") as timer:
+        try:
+            for page_number, page in iter_pdf_text_pages(f, text_page_numbers):
+                page_contents[page_number] = page
+                quality = assess_content(page)
+                if on_quality is not None:
+                    on_quality(page_number, quality)
+                if not quality.is_meaningful:
+                    scanned_page_numbers.append(page_number)
+                elif on_page is not None:
+                    # The pages having embedded text are available right away.
+                    on_page(page_number, True, page)
+        except PDFSyntaxError:
+            timer.fail()
+            # It's not even a PDF probably
+            return False, "An invalid or corrupted PDF"
+    page_count = len(kinds) if kinds is not None else len(page_contents)
+    if len(scanned_page_numbers) == page_count:
+        is_success, content = extract_pdf_text_non_searchable(file_path, options=options, on_page=on_page, page_function=page_function)
+        return is_success, content
+    if len(scanned_page_numbers) == 0:
+        # Same as the output of extract_text
+        return True, "".join(f"{page_contents[page_number]}\x0c" for page_number in sorted(page_contents))
+    scanned_page_numbers.sort()
+    logger.info(f"OCR needed for pages {scanned_page_numbers} of {page_count} in {file_path}")
+    for page_number, is_success, page_content in ocr_pdf_pages(
+        file_path, page_numbers=scanned_page_numbers, options=options, on_page=on_page, page_function=page_function
+    ):
+        # A page which failed OCR is skipped, as in the non-searchable case.
+        page_contents[page_number] = page_content if is_success is True else ''
+    content = "\n".join(page_contents[page_number] for page_number in sorted(page_contents))
+    return True, content
 
 
 def get_file_size(file):
@@ -170,13 +525,157 @@ def get_file_size(file):
     return size
 
 
-def extract_image_text(file_path: str):
+def extract_image_text_with_confidence(image: Union[str, np.ndarray]) -> Tuple[bool, str, float]:
+    """
+    Same as extract_image_text, and also returns Tesseract's mean word confidence, from 0 to 100.
+    """
+    try:
+        text, confidence = image_to_string_with_confidence(image)
+        return True, text, confidence
+    except OCRError:
+        return False, "An invalid or corrupted image", 0.0
+
+
+# Lines recognised below this confidence are OCR'd again on their own. See extract_image_layout.
+REOCR_CONFIDENCE_THRESHOLD = float(os.environ.get("REOCR_CONFIDENCE_THRESHOLD", "60"))
+# At most this many lines of an image are OCR'd again, the least confident first.
+REOCR_MAX_LINES = int(os.environ.get("REOCR_MAX_LINES", "5"))
+# A line is cropped with this margin in pixels, and upscaled by this factor.
+REOCR_PADDING = 4
+REOCR_SCALE = 2
+# Tesseract's page segmentation mode treating the image as a single line of text.
+PSM_SINGLE_LINE = 7
+
+
+def _reocr_line(image: np.ndarray, line: dict, whitelist: Optional[str] = None) -> List[dict]:
+    """
+    OCRs the region of a single line again, upscaled and as a single line of text.
+    Returns the words, with their boxes mapped back to the coordinates of `image`.
+    """
+    height, width = image.shape[:2]
+    left, top, right, bottom = line["box"]
+    left, top = max(left - REOCR_PADDING, 0), max(top - REOCR_PADDING, 0)
+    right, bottom = min(right + REOCR_PADDING, width), min(bottom + REOCR_PADDING, height)
+    region = cv.resize(image[top:bottom, left:right], None, fx=REOCR_SCALE, fy=REOCR_SCALE, interpolation=cv.INTER_CUBIC)
+    words = image_to_words(region, psm=PSM_SINGLE_LINE, whitelist=whitelist)
+    return [
+        {
+            "text": word.text,
+            "box": [left + word.left // REOCR_SCALE, top + word.top // REOCR_SCALE, left + word.right // REOCR_SCALE, top + word.bottom // REOCR_SCALE],
+            "confidence": round(word.confidence, 2),
+        }
+        for word in words
+    ]
+
+
+def extract_image_layout(image: np.ndarray, psm: Optional[int] = None, whitelist: Optional[str] = None) -> Tuple[bool, str, Optional[dict]]:
+    """
+    Same as extract_image_text, and also returns the word level layout of the image, see layout.py.
+    `psm` and `whitelist` are passed to Tesseract, see ocr_engine.image_to_words.
+
+    Lines recognised with a confidence below REOCR_CONFIDENCE_THRESHOLD are OCR'd again on their own, upscaled and as a single line.
+    Fixing a blurry field this way is much cheaper than OCR'ing the whole image again.
+    The new reading of a line replaces the first one only if it's more confident.
+    """
+    try:
+        words = image_to_words(image, psm=psm, whitelist=whitelist)
+    except OCRError:
+        return False, "An invalid or corrupted image", None
+    height, width = image.shape[:2]
+    page_layout = build_layout(words, width, height)
+    lines = low_confidence_lines(page_layout, REOCR_CONFIDENCE_THRESHOLD, REOCR_MAX_LINES)
+    if len(lines) > 0:
+        with timed("reocr", doc_type="image", engine="tesseract"):
+            for line in lines:
+                try:
+                    line_words = _reocr_line(image, line, whitelist)
+                except OCRError as exc:
+                    logger.warning(f"Line {line['text']} couldn't be OCR'd again: {exc}")
+                    continue
+                if len(line_words) == 0:
+                    continue
+                confidence = sum(word["confidence"] for word in line_words) / len(line_words)
+                if confidence > line["confidence"]:
+                    logger.info(f"Line {line['text']} read again as {' '.join(word['text'] for word in line_words)}")
+                    replace_line(page_layout, line, line_words)
+    return True, layout_text(page_layout), page_layout
+
+
+# The quick classification pass runs on a copy downscaled to this many pixels on its longest side.
+# An ID card scanned at 300 DPI is about 1000 pixels wide, a passport's data page about 1500. At 640, their printed text is still
+# 12 to 20 pixels high, enough to read the key phrases, for about a third to a fifth of the pixels. See bench_two_pass in benchmarks.run.
+CLASSIFICATION_PASS_MAX_SIDE = int(os.environ.get("CLASSIFICATION_PASS_MAX_SIDE", "640"))
+
+
+def classify_image_quickly(img: np.ndarray) -> Tuple[Optional[str], Optional[Tuple[int, int, int, int]]]:
+    """
+    OCRs a downscaled grayscale copy of the image, without any filtering, only to classify it.
+    Returns the category, and the region of the text in the full resolution image. See ocr_profiles.region_of_interest.
+    """
+    height, width = img.shape[:2]
+    scale = min(1.0, CLASSIFICATION_PASS_MAX_SIDE / max(height, width))
+    small = cv.cvtColor(img, cv.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    if scale < 1:
+        # INTER_AREA averages the pixels, rather than dropping them. Keeps thin strokes visible.
+        small = cv.resize(small, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+    try:
+        words = image_to_words(small)
+    except OCRError:
+        return None, None
+    category = classify(" ".join(word.text for word in words))
+    return category, region_of_interest(words, scale, width, height)
+
+
+def extract_image_text_two_pass(
+    file_path: str, options: dict = None, audit: bool = False, report: dict = None
+) -> Tuple[bool, str, Optional[dict], Optional[str]]:
+    """
+    Two-pass OCR. A quick pass classifies the image, then the full pass uses the OCR profile of its type. See ocr_profiles.
+    An unclassified image goes through the general pass, with the requested `options`.
+    The preprocessing steps are added to `report`, see image_preprocessing.preprocess_image_array.
+    Returns (is_success, content, layout, profile name). The profile name is None for the general pass.
+    The layout's boxes are relative to the region the full pass OCR'd, i.e the cropped image.
+    """
+    img = cv.imread(file_path)
+    if img is None:
+        logger.error(f"{file_path} couldn't be decoded as an image.")
+        return False, "An invalid or corrupted image", None, None
+    with timed("classification_pass", doc_type="image", engine="tesseract"):
+        category, region = classify_image_quickly(img)
+    profile = get_profile(category)
+    if profile is None:
+        logger.info(f"{file_path} isn't classified, using the general pass")
+        psm, whitelist = None, None
+    else:
+        logger.info(f"{file_path} classified as {category}, using its OCR profile")
+        # The profile's preprocessing options take precedence, other options e.g adaptive still apply.
+        options = {**(options or {}), **profile.options}
+        psm, whitelist = profile.psm, profile.whitelist
+        if profile.crop_to_text and region is not None:
+            left, top, right, bottom = region
+            img = img[top:bottom, left:right]
+    dpi = read_dpi(file_path) if options is not None and options.get("adaptive") is True else None
+    with timed("preprocess", doc_type="image", engine="opencv"):
+        img = preprocess_image_array(img, options, report=report, dpi=dpi)
+    if audit is True:
+        base, ext = os.path.splitext(file_path)
+        cv.imwrite(f"{base}-cv-processed{ext}", img)
+    with timed("ocr", doc_type="image", engine="tesseract") as timer:
+        is_success, content, page_layout = extract_image_layout(img, psm=psm, whitelist=whitelist)
+        if is_success is False:
+            timer.fail()
+    return is_success, content, page_layout, profile.name if profile is not None else None
+
+
+def extract_image_text(image: Union[str, np.ndarray]):
     """
-    Expects an image file path to be passed.
-    A TesseractError would happen, and will be handled, if the file is non-image.
+    Expects an image file path, or an image already decoded in memory as a NumPy array, to be passed.
+    Passing the array avoids writing the image to disk only to be read again.
+    Delegates to ocr_engine, which keeps warm Tesseract engines resident in the process.
+    An OCRError would happen, and will be handled, if the file is non-image.
     """
     try:
-        text = pytesseract.image_to_string(file_path)
+        text = image_to_string(image)
         return True, text
-    except TesseractError:
+    except OCRError:
         return False, "An invalid or corrupted image"
@@ -1,7 +1,7 @@
 #!/bin/bash
 
-# Start the RQ worker in the background
-rq worker --url redis://host.docker.internal &
+# Start the supervised pool of RQ workers in the background, see worker_pool.py
+python worker_pool.py &
 
 # Start FastAPI (uvicorn)
 exec uvicorn main:app --host 0.0.0.0 --port 8000
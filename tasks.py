@@ -7,18 +7,101 @@ A guiding principle for tasks is that they should be self-contained.
 Hence, the task itself should do any processing whether computational or I/O bound.
 And once the task has completed, it is responsible for writing it to the database.
 result_callbacks are messy, and we want to avoid them.
+
+Jobs are put on a queue per workload, so that different workloads don't wait behind each other in one line:
+- ocr: Tesseract OCR of images, CPU bound.
+- pdf: PDF extraction, involving rasterisation of large PDFs, memory bound.
+- textract: Calls to AWS Textract, network bound.
+- analysis: Classification and structured data extraction of the extracted text, chained after every extraction.
+- default: Short jobs, e.g the fan-out of a batch.
+See worker_pool.py for the workers listening to these queues.
+
+Every extraction job, whatever its engine, hands over to the analysis the same way: store_extraction, then finish_extraction.
+They live here, rather than in the wrappers, as they only need Redis.
 """
 from rq import Queue
 
 # Only required to get the Redis connection which orchestrates the queue.
-from db import get_connection
+from db import get_connection, set_fields
+from metrics import timed
+from events import publish, COMPLETED
+
+
+DEFAULT_QUEUE = "default"
+OCR_QUEUE = "ocr"
+PDF_QUEUE = "pdf"
+TEXTRACT_QUEUE = "textract"
+ANALYSIS_QUEUE = "analysis"
 
 
-def enqueue_extraction(extraction_function, **kwargs):
+def enqueue_extraction(extraction_function, queue_name: str = DEFAULT_QUEUE, **kwargs):
     """
+    `extraction_function` could be the function, or its dotted path.
+    The API enqueues by path, so that it doesn't import the service wrappers and the libraries they load, e.g OpenCV and boto3.
+
     Usage:
-    enqueue_extraction(extraction_function=detect_text_and_set_db, file_path="/media/textract-ocr-files/abc.pdf", key="some-hash")
+    enqueue_extraction(extraction_function="textract_wrapper.detect_text_and_set_db", queue_name=TEXTRACT_QUEUE, file_path="/media/textract-ocr-files/abc.pdf", key="some-hash")
     """
     connection = get_connection()
-    q = Queue(connection=connection)
+    q = Queue(queue_name, connection=connection)
     q.enqueue(extraction_function, **kwargs)
+
+
+def fan_out_extractions(extractions: list):
+    """
+    A job which enqueues many extraction jobs, e.g one per document of a batch, in a single pipeline per queue.
+    `extractions` is a list of dicts having the dotted path of the `function`, its `kwargs` and the `queue` name.
+    Functions are referred to by path, so that this module doesn't import the service wrappers.
+
+    Usage:
+    enqueue_extraction(extraction_function=fan_out_extractions, extractions=[{"function": "service_wrappers.extract_pdf_text_and_set_db", "kwargs": {...}, "queue": PDF_QUEUE}])
+    """
+    connection = get_connection()
+    jobs_by_queue = {}
+    for extraction in extractions:
+        job = Queue.prepare_data(extraction["function"], kwargs=extraction["kwargs"])
+        jobs_by_queue.setdefault(extraction.get("queue", DEFAULT_QUEUE), []).append(job)
+    for queue_name, jobs in jobs_by_queue.items():
+        q = Queue(queue_name, connection=connection)
+        q.enqueue_many(jobs)
+
+
+# Status of the analysis of a stored text, in the analysis_status field. Set to pending when the analysis is enqueued.
+ANALYSIS_PENDING = "pending"
+ANALYSIS_DONE = "done"
+ANALYSIS_FAILED = "failed"
+
+
+def enqueue_analysis(key: str, field: str = 'content', doc_type: str = "unknown"):
+    """
+    Enqueues the analysis of the text stored in `field` of `key`.
+    Called by the extraction jobs once the text is stored, and by the API to re-run the analysis of a stored text.
+    The function is referred to by path, so that the API doesn't import the service wrappers.
+
+    Usage:
+    enqueue_analysis(key="some-hash", doc_type="pdf")
+    """
+    enqueue_extraction("service_wrappers.analyze_text_and_set_db", queue_name=ANALYSIS_QUEUE, key=key, field=field, doc_type=doc_type)
+
+
+def store_extraction(key: str, doc_type: str, is_success: bool, fields: dict):
+    """
+    Stores the `fields` of the extraction. Called within the job's job_timings_recorder, so that the write is in the timings.
+    """
+    if is_success is True:
+        # Stored along with the content, so that a client never sees the content without knowing the analysis is pending.
+        fields["analysis_status"] = ANALYSIS_PENDING
+    with timed("db_write", doc_type=doc_type, engine="redis"):
+        set_fields(key, fields)
+
+
+def finish_extraction(key: str, field: str, doc_type: str, is_success: bool):
+    """
+    Chains the analysis after a successful extraction, once the extraction and its timings are stored.
+    The analysis job then marks the job completed. A failed extraction has nothing to analyse, and is completed right away.
+    """
+    if is_success is True:
+        enqueue_analysis(key, field, doc_type)
+        publish(key, "stage", {"stage": "analysis"})
+    else:
+        publish(key, COMPLETED, {"is_success": is_success})
@@ -11,60 +11,290 @@ Can perform things like:
 TODO:
 - Summarization
 """
+import os
 import re
 import nltk
 import string
 import logging
 import Levenshtein
+import numpy as np
+from collections import Counter
+from dataclasses import dataclass
+from typing import Iterable, List, Tuple
 
-# It's an idempotent operatation
-nltk.download('stopwords')
-nltk.download('punkt_tab')
-nltk.download('words')
+from layout import iter_lines, phrase_box, value_below, lines_below
 
 logger = logging.getLogger(__name__)
 
+# NLTK data needed by this module, name -> path within nltk_data.
+# Bundled in the Docker image, see the Dockerfile. Loaded lazily, on first use.
+NLTK_RESOURCES = {
+    "stopwords": "corpora/stopwords",
+    "punkt_tab": "tokenizers/punkt_tab",
+}
+# Downloading needs network access. Disabled in the Docker image, where the data is bundled.
+NLTK_DOWNLOAD = os.environ.get("NLTK_DOWNLOAD", "true").lower() == "true"
+
+# Global variable, set once the NLTK data is found.
+nltk_data_available = False
+
+
+def ensure_nltk_data():
+    """
+    Looks up the NLTK data on disk, only once per process. Downloads what's missing, only if NLTK_DOWNLOAD is enabled.
+    Raises LookupError if the data is missing and can't be downloaded.
+    """
+    global nltk_data_available
+    if nltk_data_available:
+        return
+    for name, path in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            if not NLTK_DOWNLOAD:
+                raise
+            logger.warning(f"NLTK data {name} not found, downloading")
+            if not nltk.download(name, quiet=True):
+                raise
+    nltk_data_available = True
+
+
+def warm_up():
+    """
+    Loads the NLTK data upfront, e.g in the worker pool supervisor, instead of in the first job.
+    """
+    ensure_nltk_data()
+    nltk.word_tokenize("Warm up.")
+    get_stopwords()
+
+
+# Global variable, the stopwords are loaded once and looked up in constant time. See get_stopwords.
+stopwords = None
+
+
+def get_stopwords() -> frozenset:
+    global stopwords
+    if stopwords is None:
+        ensure_nltk_data()
+        stopwords = frozenset(nltk.corpus.stopwords.words("english"))
+    return stopwords
+
+
+# Words, including contractions like "don't". Punctuation isn't counted.
+WORD_PATTERN = re.compile(r"\w+(?:'\w+)*")
+# Same as nltk's Text.collocations. Words shorter than this don't participate in collocations.
+COLLOCATION_MIN_WORD_LENGTH = 3
+COLLOCATION_MIN_FREQUENCY = 2
+# Longest run of characters held back for the next chunk. A longer one isn't a word, e.g a base64 blob, and is counted as it is.
+MAX_PENDING_CHARS = 1024
+
+
+class TextStatistics:
+    """
+    Word statistics of a text, accumulated chunk by chunk. Hence a multi-megabyte text, e.g the output of a long PDF, can be fed page by page.
+    The text is tokenised once, with a regular expression. Words are lowercased, and counted with Counters.
+
+    Usage:
+
+        statistics = TextStatistics()
+        for page in pages:
+            statistics.update(page)
+        statistics.summary()
+    """
+
+    def __init__(self):
+        self.stopwords = get_stopwords()
+        # All the words, including stopwords.
+        self.token_counts = Counter()
+        # Words other than stopwords, and adjacent pairs of them.
+        self.word_counts = Counter()
+        self.bigram_counts = Counter()
+        # A word could be split across two chunks. It's held back until the next chunk.
+        self.pending = ""
+        self.previous_word = None
+
+    def update(self, chunk: str):
+        # Only the new chunk is scanned, the held back text has no whitespace.
+        split_at = len(chunk)
+        while split_at > 0 and not chunk[split_at - 1].isspace():
+            split_at -= 1
+        if split_at == 0:
+            self.pending += chunk
+            if len(self.pending) > MAX_PENDING_CHARS:
+                self.flush()
+            return
+        self._count(self.pending + chunk[:split_at])
+        self.pending = chunk[split_at:]
+
+    def _count(self, text: str):
+        tokens = WORD_PATTERN.findall(text.lower())
+        if len(tokens) == 0:
+            return
+        self.token_counts.update(tokens)
+        words = [token for token in tokens if token not in self.stopwords]
+        if len(words) == 0:
+            return
+        self.word_counts.update(words)
+        if self.previous_word is not None:
+            self.bigram_counts[(self.previous_word, words[0])] += 1
+        self.bigram_counts.update(zip(words, words[1:]))
+        self.previous_word = words[-1]
+
+    def flush(self):
+        self._count(self.pending)
+        self.pending = ""
+
+    def collocations(self, count: int = 20) -> list:
+        """
+        Bigrams which occur together more often than chance, ranked by the likelihood ratio, like nltk's Text.collocations.
+        All the candidate bigrams are scored at once, on NumPy arrays.
+        """
+        candidates = [
+            (bigram, frequency) for bigram, frequency in self.bigram_counts.items()
+            if frequency >= COLLOCATION_MIN_FREQUENCY
+            and len(bigram[0]) >= COLLOCATION_MIN_WORD_LENGTH and len(bigram[1]) >= COLLOCATION_MIN_WORD_LENGTH
+        ]
+        if len(candidates) == 0:
+            return []
+        total = sum(self.word_counts.values())
+        # Contingency table of every bigram (w1, w2): both, w1 without w2, w2 without w1, neither.
+        n_ii = np.array([frequency for _, frequency in candidates], dtype=np.float64)
+        n_ix = np.array([self.word_counts[bigram[0]] for bigram, _ in candidates], dtype=np.float64)
+        n_xi = np.array([self.word_counts[bigram[1]] for bigram, _ in candidates], dtype=np.float64)
+        n_io = n_ix - n_ii
+        n_oi = n_xi - n_ii
+        n_oo = np.maximum(total - n_ii - n_io - n_oi, 0)
+        observed = np.stack([n_ii, n_io, n_oi, n_oo])
+        expected = np.stack([
+            n_ix * n_xi,
+            n_ix * (total - n_xi),
+            (total - n_ix) * n_xi,
+            (total - n_ix) * (total - n_xi),
+        ]) / total
+        with np.errstate(divide="ignore", invalid="ignore"):
+            terms = np.where(observed > 0, observed * np.log(observed / expected), 0)
+        scores = 2 * terms.sum(axis=0)
+        # Highest score first, ties broken alphabetically to be deterministic.
+        order = sorted(range(len(candidates)), key=lambda index: (-scores[index], candidates[index][0]))
+        return [" ".join(candidates[index][0]) for index in order[:count]]
+
+    def summary(self, most_common: int = 10, collocations: int = 20) -> dict:
+        """
+        JSON serialisable statistics. The unique words themselves aren't included, only their count, as they could be many.
+        """
+        self.flush()
+        total_tokens = sum(self.token_counts.values())
+        return {
+            # Words other than stopwords
+            "length": sum(self.word_counts.values()),
+            "total_tokens": total_tokens,
+            "unique_count": len(self.word_counts),
+            "lexical_diversity": len(self.token_counts) / total_tokens if total_tokens > 0 else 0,
+            "most_common": self.word_counts.most_common(most_common),
+            "collocations": self.collocations(collocations),
+        }
+
+
+def analyze_stream(chunks: Iterable[str]) -> dict:
+    """
+    `chunks` could be the pages of a document, or a file read in blocks.
+    """
+    statistics = TextStatistics()
+    for chunk in chunks:
+        statistics.update(chunk)
+    return statistics.summary()
+
 
 def analyze(text: str):
     """
-    Performs analysis on text using nltk.
+    Performs analysis on text.
     Currently does the following:
-    - Length of the text
+    - Length of the text, words other than stopwords
     - Most common words
     - Unique words
+    - Lexical diversity
     - Collocations
     """
-    words = nltk.word_tokenize(text)
-    # Remove stopwords
-    words = [word for word in words if word not in nltk.corpus.stopwords.words("english")]
-    uniques = set(words)
-    text = nltk.Text(words)
-    freq_dist = nltk.FreqDist(text)
-    length = len(text)
-    most_common = freq_dist.most_common(10)
-    collocations = text.collocations()
-    return {"length": length, "most_common": most_common, "uniques": uniques, "collocations": collocations}
+    statistics = TextStatistics()
+    statistics.update(text)
+    result = statistics.summary()
+    result["uniques"] = set(statistics.word_counts)
+    return result
 
 
-def is_meaningful_content(text: str):
-    # If lot of single character words, which isn't even 'a' or 'i'.
-    SINGLE_CHARACTER_PERCENTAGE_THRESHOLD = 0.5
-    words = nltk.word_tokenize(text)
-    # No word could be extracted
-    if len(words) == 0:
-        return False
+# A text having lots of single character words, which aren't even 'a' or 'i', is likely OCR noise or garbled embedded text.
+SINGLE_CHARACTER_PERCENTAGE_THRESHOLD = 0.5
+SINGLE_CHARACTER_WORDS = frozenset(["a", "i", "A", "I"])
+# If we are able to extract only page end markers, then it's an non meaningful content.
+# \x0c is the page end marker.
+PAGE_MARKER_PERCENTAGE_THRESHOLD = 0.5
+# Words, and every punctuation mark as a token of its own. Punctuation marks count as single characters, as with nltk.word_tokenize.
+TOKEN_PATTERN = re.compile(r"\w+(?:[-.,']\w+)*|[^\w\s]")
+WHITESPACE_PATTERN = re.compile(r"\s")
+# The text is examined in windows. Once this many tokens are seen, and the ratio is this far from the threshold, the verdict is clear.
+SAMPLE_WINDOW_CHARS = 4096
+MIN_SAMPLE_TOKENS = 200
+VERDICT_MARGIN = 0.15
+
+
+@dataclass
+class ContentQuality:
+    is_meaningful: bool
+    # Share of the tokens which aren't stray single characters, from 0 to 1.
+    score: float
+    tokens_examined: int
+    # Whether the verdict was reached on a sample, without examining the whole text.
+    sampled: bool
+
+
+def _sample_windows(text: str) -> List[Tuple[int, int]]:
+    """
+    Splits the text into windows of roughly SAMPLE_WINDOW_CHARS, ending at whitespace so that no word is cut.
+    The windows are ordered to spread the sample across the text, as the beginning alone, e.g a page header, isn't representative:
+    every stride-th window first, then the ones in between.
+    """
+    boundaries = [0]
+    position = SAMPLE_WINDOW_CHARS
+    while position < len(text):
+        match = WHITESPACE_PATTERN.search(text, position)
+        if match is None:
+            break
+        boundaries.append(match.start())
+        position = match.start() + SAMPLE_WINDOW_CHARS
+    boundaries.append(len(text))
+    windows = list(zip(boundaries, boundaries[1:]))
+    stride = max(1, len(windows) // 8)
+    return [windows[index] for offset in range(stride) for index in range(offset, len(windows), stride)]
+
+
+def assess_content(text: str) -> ContentQuality:
+    """
+    Decides whether the text is meaningful, e.g whether the embedded text of a PDF page is usable or the page needs OCR.
+    Tokenises only as much of the text as needed for a clear verdict.
+    """
+    if len(text) == 0 or text.count("\x0c") / len(text) > PAGE_MARKER_PERCENTAGE_THRESHOLD:
+        return ContentQuality(is_meaningful=False, score=0.0, tokens_examined=0, sampled=False)
+    windows = _sample_windows(text)
+    token_count = 0
     single_character_count = 0
-    for word in words:
-        if len(word) == 1 and word.lower() not in ['a', 'i']:
-            single_character_count += 1
-    if single_character_count / len(words) > SINGLE_CHARACTER_PERCENTAGE_THRESHOLD:
-        return False
-    # If we are able to extract only page end markers, then it's an non meaningful content.
-    # \x0c is the page end marker.
-    PAGE_MARGER_PERCENTAGE_THRESHOLD = 0.5
-    if text.count("\x0c") / len(text) > PAGE_MARGER_PERCENTAGE_THRESHOLD:
-        return False
-    return True
+    for index, (start, end) in enumerate(windows):
+        tokens = TOKEN_PATTERN.findall(text, start, end)
+        token_count += len(tokens)
+        single_character_count += sum(1 for token in tokens if len(token) == 1 and token not in SINGLE_CHARACTER_WORDS)
+        is_last = index == len(windows) - 1
+        if not is_last and token_count >= MIN_SAMPLE_TOKENS:
+            ratio = single_character_count / token_count
+            if abs(ratio - SINGLE_CHARACTER_PERCENTAGE_THRESHOLD) >= VERDICT_MARGIN:
+                return ContentQuality(ratio <= SINGLE_CHARACTER_PERCENTAGE_THRESHOLD, 1 - ratio, token_count, sampled=True)
+    # No word could be extracted
+    if token_count == 0:
+        return ContentQuality(is_meaningful=False, score=0.0, tokens_examined=0, sampled=False)
+    ratio = single_character_count / token_count
+    return ContentQuality(ratio <= SINGLE_CHARACTER_PERCENTAGE_THRESHOLD, 1 - ratio, token_count, sampled=False)
+
+
+def is_meaningful_content(text: str):
+    return assess_content(text).is_meaningful
 
 
 def classify(text: str):
@@ -76,10 +306,13 @@ def classify(text: str):
 
     It currently does a simple string matching. We will move to NLP NaiveBayes Classification soon.
     And gradually to more advanced classification models.
+
+    The key phrases of all the classifiers are found in a single pass over the text.
     """
-    if classify_passport(text):
+    matches = CLASSIFICATION_MATCHER.search(text)
+    if classify_passport(text, matches):
         return "passport"
-    if classify_pan(text):
+    if classify_pan(text, matches):
         return "pan"
     lowered_text = text.lower()
     # In Aadhaar Card, Government of India is shaded, hence binarization causes it not to be read properly.
@@ -96,111 +329,217 @@ def classify(text: str):
     return None
 
 
+class FuzzyPhraseMatcher:
+    """
+    Finds multiple phrases approximately, in a single pass over the text.
+
+    Every phrase has its own edit budget i.e maximum Levenshtein distance.
+    A phrase matches at the first window of the text, having the same length as the phrase, within the budget.
+    This is the same as sliding a window over the text and computing the Levenshtein distance at every offset,
+    however that costs a distance computation per phrase per offset.
+
+    It uses Myers' bit-parallel approximate matching. The bit vectors of all the phrases are packed in a single integer,
+    with a guard bit between phrases to absorb the carries. Hence one update per character advances all the phrases.
+    The bit vectors give, at every offset, the smallest distance of a phrase to any substring ending there.
+    That is a lower bound of the distance of the fixed length window ending there. Only windows whose lower bound is
+    within the budget are verified with Levenshtein.distance.
+
+    Usage:
+
+        matcher = FuzzyPhraseMatcher({"surname": 2, "given name": 2})
+        matches = matcher.search(text)
+        match_found, match_str, distance = matches["surname"]
+    """
+
+    def __init__(self, phrases: dict):
+        """
+        `phrases` maps a phrase to its maximum distance.
+        """
+        self.phrases = [(phrase.lower(), max_distance) for phrase, max_distance in phrases.items()]
+        self.peq = {}
+        self.top_bits = []
+        self.all_bits = 0
+        offset = 0
+        for phrase, _ in self.phrases:
+            for index, character in enumerate(phrase):
+                self.peq[character] = self.peq.get(character, 0) | (1 << (offset + index))
+            self.all_bits |= ((1 << len(phrase)) - 1) << offset
+            self.top_bits.append(1 << (offset + len(phrase) - 1))
+            # One guard bit after each phrase
+            offset += len(phrase) + 1
+
+    def search(self, text: str, stop_after: int = None) -> dict:
+        """
+        Returns a dict mapping every phrase to a (match_found, match_str, distance) tuple.
+        The scan stops early once every phrase is found, or once `stop_after` phrases are found.
+        """
+        text = text.lower()
+        results = {phrase: (False, None, None) for phrase, _ in self.phrases}
+        pending = list(range(len(self.phrases)))
+        if stop_after is None:
+            stop_after = len(self.phrases)
+        found_count = 0
+        scores = [len(phrase) for phrase, _ in self.phrases]
+        peq = self.peq
+        all_bits = self.all_bits
+        positive_vertical = all_bits
+        negative_vertical = 0
+        for end, character in enumerate(text):
+            if found_count >= stop_after or len(pending) == 0:
+                break
+            eq = peq.get(character, 0)
+            x_vertical = eq | negative_vertical
+            x_horizontal = ((((eq & positive_vertical) + positive_vertical) ^ positive_vertical) | eq) & all_bits
+            positive_horizontal = (negative_vertical | ~(x_horizontal | positive_vertical)) & all_bits
+            negative_horizontal = positive_vertical & x_horizontal
+            matched = []
+            for index in pending:
+                top_bit = self.top_bits[index]
+                if positive_horizontal & top_bit:
+                    scores[index] += 1
+                elif negative_horizontal & top_bit:
+                    scores[index] -= 1
+                phrase, max_distance = self.phrases[index]
+                if scores[index] <= max_distance and end >= len(phrase) - 1:
+                    window = text[end - len(phrase) + 1:end + 1]
+                    distance = Levenshtein.distance(window, phrase)
+                    if distance <= max_distance:
+                        results[phrase] = (True, window, distance)
+                        matched.append(index)
+            if len(matched) > 0:
+                pending = [index for index in pending if index not in matched]
+                found_count += len(matched)
+            positive_horizontal = (positive_horizontal << 1) & all_bits
+            negative_horizontal = (negative_horizontal << 1) & all_bits
+            positive_vertical = (negative_horizontal | ~(x_vertical | positive_horizontal)) & all_bits
+            negative_vertical = positive_horizontal & x_vertical
+        return results
+
+
 def fuzzy_substring_match(text, phrase, max_distance=2):
-    phrase_len = len(phrase)
-    text = text.lower()
-    phrase = phrase.lower()
+    matcher = FuzzyPhraseMatcher({phrase: max_distance})
+    return matcher.search(text)[phrase.lower()]
+
+
+REPUBLIC_OF_INDIA = "republic of india"
+NATIONALITY = "nationality"
+PASSPORT_NUMBER = "passport no"
+DATE_OF_BIRTH = "date of birth"
+PLACE_OF_BIRTH = "place of birth"
+GIVEN_NAME = "given name"
+SURNAME = "surname"
+PASSPORT_PHRASES = {
+    REPUBLIC_OF_INDIA: 2,
+    NATIONALITY: 2,
+    PASSPORT_NUMBER: 2,
+    DATE_OF_BIRTH: 2,
+    PLACE_OF_BIRTH: 2,
+    GIVEN_NAME: 2,
+    SURNAME: 2,
+}
 
-    for i in range(len(text) - phrase_len + 1):
-        window = text[i:i + phrase_len]
-        logger.info(f"Comparing {window} with {phrase}")
-        distance = Levenshtein.distance(window, phrase)
-        if distance <= max_distance:
-            return True, window, distance
+INCOME_TAX_DEPARTMENT = 'income tax department'
+GOVT_OF_INDIA = 'govt of india'
+PERMANENT_ACCOUNT_NUMBER = 'permanent account number'
+PAN_PHRASES = {
+    INCOME_TAX_DEPARTMENT: 5,
+    GOVT_OF_INDIA: 4,
+    PERMANENT_ACCOUNT_NUMBER: 4,
+}
 
-    return False, None, None
+# Consider 60% of the text as a threshold.
+CLASSIFICATION_THRESHOLD = 0.6
 
+PASSPORT_MATCHER = FuzzyPhraseMatcher(PASSPORT_PHRASES)
+PAN_MATCHER = FuzzyPhraseMatcher(PAN_PHRASES)
+CLASSIFICATION_MATCHER = FuzzyPhraseMatcher({**PASSPORT_PHRASES, **PAN_PHRASES})
 
-def classify_passport(text: str):
+
+def _required_matches(total: int) -> int:
+    """
+    Minimum number of phrases to be found, for the found ratio to reach the threshold.
+    """
+    for required in range(total + 1):
+        if required / total >= CLASSIFICATION_THRESHOLD:
+            return required
+    return total
+
+
+def _is_classified(phrases: dict, matches: dict) -> bool:
+    found_count = 0
+    for phrase in phrases:
+        match_found, match_str, distance = matches[phrase]
+        if match_found:
+            logger.info(f"Matched {match_str} with {phrase} with distance {distance}")
+            found_count += 1
+    return found_count >= _required_matches(len(phrases))
+
+
+def classify_passport(text: str, matches: dict = None):
     """
     Does this look like a passport?
+    `matches` could be passed if the phrases have already been searched, e.g by classify.
     """
-    text = text.lower()
-    REPUBLIC_OF_INDIA = "republic of india"
-    republic_of_india_found = False
-    match_found, match_str, distance = fuzzy_substring_match(text, REPUBLIC_OF_INDIA)
-    if match_found:
-        logger.info(f"Matched {match_str} with {REPUBLIC_OF_INDIA} with distance {distance}")
-        republic_of_india_found = True
-    NATIONALITY = "nationality"
-    nationality_found = False
-    match_found, match_str, distance = fuzzy_substring_match(text, NATIONALITY)
-    if match_found:
-        logger.info(f"Matched {match_str} with {NATIONALITY} with distance {distance}")
-        nationality_found = True
-    PASSPORT_NUMBER = "passport no"
-    passport_number_found = False
-    match_found, match_str, distance = fuzzy_substring_match(text, PASSPORT_NUMBER)
-    if match_found:
-        logger.info(f"Matched {match_str} with {PASSPORT_NUMBER} with distance {distance}")
-        passport_number_found = True
-    DATE_OF_BIRTH = "date of birth"
-    date_of_birth_found = False
-    match_found, match_str, distance = fuzzy_substring_match(text, DATE_OF_BIRTH)
-    if match_found:
-        logger.info(f"Matched {match_str} with {DATE_OF_BIRTH} with distance {distance}")
-        date_of_birth_found = True
-    PLACE_OF_BIRTH = "place of birth"
-    place_of_birth_found = False
-    match_found, match_str, distance = fuzzy_substring_match(text, PLACE_OF_BIRTH)
-    if match_found:
-        logger.info(f"Matched {match_str} with {PLACE_OF_BIRTH} with distance {distance}")
-        place_of_birth_found = True
-    GIVEN_NAME = "given name"
-    given_name_found = False
-    match_found, match_str, distance = fuzzy_substring_match(text, GIVEN_NAME)
-    if match_found:
-        logger.info(f"Matched {match_str} with {GIVEN_NAME} with distance {distance}")
-        given_name_found = True
-    SURNAME = "surname"
-    surname_found = False
-    match_found, match_str, distance = fuzzy_substring_match(text, SURNAME)
-    if match_found:
-        logger.info(f"Matched {match_str} with {SURNAME} with distance {distance}")
-        surname_found = True
-    found_array = [republic_of_india_found, nationality_found, passport_number_found, date_of_birth_found, place_of_birth_found, given_name_found, surname_found]
-    found_true = [x for x in found_array if x]
-    # Consider 60% of the text as a threshold.
-    if len(found_true)/len(found_array) >= 0.6:
-        return True
-    return False
-
-
-def classify_pan(text: str):
-    text = text.lower()
-    INCOME_TAX_DEPARTMENT = 'income tax department'
-    GOVT_OF_INDIA = 'govt of india'
-    PERMANENT_ACCOUNT_NUMBER = 'permanent account number'
-    income_tax_department_found = False
-    govt_of_india_found = False
-    permanent_account_number_found = False
-    match_found, match_str, distance = fuzzy_substring_match(text, INCOME_TAX_DEPARTMENT, max_distance=5)
-    if match_found:
-        logger.info(f"Matched {match_str} with {INCOME_TAX_DEPARTMENT} with distance {distance}")
-        income_tax_department_found = True
-    match_found, match_str, distance = fuzzy_substring_match(text, GOVT_OF_INDIA, max_distance=4)
-    if match_found:
-        logger.info(f"Matched {match_str} with {GOVT_OF_INDIA} with distance {distance}")
-        govt_of_india_found = True
-    match_found, match_str, distance = fuzzy_substring_match(text, PERMANENT_ACCOUNT_NUMBER, max_distance=4)
-    if match_found:
-        logger.info(f"Matched {match_str} with {PERMANENT_ACCOUNT_NUMBER} with distance {distance}")
-        permanent_account_number_found = True
-    found_array = [income_tax_department_found, govt_of_india_found, permanent_account_number_found]
-    found_true = [x for x in found_array if x]
-    # Consider 60% of the text as a threshold.
-    if len(found_true)/len(found_array) >= 0.6:
-        return True
-    return False
+    if matches is None:
+        # The scan can stop as soon as enough phrases are found.
+        matches = PASSPORT_MATCHER.search(text, stop_after=_required_matches(len(PASSPORT_PHRASES)))
+    return _is_classified(PASSPORT_PHRASES, matches)
+
+
+def classify_pan(text: str, matches: dict = None):
+    if matches is None:
+        matches = PAN_MATCHER.search(text, stop_after=_required_matches(len(PAN_PHRASES)))
+    return _is_classified(PAN_PHRASES, matches)
 
 
-def analyze_passport(text: str):
+PASSPORT_FIRST_NAME = "given name(s)"
+PASSPORT_FIELDS_MATCHER = FuzzyPhraseMatcher({PASSPORT_FIRST_NAME: 3, SURNAME: 2, DATE_OF_BIRTH: 2})
+PAN_NAME_MATCHER = FuzzyPhraseMatcher({"india": 2})
+
+
+def _line_after(text: str, match_str: str):
+    index = text.index(match_str)
+    new_line_index = text.find('\n', index)
+    content_after_new_line = text[new_line_index+1:]
+    return content_after_new_line.split('\n')
+
+
+def _find_labels(layout: dict, matcher: FuzzyPhraseMatcher) -> dict:
+    """
+    Searches the labels line by line. Returns a dict mapping every label found to its box, the first occurrence of it.
+    """
+    boxes = {}
+    for line in iter_lines(layout):
+        lowered_line = line["text"].lower()
+        for phrase, (match_found, match_str, distance) in matcher.search(lowered_line).items():
+            if match_found and phrase not in boxes:
+                start = lowered_line.index(match_str)
+                boxes[phrase] = phrase_box(line, start, start + len(match_str))
+    return boxes
+
+
+def _analyze_passport_layout(layout: dict) -> dict:
+    """
+    The fields of a passport are printed under their labels.
+    """
+    data = {}
+    boxes = _find_labels(layout, PASSPORT_FIELDS_MATCHER)
+    for phrase, name in ((PASSPORT_FIRST_NAME, 'First Name'), (SURNAME, 'Last Name'), (DATE_OF_BIRTH, 'Date Of Birth')):
+        if phrase in boxes:
+            value = value_below(layout, boxes[phrase])
+            if value is not None:
+                data[name] = value
+    return data
+
+
+def analyze_passport(text: str, layout: dict = None):
+    """
+    If the word level `layout` of the text is passed, see layout.py, the fields are located spatially.
+    Fields which couldn't be located are taken from the line after their label in the text.
+    """
     # Word boundary on both sides.
     # An upper case letter followed by exactly 7 digits
     logger.info("Analyzing passport")
-    FIRST_NAME = "given name(s)"
-    DOB = "date of birth"
-    LAST_NAME = "surname"
     first_name = None
     last_name = None
     dob = None
@@ -214,28 +553,21 @@ def analyze_passport(text: str):
         non_blank_lines = [line for line in lines if line.strip() != '']
         text = '\n'.join(non_blank_lines)
         text = text.lower()
-        match_found, match_str, distance = fuzzy_substring_match(text, FIRST_NAME, max_distance=3)
+        # All the field labels are found in a single pass.
+        field_matches = PASSPORT_FIELDS_MATCHER.search(text)
+        match_found, match_str, distance = field_matches[PASSPORT_FIRST_NAME]
         if match_found:
-            index = text.index(match_str)
-            new_line_index = text.find('\n', index)
-            content_after_new_line = text[new_line_index+1:]
-            name_and_others = content_after_new_line.split('\n')
+            name_and_others = _line_after(text, match_str)
             if len(name_and_others) > 0:
                 first_name = name_and_others[0]
-        match_found, match_str, distance = fuzzy_substring_match(text, LAST_NAME, max_distance=2)
+        match_found, match_str, distance = field_matches[SURNAME]
         if match_found:
-            index = text.index(match_str)
-            new_line_index = text.find('\n', index)
-            content_after_new_line = text[new_line_index+1:]
-            name_and_others = content_after_new_line.split('\n')
+            name_and_others = _line_after(text, match_str)
             if len(name_and_others) > 0:
                 last_name = name_and_others[0]
-        match_found, match_str, distance = fuzzy_substring_match(text, DOB, max_distance=2)
+        match_found, match_str, distance = field_matches[DATE_OF_BIRTH]
         if match_found:
-            index = text.index(match_str)
-            new_line_index = text.find('\n', index)
-            content_after_new_line = text[new_line_index+1:]
-            name_and_others = content_after_new_line.split('\n')
+            name_and_others = _line_after(text, match_str)
             if len(name_and_others) > 0:
                 dob = name_and_others[0]
     except Exception as e:
@@ -251,10 +583,56 @@ def analyze_passport(text: str):
         data['Last Name'] = last_name
     if dob is not None:
         data['Date Of Birth'] = dob
+    if layout is not None:
+        try:
+            data.update(_analyze_passport_layout(layout))
+        except Exception as e:
+            logger.error(e)
     return data
 
 
-def analyze_pan(text: str):
+# Names are printed in capitals on a PAN card.
+PAN_NAME_PATTERN = re.compile(r"[A-Z][A-Z ]*[A-Z]")
+PAN_DATE_PATTERN = re.compile(r"\b\d{2}/\d{2}/\d{4}\b")
+
+
+def _analyze_pan_layout(layout: dict) -> dict:
+    """
+    The name, father's name and date of birth are printed under the header line having "Govt. of India", from top to bottom.
+    Only the lines overlapping the header horizontally are considered, in the order of their position.
+    A line is taken as a name only if it's in capitals, and as the date of birth only if it has a date.
+    Only the fields found this way are returned, the others are left to the order of the lines in the text.
+    """
+    data = {}
+    header = None
+    for line in iter_lines(layout):
+        match_found, match_str, distance = PAN_NAME_MATCHER.search(line["text"])["india"]
+        if match_found:
+            header = line
+            break
+    if header is None:
+        return data
+    names = []
+    for line in lines_below(layout, header["box"]):
+        date = PAN_DATE_PATTERN.search(line["text"])
+        if date is not None:
+            data['Date of Birth'] = date.group()
+            # The names precede the date of birth.
+            break
+        name = line["text"].translate(str.maketrans('', '', string.punctuation)).strip()
+        if PAN_NAME_PATTERN.fullmatch(name) is not None:
+            names.append(name)
+    if len(names) > 0:
+        data['Name'] = names[0]
+    if len(names) > 1:
+        data["Father's Name"] = names[1]
+    return data
+
+
+def analyze_pan(text: str, layout: dict = None):
+    """
+    If the word level `layout` of the text is passed, see layout.py, the names are located spatially.
+    """
     # Remove blank lines
     lines = text.splitlines()
     non_blank_lines = [line for line in lines if line.strip() != '']
@@ -271,7 +649,7 @@ def analyze_pan(text: str):
         pan_number = matches[0]
     # Extract name
     # Find where "India" occurs
-    match_found, match_str, distance = fuzzy_substring_match(lowered_text, "india")
+    match_found, match_str, distance = PAN_NAME_MATCHER.search(lowered_text)["india"]
     if match_found:
         # Find index of "India"
         index = lowered_text.index(match_str)
@@ -302,4 +680,9 @@ def analyze_pan(text: str):
         data["Father's Name"] = father_name
     if dob is not None:
         data['Date of Birth'] = dob
+    if layout is not None:
+        try:
+            data.update(_analyze_pan_layout(layout))
+        except Exception as e:
+            logger.error(e)
     return data
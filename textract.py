@@ -1,34 +1,257 @@
 """
 Integration with Amazon Textract for performing Text Detection and Optical Character Recognition.
+
+The boto3 client is created once per process and reused, along with its connection pool. See get_client.
+Creating a client loads the service model, which costs more than a Textract call on a small image.
+The worker pool supervisor creates it upfront, see warm_up, hence the forked workers and work horses inherit it.
+No request is made before forking, so no connection is shared between processes.
+
+Textract's synchronous API handles a single page per request. A multi-page PDF is split into single-page PDFs,
+and the pages are sent as concurrent requests, limited to TEXTRACT_MAX_CONCURRENCY in flight per document.
+Textract is called from the textract workers, and from the OCR and PDF workers escalating pages, see ocr_router,
+including every process of the PDF page pool. All of them together are limited to TEXTRACT_RATE_LIMIT requests per second,
+counted in Redis, see SharedRateLimiter.
+Throttled requests are retried by botocore with backoff, in the adaptive retry mode.
+
+Set TEXTRACT_ENDPOINT_URL to point the client to a local stub, e.g moto or LocalStack, instead of AWS.
 """
-import boto3
+import io
 import os
+import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Optional, Tuple
+
+import boto3
+from botocore.config import Config
+from pikepdf import Pdf
+from pdf2image import convert_from_path
+
+from db import get_connection
 
 
 logger = logging.getLogger(__name__)
 
+TEXTRACT_REGION = os.environ.get("TEXTRACT_REGION", "ap-south-1")
+TEXTRACT_ENDPOINT_URL = os.environ.get("TEXTRACT_ENDPOINT_URL") or None
+# Concurrent page requests of a document. Also the size of the connection pool.
+TEXTRACT_MAX_CONCURRENCY = int(os.environ.get("TEXTRACT_MAX_CONCURRENCY", "4"))
+# Requests per second, across all the processes calling Textract. Textract's quota is per account and region.
+TEXTRACT_RATE_LIMIT = int(os.environ.get("TEXTRACT_RATE_LIMIT", "5"))
+RATE_LIMIT_KEY = "textract:rate"
+# Attempts per request, including the first one.
+TEXTRACT_MAX_ATTEMPTS = int(os.environ.get("TEXTRACT_MAX_ATTEMPTS", "5"))
+# The synchronous API accepts documents up to 10 MB.
+TEXTRACT_MAX_BYTES = 10 * 1024 * 1024
+# A page too large to be sent as is, e.g a high resolution scan, is rendered at this DPI instead.
+TEXTRACT_RENDER_DPI = 200
+
+# Called with (page_number, is_success, content) as soon as a page is detected.
+PageCallback = Optional[Callable[[int, bool, str], None]]
+
+# Global variable, the client is created on first use. See get_client.
+textract_client = None
+client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    boto3 clients are thread-safe, the page requests of a document share it.
+    """
+    global textract_client
+    if textract_client is None:
+        with client_lock:
+            if textract_client is None:
+                config = Config(
+                    region_name=TEXTRACT_REGION,
+                    max_pool_connections=TEXTRACT_MAX_CONCURRENCY,
+                    retries={"max_attempts": TEXTRACT_MAX_ATTEMPTS, "mode": "adaptive"},
+                    connect_timeout=5,
+                    read_timeout=60,
+                )
+                # A session of our own, the default session isn't thread-safe.
+                session = boto3.session.Session(
+                    aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
+                    aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+                )
+                textract_client = session.client('textract', config=config, endpoint_url=TEXTRACT_ENDPOINT_URL)
+    return textract_client
+
 
-def detect_text(file_path: str):
+def warm_up():
+    """
+    Creates the client upfront, e.g in the worker pool supervisor, instead of in every job.
+    """
+    get_client()
+
+
+class RateLimiter:
+    """
+    Spaces out the requests of a process to at most `rate` per second, across threads.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SharedRateLimiter:
+    """
+    Limits the requests of all the processes together to `rate` per second.
+    Requests are counted in Redis, in windows of a second: INCR of the window's key, which expires soon after the window.
+    A request over the limit waits for the next window.
+    If Redis can't be reached, it falls back to limiting this process alone.
+    """
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.local = RateLimiter(rate)
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.time()
+            window = int(now)
+            try:
+                pipeline = get_connection().pipeline(transaction=False)
+                pipeline.incr(f"{RATE_LIMIT_KEY}:{window}")
+                pipeline.expire(f"{RATE_LIMIT_KEY}:{window}", 2)
+                count, _ = pipeline.execute()
+            except Exception as exc:
+                logger.error(f"Exception {exc} ocurred while rate limiting Textract, limiting this process alone.")
+                self.local.acquire()
+                return
+            if count <= self.rate:
+                return
+            time.sleep(window + 1 - now)
+
+
+rate_limiter = SharedRateLimiter(TEXTRACT_RATE_LIMIT)
+
+
+def detect_document_text(document: bytes) -> str:
+    """
+    A single page, as the bytes of a JPEG, PNG, TIFF or single-page PDF.
+    Raises botocore's ClientError once the retries are exhausted.
+    """
+    rate_limiter.acquire()
+    response = get_client().detect_document_text(Document={
+        "Bytes": document
+    })
+    words = [block.get('Text') for block in response['Blocks'] if block.get('Text') is not None and block['BlockType'] == 'WORD']
+    return " ".join(words)
+
+
+def _single_page_pdf(page) -> bytes:
+    single_page_pdf = Pdf.new()
+    single_page_pdf.pages.append(page)
+    output = io.BytesIO()
+    single_page_pdf.save(output)
+    single_page_pdf.close()
+    return output.getvalue()
+
+
+def split_pdf_pages(file_path: str) -> List[bytes]:
+    """
+    Splits a PDF into single-page PDFs, in memory. qpdf copies the pages as they are, without rendering.
+    """
+    with Pdf.open(file_path) as pdf:
+        return [_single_page_pdf(page) for page in pdf.pages]
+
+
+def render_pdf_page(file_path: str, page_number: int) -> bytes:
+    image = convert_from_path(file_path, dpi=TEXTRACT_RENDER_DPI, first_page=page_number, last_page=page_number, grayscale=True)[0]
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def _detect_pdf_page(file_path: str, page_number: int, document: bytes) -> str:
+    if len(document) > TEXTRACT_MAX_BYTES:
+        logger.info(f"Page {page_number} of {file_path} is {len(document)} bytes, rendering it instead")
+        document = render_pdf_page(file_path, page_number)
+    return detect_document_text(document)
+
+
+def detect_pdf_page_text(file_path: str, page_number: int) -> str:
+    """
+    Detects the text of a single page of a PDF. `page_number` is 1-based.
+    Raises botocore's ClientError once the retries are exhausted.
+    """
+    with Pdf.open(file_path) as pdf:
+        document = _single_page_pdf(pdf.pages[page_number - 1])
+    return _detect_pdf_page(file_path, page_number, document)
+
+
+def detect_pdf_text(file_path: str, on_page: PageCallback = None) -> List[Tuple[int, bool, str]]:
+    """
+    Detects the text of every page of a PDF, with concurrent page requests.
+    Returns a (page_number, is_success, content) tuple for every page, in page order.
+    A page failing doesn't fail the other pages.
+    """
+    pages = split_pdf_pages(file_path)
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, min(TEXTRACT_MAX_CONCURRENCY, len(pages)))) as executor:
+        futures = {
+            executor.submit(_detect_pdf_page, file_path, page_number, document): page_number
+            for page_number, document in enumerate(pages, start=1)
+        }
+        for future in as_completed(futures):
+            page_number = futures[future]
+            try:
+                is_success, content = True, future.result()
+            except Exception as exc:
+                logger.error(f"Exception {exc} ocurred during Textract text detection of page {page_number} of {file_path}.")
+                is_success, content = False, str(exc)
+            results.append((page_number, is_success, content))
+            if on_page is not None:
+                on_page(page_number, is_success, content)
+    # Pages complete in any order, restore the page order.
+    results.sort(key=lambda result: result[0])
+    return results
+
+
+def detect_text(file_path: str, is_pdf: bool = False, on_page: PageCallback = None):
     """
     Detects document text using AWS Textract.
     This is a synchronous and blocking operation.
-    Textract Synchronous API only supports JPG and PNG formats. It doesn't support PDF format.
 
     Provide file path to a valid file.
-    Textract supports JPEG, PNG.
-    """
-    aws_access_key_id = os.environ['AWS_ACCESS_KEY_ID']
-    aws_secret_access_key = os.environ['AWS_SECRET_ACCESS_KEY']
-    textract = boto3.client('textract', aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key, region_name='ap-south-1')
-    f = open(file_path, "rb")
-    content = f.read()
-    try:
-        response = textract.detect_document_text(Document={
-            "Bytes": content
-        })
-        words = [block.get('Text') for block in response['Blocks'] if block.get('Text') is not None and block['BlockType'] == 'WORD']
-        return True, " ".join(words)
-    except Exception as exc:
-        logger.error(f"Exception {exc} ocurred during Textract text detection.")
-        return False, str(exc)
+    Textract supports JPEG, PNG. A PDF is sent page by page, see detect_pdf_text.
+    Pages that fail are skipped, and reported in the logs.
+    """
+    if is_pdf:
+        try:
+            results = detect_pdf_text(file_path, on_page)
+        except Exception as exc:
+            logger.error(f"Exception {exc} ocurred while splitting {file_path}.")
+            return False, str(exc)
+        contents = [content for _, is_success, content in results if is_success is True]
+        if len(contents) == 0:
+            # Report the failure of the first page.
+            return False, results[0][2] if len(results) > 0 else "An empty PDF"
+        return True, "\n".join(contents)
+    with open(file_path, "rb") as f:
+        content = f.read()
+    if len(content) > TEXTRACT_MAX_BYTES:
+        is_success, text = False, f"Image exceeds Textract's limit of {TEXTRACT_MAX_BYTES} bytes"
+    else:
+        try:
+            is_success, text = True, detect_document_text(content)
+        except Exception as exc:
+            logger.error(f"Exception {exc} ocurred during Textract text detection.")
+            is_success, text = False, str(exc)
+    if on_page is not None:
+        on_page(1, is_success, text)
+    return is_success, text
@@ -1,12 +1,28 @@
 from textract import detect_text
 
-from db import set_object
+from metrics import timed, job_timings_recorder, record_queue_wait
+from events import publish
+from tasks import store_extraction, finish_extraction
 
 
-def detect_text_and_set_db(file_path: str, key: str, field: str = 'content'):
-    is_success, content = detect_text(file_path)
-    if is_success is True:
-        set_object(key, field, content)
-        return True, content
-    else:
-        return False, content
+def detect_text_and_set_db(file_path: str, key: str, field: str = 'content', doc_type: str = "image"):
+    def publish_page(page_number: int, is_success: bool, content: str):
+        publish(key, "page", {"page": page_number, "is_success": is_success, "content": content})
+
+    fields = {}
+    # The timings are stored at the end of the block, along with the job's metrics.
+    with job_timings_recorder(key):
+        record_queue_wait(doc_type=doc_type, engine="textract")
+        publish(key, "stage", {"stage": "ocr"})
+        with timed("ocr", doc_type=doc_type, engine="textract") as timer:
+            is_success, content = detect_text(file_path, is_pdf=doc_type == "pdf", on_page=publish_page)
+            if is_success is False:
+                timer.fail()
+        if is_success is True:
+            fields[field] = content
+        else:
+            fields["error"] = content
+        store_extraction(key, doc_type, is_success, fields)
+    # Classification and structured data extraction run on the analysis queue, which then marks the job completed.
+    finish_extraction(key, field, doc_type, is_success)
+    return is_success, content
@@ -0,0 +1,203 @@
+"""
+Supervised pool of rq worker processes.
+
+A single `rq worker` uses a single core, and every workload waits in one line behind the others.
+Instead, this runs a configurable number of worker processes per group of queues. See tasks.py for the queues.
+
+WORKER_POOL configures the groups, separated by `;`. A group lists its queues in priority order, followed by the number of processes:
+
+    WORKER_POOL="default,ocr=3;pdf=1;textract=4;analysis=1"
+
+Here 3 processes serve the default queue first and then ocr, 1 process serves pdf, 4 processes serve textract and 1 serves analysis.
+
+Heavy modules, e.g OpenCV, the NLTK data and the Tesseract engines, are loaded once in the supervisor.
+Worker processes are forked from the supervisor, hence they start warm and share those memory pages.
+rq forks a work horse per job from the worker process, which inherits the same.
+
+A worker process is recycled, i.e exits and is replaced, after WORKER_MAX_JOBS jobs or once its RSS crosses WORKER_MAX_RSS_MB.
+A worker which dies for any other reason is replaced as well.
+
+Usage:
+
+    python worker_pool.py
+"""
+import os
+import time
+import signal
+import logging
+import importlib
+import multiprocessing
+from typing import List, Tuple
+
+from rq import Queue, Worker
+
+from db import get_connection
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKER_POOL = f"default,ocr={os.cpu_count() or 1};pdf=1;textract=2;analysis=1"
+WORKER_MAX_JOBS = int(os.environ.get("WORKER_MAX_JOBS", "500"))
+WORKER_MAX_RSS_MB = int(os.environ.get("WORKER_MAX_RSS_MB", "1024"))
+# Modules imported by the jobs. Importing them upfront loads OpenCV, boto3 etc.
+# A module having a `warm_up` function gets it called, to load its models and data, e.g NLTK data and the Tesseract engines.
+WORKER_PRELOAD_MODULES = os.environ.get("WORKER_PRELOAD_MODULES", "service_wrappers,textract_wrapper,textract,text_analysis,ocr_engine")
+# A worker dying sooner than this after start is considered crashing, and is restarted with a delay.
+MIN_WORKER_LIFETIME = 10
+
+
+def parse_worker_pool(config: str) -> List[Tuple[List[str], int]]:
+    groups = []
+    for group in config.split(";"):
+        group = group.strip()
+        if group == "":
+            continue
+        queues, _, count = group.partition("=")
+        queue_names = [queue_name.strip() for queue_name in queues.split(",") if queue_name.strip() != ""]
+        groups.append((queue_names, int(count or 1)))
+    return groups
+
+
+def get_rss_mb() -> float:
+    """
+    Current resident set size of this process.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        # Not on Linux. Fall back to the peak RSS, reported in KB.
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process. ru_maxrss is in KB on Linux.
+    """
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class RecyclingWorker(Worker):
+    """
+    An rq Worker which stops once its RSS, or the peak RSS of its last work horse, crosses `max_rss_mb`. Checked after every job.
+    rq's `max_jobs` takes care of the job count.
+
+    rq runs every job in a work horse forked from the worker, and the horse's memory is freed once it exits.
+    The horse starts as a copy of the worker, hence a horse crossing the limit means the worker has grown, or the jobs have.
+    The horse reports its peak RSS through shared memory, which rq's fork keeps shared.
+    """
+
+    def __init__(self, *args, max_rss_mb: int = WORKER_MAX_RSS_MB, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_rss_mb = max_rss_mb
+        self.horse_rss_mb = multiprocessing.Value("d", 0.0, lock=False)
+
+    def perform_job(self, job, queue):
+        # Runs in the work horse.
+        try:
+            return super().perform_job(job, queue)
+        finally:
+            self.horse_rss_mb.value = get_peak_rss_mb()
+
+    def execute_job(self, job, queue):
+        self.horse_rss_mb.value = 0.0
+        result = super().execute_job(job, queue)
+        rss_mb = max(get_rss_mb(), self.horse_rss_mb.value)
+        if rss_mb > self.max_rss_mb:
+            logger.info(f"Worker {self.name} RSS {rss_mb:.0f} MB exceeds {self.max_rss_mb} MB, recycling")
+            # Checked by rq's work loop before dequeuing the next job.
+            self._stop_requested = True
+        return result
+
+
+def preload():
+    """
+    Loads the heavy modules and resources once, in the supervisor.
+    """
+    # Every job runs Tesseract on a single core, we parallelise across processes instead.
+    # Has to be set before Tesseract is loaded.
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    for module_name in WORKER_PRELOAD_MODULES.split(","):
+        module_name = module_name.strip()
+        if module_name != "":
+            logger.info(f"Preloading {module_name}")
+            module = importlib.import_module(module_name)
+            if hasattr(module, "warm_up"):
+                module.warm_up()
+
+
+def run_worker(queue_names: List[str]):
+    # The supervisor's signal handlers shouldn't apply to the worker, rq installs its own.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    connection = get_connection()
+    queues = [Queue(queue_name, connection=connection) for queue_name in queue_names]
+    worker = RecyclingWorker(queues, connection=connection)
+    worker.work(max_jobs=WORKER_MAX_JOBS)
+
+
+def supervise(groups: List[Tuple[List[str], int]]):
+    context = multiprocessing.get_context("fork")
+    # slot -> (process, queue names, start time, restart delay)
+    slots = {}
+    # slot -> (queue names, restart time, restart delay), of the crashing workers waiting to be restarted.
+    restarts = {}
+    stopping = False
+
+    def start(slot, queue_names, delay=0):
+        process = context.Process(target=run_worker, args=(queue_names,), name=f"rq-{','.join(queue_names)}-{slot[1]}")
+        process.start()
+        logger.info(f"Started worker {process.name} with pid {process.pid}")
+        slots[slot] = (process, queue_names, time.monotonic(), delay)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        logger.info("Stopping workers")
+        for process, _, _, _ in slots.values():
+            if process.is_alive():
+                # rq performs a warm shutdown on SIGTERM, i.e finishes the current job.
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for group_index, (queue_names, count) in enumerate(groups):
+        for index in range(count):
+            start((group_index, index), queue_names)
+    while not stopping:
+        time.sleep(1)
+        now = time.monotonic()
+        for slot, (queue_names, restart_at, delay) in list(restarts.items()):
+            if now >= restart_at and not stopping:
+                del restarts[slot]
+                start(slot, queue_names, delay)
+        for slot, (process, queue_names, started_at, delay) in list(slots.items()):
+            if process.is_alive() or stopping or slot in restarts:
+                continue
+            lifetime = now - started_at
+            logger.info(f"Worker {process.name} exited with code {process.exitcode} after {lifetime:.0f}s")
+            if lifetime < MIN_WORKER_LIFETIME:
+                # Crashing right after start, back off instead of restarting in a tight loop.
+                # The other slots, and a shutdown, are still attended to meanwhile.
+                delay = min(max(delay * 2, 1), 60)
+                logger.info(f"Restarting worker {process.name} in {delay}s")
+                restarts[slot] = (queue_names, now + delay, delay)
+            else:
+                start(slot, queue_names, 0)
+    for process, _, _, _ in slots.values():
+        process.join()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    groups = parse_worker_pool(os.environ.get("WORKER_POOL", DEFAULT_WORKER_POOL))
+    logger.info(f"Worker pool: {groups}")
+    preload()
+    supervise(groups)
+
+
+if __name__ == "__main__":
+    main()